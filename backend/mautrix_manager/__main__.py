@@ -13,14 +13,28 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+
+import asyncpg
+
 from mautrix.util.program import Program
 from mautrix.util.async_db import Database
 
 from .config import Config
-from .server import Server
-from .mixpanel import init as init_mixpanel
-from .database import upgrade_table, Base
+from .server import Server, precompress_resources
+from .mixpanel import init as init_mixpanel, stop as stop_mixpanel
+from .database import upgrade_table, Base, Token
 from .version import version
+from .util import json_codec
+from . import workers
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Arbitrary key for the advisory lock that serializes schema upgrades between workers
+SCHEMA_UPGRADE_LOCK = 0x6D61755F6D6E67
 
 
 class MautrixManager(Program):
@@ -36,20 +50,68 @@ class MautrixManager(Program):
     server: Server
     database: Database
 
+    def prepare(self) -> None:
+        if self.config["server.speedups.orjson"] and not json_codec.use_orjson(True):
+            self.log.warning("orjson is enabled in the config, but it's not installed")
+        # This is done before the event loop starts, and before forking so that workers don't
+        # all write the same files at once
+        precompress_resources(self.config)
+        if self.config["server.workers"] > 1:
+            # Fork before the event loop is created. This only returns in the workers.
+            workers.start(self.config, self.config["server.workers"])
+        super().prepare()
+
+    def prepare_loop(self) -> None:
+        # Program uses uvloop whenever it's installed, but here it's opt-in
+        if self.config["server.speedups.uvloop"]:
+            if uvloop is not None:
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+                self.log.debug("Using uvloop for asyncio")
+            else:
+                self.log.warning("uvloop is enabled in the config, but it's not installed")
+        # Newer uvloop versions don't create a loop in get_event_loop() anymore
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def start_prometheus(self) -> None:
+        if workers.is_worker() and self.config["metrics.enabled"]:
+            # Each worker has its own metrics, so they can't all listen on the same port.
+            self.config["metrics.listen_port"] += workers.worker_id - 1
+        super().start_prometheus()
+
     async def start(self) -> None:
         self.database = Database(url=self.config["server.database"], upgrade_table=upgrade_table)
         Base.db = self.database
+        Token.init_cache(max_size=self.config["server.token_cache.size"],
+                         ttl=self.config["server.token_cache.ttl"],
+                         negative_ttl=self.config["server.token_cache.negative_ttl"])
         init_mixpanel(self.config)
         self.server = Server(self.config)
 
-        await self.database.start()
+        if workers.is_worker():
+            await self._start_database_locked()
+        else:
+            await self.database.start()
         await self.server.start()
 
         await super().start()
 
+    async def _start_database_locked(self) -> None:
+        # The workers start at the same time, so only let one of them upgrade the schema at once
+        conn = await asyncpg.connect(self.config["server.database"])
+        try:
+            await conn.execute("SELECT pg_advisory_lock($1)", SCHEMA_UPGRADE_LOCK)
+            try:
+                await self.database.start()
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", SCHEMA_UPGRADE_LOCK)
+        finally:
+            await conn.close()
+
     async def stop(self) -> None:
         await super().stop()
         await self.server.stop()
+        await stop_mixpanel()
 
 
 MautrixManager().run()
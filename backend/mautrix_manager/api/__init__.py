@@ -16,19 +16,25 @@
 from aiohttp import web
 
 from ..config import Config
+from ..metrics import metrics_middleware
 from .initable import init as init_all
-from .auth import routes as auth_routes, token_middleware, init as auth_init
+from .auth import (routes as auth_routes, token_middleware, init as auth_init,
+                   stop as auth_stop)
+from .bridge import init as bridge_init
 from . import (docker_proxy, generic_proxy, telegram_proxy, facebook_proxy, hangouts_proxy,
                whatsapp_proxy, slack_proxy, mx_puppet_twitter_proxy, instagram_proxy, tracking,
-               slack_link, mx_puppet_twitter_link, twitter_proxy, manager_config)
+               slack_link, mx_puppet_twitter_link, twitter_proxy, manager_config, bridge_status,
+               response_cache, ws_relay, sessions)
 
 integrations_app = web.Application()
 integrations_app.add_routes(auth_routes)
 
-api_app = web.Application(middlewares=[token_middleware])
+api_app = web.Application(middlewares=[metrics_middleware, token_middleware])
 ui_app = web.Application()
 
 
 def init(config: Config) -> None:
     auth_init(config)
+    integrations_app.on_cleanup.append(auth_stop)
+    bridge_init(config, api_app)
     init_all(config, api_app, ui_app)
@@ -13,16 +13,20 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Callable, Awaitable, TYPE_CHECKING
-import json
+from typing import Dict, Callable, Awaitable, Tuple, Optional, TYPE_CHECKING
+import ipaddress
+import asyncio
+import logging
 
 from mautrix.client import Client
 from mautrix.types import UserID
-from aiohttp import web, hdrs, ClientSession, ClientError
+from aiohttp import web, hdrs, ClientSession, ClientError, ClientTimeout
 from yarl import URL
 
 from ..database import Token
 from ..config import Config
+from ..util import TTLCache, json_codec
+from ..util.json_codec import json_response, read_json, JSONDecodeError
 from .errors import Error
 
 if TYPE_CHECKING:
@@ -43,12 +47,24 @@ Handler = Callable[[web.Request], Awaitable[web.Response]]
 
 routes = web.RouteTableDef()
 config: Config
-userinfo_url: URL
+http: ClientSession
+federation_timeout: ClientTimeout
+max_sessions_per_user: int
+# Federation API base URLs by server name. Servers whose .well-known couldn't be fetched are
+# cached for a shorter time.
+federation_urls: TTLCache[str, URL]
+federation_negative_ttl: float
+# User IDs by (server name, OpenID token), so retried registrations don't need new requests.
+verified_tokens: TTLCache[Tuple[str, str], UserID]
+
+DEFAULT_FEDERATION_PORT = 8448
+
+log = logging.getLogger("mau.manager.auth")
 
 
 def make_error(errcode: str, error: str) -> Dict[str, str]:
     return {
-        "body": json.dumps({
+        "body": json_codec.dumps({
             "error": error,
             "errcode": errcode,
         }),
@@ -70,6 +86,7 @@ async def get_token(request: web.Request) -> Token:
     token = await Token.get(auth)
     if not token:
         raise Error.invalid_auth_token
+    token.touch()
     return token
 
 
@@ -92,14 +109,80 @@ account_cors_headers = {
 @routes.get("/account")
 async def get_auth(request: web.Request) -> web.Response:
     token = await get_token(request)
-    return web.json_response({"user_id": token.user_id}, headers=account_cors_headers)
+    return json_response({"user_id": token.user_id}, headers=account_cors_headers)
+
 
+def _split_server_name(server_name: str) -> Tuple[str, Optional[int]]:
+    host, port = server_name, None
+    if server_name.startswith("["):
+        # IPv6 literal, possibly with a port
+        end = server_name.index("]")
+        host, rest = server_name[:end + 1], server_name[end + 1:]
+        if rest:
+            port = int(rest.lstrip(":"))
+    elif ":" in server_name:
+        host, port_str = server_name.rsplit(":", 1)
+        port = int(port_str)
+    return host, port
+
+
+def _is_ip_literal(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return True
+    except ValueError:
+        return False
 
-async def check_openid_token(token: str) -> UserID:
-    async with ClientSession() as sess:
-        async with sess.get(userinfo_url.with_query({"access_token": token})) as resp:
-            data: OpenIDResponse = await resp.json()
-            return UserID(data["sub"])
+
+def _server_url(server_name: str) -> URL:
+    host, port = _split_server_name(server_name)
+    return URL(f"https://{host}:{port or DEFAULT_FEDERATION_PORT}")
+
+
+async def _discover_server(server_name: str) -> Tuple[URL, Optional[float]]:
+    """
+    Find the federation API URL of a server with ``.well-known/matrix/server``. Returns the URL
+    and the cache TTL to use (None for the default). SRV records aren't supported.
+    """
+    host, port = _split_server_name(server_name)
+    if port or _is_ip_literal(host):
+        return _server_url(server_name), None
+    try:
+        async with http.get(f"https://{server_name}/.well-known/matrix/server",
+                            timeout=federation_timeout) as resp:
+            if resp.status == 200:
+                data = await resp.json(content_type=None, loads=json_codec.loads)
+                return _server_url(data["m.server"]), None
+    except (ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+        log.debug(f"Failed to get .well-known of {server_name}: {type(e).__name__}")
+    return _server_url(server_name), federation_negative_ttl
+
+
+async def get_federation_url(server_name: str) -> URL:
+    if server_name == config["homeserver.domain"]:
+        return URL(config["homeserver.federation_url"])
+    url = federation_urls.get(server_name)
+    if url is None:
+        url, ttl = await _discover_server(server_name)
+        federation_urls.set(server_name, url, ttl=ttl)
+    return url
+
+
+async def check_openid_token(token: str, server_name: str, expires_in: int = 0) -> UserID:
+    user_id = verified_tokens.get((server_name, token))
+    if user_id:
+        return user_id
+    url = (await get_federation_url(server_name)
+           / "_matrix" / "federation" / "v1" / "openid" / "userinfo")
+    async with http.get(url.with_query({"access_token": token}),
+                        timeout=federation_timeout) as resp:
+        data: OpenIDResponse = await resp.json(loads=json_codec.loads)
+        user_id = UserID(data["sub"])
+    if expires_in > 0:
+        # The cache TTL is an upper limit, the token can't be trusted after it expires either.
+        verified_tokens.set((server_name, token), user_id,
+                            ttl=min(expires_in, verified_tokens.ttl))
+    return user_id
 
 
 @routes.route(hdrs.METH_OPTIONS, "/account/register")
@@ -112,15 +195,21 @@ async def cors_token(_: web.Request) -> web.Response:
 @routes.post("/account/register")
 async def exchange_token(request: web.Request) -> web.Response:
     try:
-        data: 'OpenIDPayload' = await request.json()
-    except json.JSONDecodeError:
+        data: 'OpenIDPayload' = await read_json(request)
+    except JSONDecodeError:
         raise Error.request_not_json
     if "access_token" not in data or "matrix_server_name" not in data:
         raise Error.invalid_openid_payload
+    server_name = data["matrix_server_name"]
+    # Don't make requests to arbitrary servers if nobody there could be allowed in anyway
+    if not isinstance(server_name, str) or not config.is_server_allowed(server_name):
+        raise Error.no_access
+    expires_in = data.get("expires_in")
     try:
-        user_id = await check_openid_token(data["access_token"])
+        user_id = await check_openid_token(data["access_token"], server_name,
+                                           expires_in if isinstance(expires_in, int) else 0)
         _, homeserver = Client.parse_user_id(user_id)
-    except (ClientError, json.JSONDecodeError, KeyError, ValueError):
+    except (ClientError, asyncio.TimeoutError, JSONDecodeError, KeyError, ValueError):
         raise Error.invalid_openid_token
     if homeserver != data["matrix_server_name"]:
         raise Error.homeserver_mismatch
@@ -129,7 +218,9 @@ async def exchange_token(request: web.Request) -> web.Response:
         raise Error.no_access
     token = Token.random(user_id)
     await token.insert()
-    return web.json_response({
+    if max_sessions_per_user > 0:
+        await Token.delete_old_sessions(user_id, keep=max_sessions_per_user)
+    return json_response({
         "user_id": user_id,
         "token": token.secret,
         "level": permissions.level,
@@ -143,11 +234,22 @@ async def exchange_token(request: web.Request) -> web.Response:
 async def logout(request: web.Request) -> web.Response:
     token = await get_token(request)
     await token.delete()
-    return web.json_response({}, status=204, headers=account_cors_headers)
+    return json_response({}, status=204, headers=account_cors_headers)
 
 
 def init(cfg: Config) -> None:
-    global config, userinfo_url
+    global config, http, federation_timeout, max_sessions_per_user, federation_urls
+    global federation_negative_ttl, verified_tokens
     config = cfg
-    userinfo_url = (URL(config["homeserver.federation_url"])
-                    / "_matrix" / "federation" / "v1" / "openid" / "userinfo")
+    max_sessions_per_user = cfg["server.sessions.max_per_user"]
+    http = ClientSession()
+    federation_timeout = ClientTimeout(total=cfg["server.openid.timeout"])
+    federation_urls = TTLCache(cfg["server.openid.server_cache_size"],
+                               cfg["server.openid.server_cache_ttl"])
+    federation_negative_ttl = cfg["server.openid.server_negative_ttl"]
+    verified_tokens = TTLCache(cfg["server.openid.token_cache_size"],
+                               cfg["server.openid.token_cache_ttl"])
+
+
+async def stop(_: web.Application) -> None:
+    await http.close()
@@ -0,0 +1,211 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Any, Tuple
+import asyncio
+import logging
+import time
+
+from aiohttp import web, hdrs
+from attr import dataclass
+from yarl import URL
+import aiohttp
+
+from ..config import Config
+from ..metrics import BRIDGE_BREAKER_STATE
+from ..util import CircuitBreaker, BreakerState, json_codec
+
+# Sent to bridges so they can give up on requests the manager will no longer wait for.
+# The value is a Unix timestamp in milliseconds.
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# Upstream statuses that mean a reverse proxy couldn't reach the bridge
+UNAVAILABLE_STATUSES = frozenset({502, 503, 504})
+
+BREAKER_STATE_VALUES = {
+    BreakerState.CLOSED: 0,
+    BreakerState.HALF_OPEN: 1,
+    BreakerState.OPEN: 2,
+}
+
+
+@dataclass
+class Bridge:
+    name: str
+    url: Optional[URL]
+    secret: Optional[str]
+    breaker: CircuitBreaker
+    http_options: Dict[str, Any]
+    socket_path: Optional[str] = None
+    http: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url and self.secret)
+
+    @property
+    def coalesce_requests(self) -> bool:
+        return self.http_options["coalesce_requests"]
+
+    def deadline_header(self, timeout: Optional[aiohttp.ClientTimeout] = None) -> Dict[str, str]:
+        total = (timeout or self.http.timeout).total
+        if not total:
+            return {}
+        return {DEADLINE_HEADER: str(int((time.time() + total) * 1000))}
+
+    def request_headers(self, timeout: Optional[aiohttp.ClientTimeout] = None
+                        ) -> Dict[str, str]:
+        """Get the headers for requests that the manager makes to the bridge by itself."""
+        return {
+            hdrs.AUTHORIZATION: f"Bearer {self.secret}",
+            # The session doesn't decompress responses, so don't ask for compressed ones.
+            hdrs.ACCEPT_ENCODING: "identity",
+            **self.deadline_header(timeout),
+        }
+
+    def start(self) -> None:
+        # Each bridge gets its own connection pool, so a slow bridge can't use up the
+        # connections of other bridges.
+        opts = self.http_options
+        if self.socket_path:
+            connector = aiohttp.UnixConnector(self.socket_path, limit=opts["limit"],
+                                              keepalive_timeout=opts["keepalive_timeout"])
+        else:
+            connector = aiohttp.TCPConnector(limit=opts["limit"],
+                                             limit_per_host=opts["limit_per_host"],
+                                             keepalive_timeout=opts["keepalive_timeout"],
+                                             ttl_dns_cache=opts["dns_cache_ttl"])
+        timeout = aiohttp.ClientTimeout(total=opts["timeout"]["total"],
+                                        connect=opts["timeout"]["connect"],
+                                        sock_read=opts["timeout"]["sock_read"])
+        # Responses are streamed to the client as-is, so don't decompress them.
+        self.http = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                          auto_decompress=False,
+                                          json_serialize=json_codec.dumps)
+
+    async def stop(self) -> None:
+        if self.http:
+            await self.http.close()
+            self.http = None
+
+    def _state_changed(self, state: BreakerState) -> None:
+        BRIDGE_BREAKER_STATE.labels(bridge=self.name).set(BREAKER_STATE_VALUES[state])
+        if state == BreakerState.OPEN:
+            log.warning(f"{self.name} is unavailable ({self.breaker.last_failure}), "
+                        f"failing requests to it for {self.breaker.reset_timeout} seconds")
+        elif state == BreakerState.CLOSED:
+            log.info(f"{self.name} is available again")
+
+
+bridges: Dict[str, Bridge] = {}
+probe_interval: float
+probe_timeout: aiohttp.ClientTimeout
+_probe_task: Optional[asyncio.Future] = None
+
+log = logging.getLogger("mau.manager.bridge")
+
+
+def get_health() -> Dict[str, dict]:
+    return {name: bridge.breaker.stats() for name, bridge in bridges.items() if bridge.enabled}
+
+
+async def probe(bridge: Bridge) -> None:
+    # Any HTTP response means the bridge is up, even if it doesn't like our request.
+    try:
+        async with bridge.http.get(bridge.url, headers=bridge.request_headers(probe_timeout),
+                                   timeout=probe_timeout) as resp:
+            if resp.status in UNAVAILABLE_STATUSES:
+                bridge.breaker.record_failure(f"HTTP {resp.status}")
+                return
+    except asyncio.TimeoutError:
+        bridge.breaker.record_failure("timeout")
+    except aiohttp.ClientError as e:
+        bridge.breaker.record_failure(type(e).__name__)
+    else:
+        bridge.breaker.record_success()
+
+
+async def _probe_loop() -> None:
+    while True:
+        try:
+            await asyncio.gather(*(probe(bridge) for bridge in bridges.values()
+                                   if bridge.enabled))
+        except Exception:
+            log.exception("Error probing bridges")
+        await asyncio.sleep(probe_interval)
+
+
+async def _start(_: web.Application) -> None:
+    global _probe_task
+    for bridge in bridges.values():
+        if bridge.enabled:
+            bridge.start()
+    if probe_interval > 0:
+        _probe_task = asyncio.ensure_future(_probe_loop())
+
+
+async def _stop(_: web.Application) -> None:
+    global _probe_task
+    if _probe_task:
+        _probe_task.cancel()
+        try:
+            await _probe_task
+        except asyncio.CancelledError:
+            pass
+        _probe_task = None
+    await asyncio.gather(*(bridge.stop() for bridge in bridges.values()))
+
+
+def parse_url(url: Optional[str]) -> Tuple[Optional[URL], Optional[str]]:
+    """
+    Parse a bridge URL. In addition to normal HTTP URLs, this supports connecting to bridges
+    through unix sockets with ``unix:///path/to/socket:/http/path``. Returns the HTTP URL to
+    request and the socket path, if any.
+    """
+    if not url:
+        return None, None
+    if not url.startswith("unix://"):
+        return URL(url), None
+    socket_path, _, http_path = url[len("unix://"):].partition(":")
+    # The host is only used for the Host header, the connector always connects to the socket.
+    return URL("http://localhost").with_path(http_path or "/"), socket_path
+
+
+def _http_options(defaults: Dict[str, Any], overrides: Optional[Dict[str, Any]]
+                  ) -> Dict[str, Any]:
+    if not overrides:
+        return defaults
+    return {**defaults, **overrides,
+            "timeout": {**defaults["timeout"], **(overrides.get("timeout") or {})}}
+
+
+def init(cfg: Config, app: web.Application) -> None:
+    global probe_interval, probe_timeout
+    probe_interval = cfg["server.bridge_health.probe_interval"]
+    probe_timeout = aiohttp.ClientTimeout(total=cfg["server.bridge_health.probe_timeout"])
+    http_defaults = cfg["server.bridge_http"]
+    bridges.clear()
+    for name, data in cfg["bridges"].items():
+        url, socket_path = parse_url(data["url"])
+        bridge = Bridge(name=name, url=url, socket_path=socket_path, secret=data["secret"],
+                        breaker=CircuitBreaker(cfg["server.bridge_health.failure_threshold"],
+                                               cfg["server.bridge_health.reset_timeout"]),
+                        http_options=_http_options(http_defaults, data.get("http")))
+        bridge.breaker.on_state_change = bridge._state_changed
+        bridges[name] = bridge
+        if bridge.enabled:
+            BRIDGE_BREAKER_STATE.labels(bridge=name).set(0)
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
@@ -0,0 +1,112 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Callable, NamedTuple, Union, Awaitable
+import asyncio
+import logging
+import time
+
+from aiohttp import web, ClientError, ClientTimeout, ContentTypeError
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..util import json_codec
+from ..util.json_codec import json_response, JSONDecodeError
+from .initable import initializer
+from .bridge import Bridge, bridges, UNAVAILABLE_STATUSES
+from . import (telegram_proxy, whatsapp_proxy, facebook_proxy, hangouts_proxy, twitter_proxy,
+               slack_proxy, mx_puppet_twitter_proxy, instagram_proxy)
+
+Info = Dict[str, Any]
+StatusSource = NamedTuple("StatusSource",
+                          get_info=Callable[[UserID], Union[Info, Awaitable[Info]]], path=str)
+
+# The local info endpoint and the upstream per-user status endpoint the UI uses for each bridge
+sources: Dict[str, StatusSource] = {
+    "mautrix-telegram": StatusSource(telegram_proxy.get_info, "user/{user_id}"),
+    "mautrix-whatsapp": StatusSource(whatsapp_proxy.get_info, "ping"),
+    "mautrix-facebook": StatusSource(facebook_proxy.get_info, "api/whoami"),
+    "mautrix-hangouts": StatusSource(hangouts_proxy.get_info, "api/whoami"),
+    "mautrix-twitter": StatusSource(twitter_proxy.get_info, "api/whoami"),
+    "mx-puppet-slack": StatusSource(slack_proxy.get_info, "status"),
+    "mx-puppet-twitter": StatusSource(mx_puppet_twitter_proxy.get_info, "status"),
+    "mx-puppet-instagram": StatusSource(instagram_proxy.get_info, "status"),
+}
+
+routes = web.RouteTableDef()
+timeout: ClientTimeout
+
+log = logging.getLogger("mau.manager.bridge_status")
+
+
+async def _fetch_status(bridge: Bridge, path: str, user_id: UserID) -> Dict[str, Any]:
+    url = bridge.url / path.format(user_id=user_id)
+    async with bridge.http.get(url, params={"user_id": user_id},
+                               headers=bridge.request_headers(timeout), timeout=timeout) as resp:
+        if resp.status in UNAVAILABLE_STATUSES:
+            bridge.breaker.record_failure(f"HTTP {resp.status}")
+        else:
+            bridge.breaker.record_success()
+        result = {"status_code": resp.status}
+        if resp.status != 204:
+            result["status"] = await resp.json(loads=json_codec.loads)
+        return result
+
+
+async def _check_bridge(name: str, user_id: UserID) -> Dict[str, Any]:
+    source = sources[name]
+    bridge = bridges[name]
+    start = time.monotonic()
+    info = source.get_info(user_id)
+    # Bridges with link tokens need to query the link state store
+    if asyncio.iscoroutine(info):
+        info = await info
+    result = {"info": info}
+    if not bridge.breaker.allow_request():
+        result["error"] = "Bridge is unavailable"
+        result["duration_ms"] = 0
+        return result
+    try:
+        result.update(await _fetch_status(bridge, source.path, user_id))
+    except asyncio.TimeoutError:
+        bridge.breaker.record_failure("timeout")
+        result["error"] = "Bridge did not respond in time"
+    except (ContentTypeError, JSONDecodeError):
+        result["error"] = "Invalid response from bridge"
+    except ClientError as e:
+        log.debug(f"Failed to fetch status from {name}", exc_info=True)
+        bridge.breaker.record_failure(type(e).__name__)
+        result["error"] = "Failed to contact bridge"
+    except Exception:
+        log.warning(f"Unhandled error fetching status from {name}", exc_info=True)
+        result["error"] = "Unknown error"
+    result["duration_ms"] = round((time.monotonic() - start) * 1000)
+    return result
+
+
+@routes.get("/bridges/status")
+async def get_status(request: web.Request) -> web.Response:
+    user_id = request["token"].user_id
+    names = [name for name, bridge in bridges.items() if bridge.enabled and name in sources]
+    results = await asyncio.gather(*(_check_bridge(name, user_id) for name in names))
+    return json_response(dict(zip(names, results)))
+
+
+@initializer
+def init(cfg: Config, app: web.Application) -> None:
+    global timeout
+    timeout = ClientTimeout(total=cfg["server.bridge_status_timeout"])
+    app.add_routes(routes)
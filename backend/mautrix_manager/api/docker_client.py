@@ -0,0 +1,130 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Tuple, List, Optional
+import logging
+import asyncio
+
+from aiohttp import web
+from attr import dataclass
+from yarl import URL
+import aiohttp
+
+from ..config import Config
+from ..util import json_codec
+from .initable import initializer
+from .errors import Error
+
+API_VERSION = "v1.35"
+# Don't time out long-running responses like log streams, but don't wait forever for a
+# connection to the daemon either.
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=5, sock_connect=5, sock_read=None)
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5, sock_connect=5)
+
+
+@dataclass
+class DockerHost:
+    name: str
+    url: URL
+    http: aiohttp.ClientSession
+
+    def api_url(self, path: str) -> URL:
+        return self.url / API_VERSION / path
+
+    async def inspect_container(self, container_id: str) -> Dict[str, Any]:
+        async with self.http.get(self.api_url(f"containers/{container_id}/json"),
+                                 timeout=REQUEST_TIMEOUT) as resp:
+            if resp.status == 404:
+                raise web.HTTPNotFound(text=f"Container {container_id} not found")
+            resp.raise_for_status()
+            return await resp.json(loads=json_codec.loads)
+
+
+config: Config
+# Every host has its own session, so a slow host can't use up the connections of other hosts.
+hosts: Dict[str, DockerHost] = {}
+default_host: DockerHost
+# How long to wait for each host when looking through all of them
+host_timeout: float
+
+log = logging.getLogger("mau.manager.docker")
+
+
+def check_access(request: web.Request) -> None:
+    if not config.get_permissions(request["token"].user_id).admin:
+        raise Error.no_access_docker
+
+
+def get_host(name: str) -> DockerHost:
+    try:
+        return hosts[name]
+    except KeyError:
+        raise web.HTTPNotFound(text=f"Docker host {name} not found")
+
+
+async def locate_container(container_id: str) -> Tuple[DockerHost, Dict[str, Any]]:
+    """
+    Find which host has the given container by asking all of them at the same time. Returns as
+    soon as one host has the container, so slow hosts only matter if no host has it.
+    """
+
+    async def try_inspect(host: DockerHost) -> Optional[Tuple[DockerHost, Dict[str, Any]]]:
+        try:
+            return host, await asyncio.wait_for(host.inspect_container(container_id),
+                                                timeout=host_timeout)
+        except web.HTTPNotFound:
+            return None
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            log.warning(f"Failed to look for {container_id} on {host.name}: "
+                        f"{type(e).__name__}")
+            return None
+
+    tasks: List[asyncio.Future] = [asyncio.ensure_future(try_inspect(host))
+                                   for host in hosts.values()]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            if result:
+                return result
+    finally:
+        for task in tasks:
+            task.cancel()
+    raise web.HTTPNotFound(text=f"Container {container_id} not found")
+
+
+async def close_hosts(_: web.Application) -> None:
+    for host in hosts.values():
+        await host.http.close()
+
+
+def _make_host(name: str, url: str) -> DockerHost:
+    if url.startswith("unix://"):
+        http = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=url[len("unix://"):]),
+                                     loop=asyncio.get_event_loop())
+        url = "unix://localhost"
+    else:
+        http = aiohttp.ClientSession(loop=asyncio.get_event_loop())
+    return DockerHost(name=name, url=URL(url), http=http)
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global config, default_host, host_timeout
+    config = cfg
+    host_timeout = cfg["docker.host_timeout"]
+    hosts.clear()
+    for host in cfg["docker.hosts"] or [{"name": "default", "url": cfg["docker.host"]}]:
+        hosts[host["name"]] = _make_host(host["name"], host["url"])
+    default_host = next(iter(hosts.values()))
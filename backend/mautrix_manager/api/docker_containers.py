@@ -0,0 +1,295 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Optional, Set, List
+import asyncio
+import logging
+import time
+
+from aiohttp import web, hdrs
+
+from ..config import Config
+from ..util import json_codec
+from ..util.json_codec import json_response
+from .initable import initializer
+from . import docker_client as docker
+
+routes = web.RouteTableDef()
+
+# Events that can change the fields in the container list. Health check runs cause exec_*
+# events, so listening to everything would mean a lot of useless refreshes.
+WATCHED_EVENTS = ["create", "start", "restart", "stop", "die", "kill", "oom", "pause", "unpause",
+                  "rename", "update", "destroy", "health_status"]
+RETRY_DELAY_MAX = 60
+SUBSCRIBER_QUEUE_SIZE = 64
+
+Container = Dict[str, Any]
+
+subscribers: Set['asyncio.Queue[Optional[Dict[str, Any]]]'] = set()
+
+log = logging.getLogger("mau.manager.docker_containers")
+
+
+def _parse_health(status: str) -> Optional[str]:
+    for health in ("unhealthy", "healthy", "starting"):
+        if f"({health})" in status or f"(health: {health})" in status:
+            return health
+    return None
+
+
+def _end(queue: 'asyncio.Queue[Optional[Dict[str, Any]]]') -> None:
+    # Make room for the end marker if the queue is full
+    while True:
+        try:
+            queue.put_nowait(None)
+            return
+        except asyncio.QueueFull:
+            queue.get_nowait()
+
+
+def _notify(event_type: str, container: Container) -> None:
+    event = {"type": event_type, "container": container}
+    for queue in list(subscribers):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client isn't reading, make it reconnect and get the current state
+            subscribers.discard(queue)
+            _end(queue)
+
+
+class ContainerIndex:
+    """
+    The containers of one Docker host, kept up to date from the Docker event stream.
+
+    Entries are in the same format as Docker's /containers/json, with the host name and the
+    health check status added.
+    """
+
+    host: docker.DockerHost
+    containers: Dict[str, Container]
+    ready: asyncio.Event
+    attempted: bool
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, host: docker.DockerHost) -> None:
+        self.host = host
+        self.containers = {}
+        self.ready = asyncio.Event()
+        self.attempted = False
+        self._task = None
+
+    def _set(self, container: Container) -> None:
+        container["Host"] = self.host.name
+        container["Health"] = _parse_health(container.get("Status", ""))
+        if self.containers.get(container["Id"]) != container:
+            self.containers[container["Id"]] = container
+            _notify("update", container)
+
+    def _remove(self, container_id: str) -> None:
+        container = self.containers.pop(container_id, None)
+        if container:
+            _notify("remove", container)
+
+    async def _list(self, filters: Optional[Dict[str, List[str]]] = None) -> List[Container]:
+        params = {"all": "true"}
+        if filters:
+            params["filters"] = json_codec.dumps(filters)
+        async with self.host.http.get(self.host.api_url("containers/json"), params=params,
+                                      timeout=docker.REQUEST_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return await resp.json(loads=json_codec.loads)
+
+    async def _refresh(self, container_id: str) -> None:
+        found = await self._list({"id": [container_id]})
+        if found:
+            self._set(found[0])
+        else:
+            self._remove(container_id)
+
+    async def _seed(self) -> None:
+        found = {container["Id"]: container for container in await self._list()}
+        for container_id in list(self.containers.keys()):
+            if container_id not in found:
+                self._remove(container_id)
+        for container in found.values():
+            self._set(container)
+
+    async def _watch_events(self) -> None:
+        params = {
+            "since": str(int(time.time())),
+            "filters": json_codec.dumps({"type": ["container"], "event": WATCHED_EVENTS}),
+        }
+        async with self.host.http.get(self.host.api_url("events"), params=params,
+                                      timeout=docker.STREAM_TIMEOUT) as resp:
+            resp.raise_for_status()
+            # Subscribe to events before listing containers, so that no changes are missed
+            await self._seed()
+            self.ready.set()
+            self.attempted = True
+            log.debug(f"Container index of {self.host.name} seeded with "
+                      f"{len(self.containers)} containers")
+            while True:
+                line = await resp.content.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                event = json_codec.loads(line)
+                container_id = event.get("id") or event.get("Actor", {}).get("ID")
+                if not container_id:
+                    continue
+                if event.get("Action") == "destroy":
+                    self._remove(container_id)
+                else:
+                    await self._refresh(container_id)
+
+    async def _run(self) -> None:
+        delay = 1
+        while True:
+            try:
+                await self._watch_events()
+                log.warning(f"Docker event stream from {self.host.name} ended, reconnecting")
+                delay = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning(f"Error watching Docker events from {self.host.name}, "
+                            f"retrying in {delay} seconds", exc_info=True)
+            self.ready.clear()
+            self.attempted = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_DELAY_MAX)
+
+    async def wait_ready(self) -> bool:
+        """
+        Start the index if necessary and wait until it's usable. Only the first connection
+        attempt is waited for, after that a disconnected host is skipped right away.
+        """
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+        if self.ready.is_set():
+            return True
+        elif self.attempted:
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(self.ready.wait()), timeout=docker.host_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.attempted = True
+            return False
+
+    def find(self, container: str) -> Optional[Container]:
+        name = f"/{container.lstrip('/')}"
+        for entry in self.containers.values():
+            if entry["Id"].startswith(container) or name in entry.get("Names", []):
+                return entry
+        return None
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.ready.clear()
+        self.attempted = False
+
+
+indexes: Dict[str, ContainerIndex] = {}
+
+
+async def get_containers() -> Dict[str, Container]:
+    """Get the containers of all hosts that are reachable, starting the indexes if necessary."""
+    ready = await asyncio.gather(*(index.wait_ready() for index in indexes.values()))
+    if not any(ready):
+        raise web.HTTPBadGateway(text="Failed to contact Docker daemon")
+    return {container_id: container
+            for index, is_ready in zip(indexes.values(), ready) if is_ready
+            for container_id, container in index.containers.items()}
+
+
+async def find_host(container: str) -> docker.DockerHost:
+    """Find the host that has the given container (ID, ID prefix or name)."""
+    if len(docker.hosts) == 1:
+        return docker.default_host
+    for index in indexes.values():
+        if index.ready.is_set():
+            entry = index.find(container)
+            if entry:
+                return index.host
+    host, _ = await docker.locate_container(container)
+    return host
+
+
+@routes.get("/docker/containers")
+async def list_containers(request: web.Request) -> web.Response:
+    docker.check_access(request)
+    containers = (await get_containers()).values()
+    name = request.query.get("name")
+    if name:
+        name = f"/{name.lstrip('/')}"
+        return json_response([container for container in containers
+                                  if name in container.get("Names", [])])
+    return json_response(list(containers))
+
+
+@routes.get("/docker/containers/events")
+async def container_events(request: web.Request) -> web.StreamResponse:
+    """
+    Stream changes to the container index as server-sent events. The stream starts with a
+    ``reset`` event that has the list of all containers, so clients that reconnect don't miss
+    the changes made in between.
+    """
+    docker.check_access(request)
+    containers = list((await get_containers()).values())
+    # Subscribe right after taking the snapshot, so no changes are lost between them
+    queue: 'asyncio.Queue[Optional[Dict[str, Any]]]' = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+    subscribers.add(queue)
+    try:
+        response = web.StreamResponse(headers={
+            hdrs.CONTENT_TYPE: "text/event-stream",
+            hdrs.CACHE_CONTROL: "no-cache",
+        })
+        await response.prepare(request)
+        await response.write(f"event: reset\ndata: {json_codec.dumps(containers)}\n\n"
+                             .encode("utf-8"))
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            data = json_codec.dumps(event["container"])
+            await response.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+        await response.write_eof()
+        return response
+    finally:
+        subscribers.discard(queue)
+
+
+async def _stop(_: web.Application) -> None:
+    await asyncio.gather(*(index.stop() for index in indexes.values()))
+    for queue in subscribers:
+        _end(queue)
+
+
+@initializer
+def init(_: Config, app: web.Application) -> None:
+    indexes.clear()
+    for name, host in docker.hosts.items():
+        indexes[name] = ContainerIndex(host)
+    app.on_cleanup.append(_stop)
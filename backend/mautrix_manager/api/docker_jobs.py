@@ -0,0 +1,230 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Optional, Set, List
+import asyncio
+import logging
+import random
+import string
+import time
+
+from aiohttp import web, hdrs, ClientError
+from attr import dataclass
+import attr
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..util import TTLCache, json_codec
+from ..util.json_codec import json_response, read_json, JSONDecodeError
+from .. import workers
+from .initable import initializer
+from .errors import Error
+from .docker_containers import find_host
+from . import docker_client as docker
+
+routes = web.RouteTableDef()
+
+ACTIONS = ("start", "stop", "restart")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    action: str
+    user_id: UserID
+    stop_timeout: Optional[int]
+    progress: Dict[str, Dict[str, Any]]
+    created_at: float = attr.ib(factory=time.time)
+    finished_at: Optional[float] = None
+    listeners: 'Set[asyncio.Queue[Optional[Dict[str, Any]]]]' = attr.ib(factory=set)
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def serialize(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "user_id": self.user_id,
+            "containers": self.progress,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    def _notify(self, event: Optional[Dict[str, Any]]) -> None:
+        for queue in self.listeners:
+            queue.put_nowait(event)
+
+    def update(self, container: str, status: str, error: Optional[str] = None) -> None:
+        self.progress[container] = {"status": status, "error": error, "time": time.time()}
+        self._notify({"type": "progress", "container": container, **self.progress[container]})
+
+    def finish(self) -> None:
+        self.finished_at = time.time()
+        self._notify({"type": "done", **self.serialize()})
+        self._notify(None)
+
+
+# Jobs that haven't finished yet. These are never evicted, as the work is still going on.
+running: Dict[str, Job] = {}
+# Finished jobs are kept around for a while so clients can check the results
+jobs: TTLCache[str, Job]
+semaphore: asyncio.Semaphore
+
+log = logging.getLogger("mau.manager.docker_jobs")
+
+
+async def _run_action(job: Job, container: str) -> None:
+    async with semaphore:
+        job.update(container, RUNNING)
+        params = {"t": str(job.stop_timeout)} if job.stop_timeout is not None else {}
+        try:
+            host = await find_host(container)
+        except web.HTTPNotFound:
+            job.update(container, FAILED, f"Container {container} not found")
+            return
+        url = host.api_url(f"containers/{container}/{job.action}")
+        try:
+            # Stopping can take as long as the container's grace period, so don't use the
+            # normal request timeout.
+            async with host.http.post(url, params=params,
+                                      timeout=docker.STREAM_TIMEOUT) as resp:
+                # 304 means the container was already in the requested state
+                if resp.status in (204, 304):
+                    job.update(container, DONE)
+                    return
+                try:
+                    error = (await resp.json(loads=json_codec.loads))["message"]
+                except (ClientError, JSONDecodeError, KeyError, TypeError, ValueError):
+                    error = f"HTTP {resp.status}"
+        except ClientError as e:
+            log.warning(f"Failed to {job.action} {container} on {host.name}", exc_info=True)
+            error = f"Failed to contact Docker daemon: {type(e).__name__}"
+        job.update(container, FAILED, error)
+
+
+async def _run(job: Job) -> None:
+    log.info(f"Running job {job.id}: {job.action} {', '.join(job.progress.keys())} "
+             f"(requested by {job.user_id})")
+    try:
+        await asyncio.gather(*(_run_action(job, container) for container in job.progress))
+    except Exception:
+        log.exception(f"Unhandled error in job {job.id}")
+        for container, progress in job.progress.items():
+            if progress["status"] in (PENDING, RUNNING):
+                job.update(container, FAILED, "Unknown error")
+    finally:
+        job.finish()
+        # The retention time counts from when the job finished
+        jobs.set(job.id, job)
+        running.pop(job.id, None)
+    failed = sum(1 for progress in job.progress.values() if progress["status"] == FAILED)
+    log.info(f"Job {job.id} finished with {failed}/{len(job.progress)} failures")
+
+
+def _get_job(request: web.Request) -> Job:
+    docker.check_access(request)
+    job = running.get(request.match_info["id"]) or jobs.get(request.match_info["id"])
+    if not job:
+        raise web.HTTPNotFound(text="Job not found")
+    return job
+
+
+@routes.post("/docker/jobs")
+async def create_job(request: web.Request) -> web.Response:
+    """
+    Start a job and return it right away, or when it's done if ``wait`` is true. The progress of
+    running jobs can be followed with the events endpoint.
+
+    With multiple workers, jobs are only stored in the worker that created them, and later
+    requests may go to another worker. In that case the job is always waited for.
+    """
+    docker.check_access(request)
+    try:
+        data = await read_json(request)
+    except JSONDecodeError:
+        raise Error.request_not_json
+    try:
+        action = data["action"]
+        containers = data["containers"]
+        stop_timeout = data.get("timeout")
+        wait = data.get("wait") is True or workers.is_worker()
+    except (KeyError, TypeError, AttributeError):
+        raise Error.invalid_docker_job
+    if (action not in ACTIONS or not isinstance(containers, list) or not containers
+            or not all(isinstance(container, str) and container for container in containers)
+            or (stop_timeout is not None and not isinstance(stop_timeout, int))):
+        raise Error.invalid_docker_job
+    job = Job(id="".join(random.choices(string.ascii_lowercase + string.digits, k=16)),
+              action=action, user_id=request["token"].user_id, stop_timeout=stop_timeout,
+              progress={container: {"status": PENDING, "error": None, "time": time.time()}
+                        for container in containers})
+    running[job.id] = job
+    task = asyncio.ensure_future(_run(job))
+    if wait:
+        await asyncio.shield(task)
+        return json_response(job.serialize())
+    return json_response(job.serialize(), status=202)
+
+
+@routes.get("/docker/jobs/{id}")
+async def get_job(request: web.Request) -> web.Response:
+    return json_response(_get_job(request).serialize())
+
+
+@routes.get("/docker/jobs/{id}/events")
+async def job_events(request: web.Request) -> web.StreamResponse:
+    """
+    Stream the progress of a job as server-sent events, starting with the current state. The
+    stream always ends with a ``done`` event, even if the job had already finished.
+    """
+    job = _get_job(request)
+    queue: 'asyncio.Queue[Optional[Dict[str, Any]]]' = asyncio.Queue()
+    events: List[Optional[Dict[str, Any]]] = [{"type": "state", **job.serialize()}]
+    if job.finished:
+        events += [{"type": "done", **job.serialize()}, None]
+    else:
+        job.listeners.add(queue)
+    try:
+        response = web.StreamResponse(headers={
+            hdrs.CONTENT_TYPE: "text/event-stream",
+            hdrs.CACHE_CONTROL: "no-cache",
+        })
+        await response.prepare(request)
+        while True:
+            event = events.pop(0) if events else await queue.get()
+            if event is None:
+                break
+            event_type = event.pop("type")
+            await response.write(f"event: {event_type}\ndata: {json_codec.dumps(event)}\n\n"
+                                 .encode("utf-8"))
+        await response.write_eof()
+        return response
+    finally:
+        job.listeners.discard(queue)
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global jobs, semaphore
+    jobs = TTLCache(cfg["docker.jobs.max_jobs"], cfg["docker.jobs.retention"])
+    semaphore = asyncio.Semaphore(cfg["docker.jobs.parallelism"])
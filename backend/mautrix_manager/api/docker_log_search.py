@@ -0,0 +1,282 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Optional, List, Deque, Pattern, Iterable
+from collections import deque
+import asyncio
+import logging
+import time
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from aiohttp import web, hdrs, ClientError
+
+from ..config import Config
+from ..metrics import UPSTREAM_ERRORS
+from ..util import json_codec
+from .initable import initializer
+from .docker_logs import LogLine, open_logs, read_log_batches
+from . import docker_client as docker
+
+routes = web.RouteTableDef()
+
+LEVELS = {"trace": 0, "debug": 10, "info": 20, "warning": 30, "error": 40, "critical": 50}
+LEVEL_ALIASES = {"warn": "warning", "err": "error", "crit": "critical", "fatal": "critical"}
+# The level is usually near the start of the line, e.g. "[time] [INFO@mau.matrix] message" in
+# the Python bridges or "[time] [WARN] message" in the Go bridges.
+LEVEL_REGEX = re.compile(r"\b(trace|debug|info|warn(?:ing)?|err(?:or)?|crit(?:ical)?|fatal)\b",
+                         re.IGNORECASE)
+LEVEL_SEARCH_LENGTH = 80
+ANSI_REGEX = re.compile(r"\x1b\[[0-9;]*m")
+MAX_PATTERN_LENGTH = 1000
+# Only this much of each line is matched against the search pattern
+MAX_MATCH_LENGTH = 10000
+REPEAT_OPS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+
+default_tail: int
+max_bytes: int
+max_time: float
+max_matches: int
+max_context: int
+
+log = logging.getLogger("mau.manager.docker_log_search")
+
+
+def _parse_level(value: str) -> str:
+    value = value.lower()
+    return LEVEL_ALIASES.get(value, value)
+
+
+def _subpatterns(value: Any) -> Iterable[sre_parse.SubPattern]:
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _subpatterns(item)
+
+
+def _has_nested_repeat(pattern: sre_parse.SubPattern, in_repeat: bool = False) -> bool:
+    """
+    Check if a parsed regex has an unbounded repeat inside another repeat, like ``(a+)*``.
+    Those can take exponential time on lines that almost match.
+    """
+    for op, value in pattern:
+        if op in REPEAT_OPS:
+            _, max_repeat, sub = value
+            unbounded = max_repeat == sre_parse.MAXREPEAT
+            if unbounded and in_repeat:
+                return True
+            if _has_nested_repeat(sub, in_repeat or unbounded):
+                return True
+        elif any(_has_nested_repeat(sub, in_repeat) for sub in _subpatterns(value)):
+            return True
+    return False
+
+
+def _compile_pattern(pattern: str, flags: int) -> Pattern:
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise web.HTTPBadRequest(text=f"The regex can't be longer than {MAX_PATTERN_LENGTH} "
+                                      "characters")
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+        compiled = re.compile(pattern, flags)
+    except re.error as e:
+        raise web.HTTPBadRequest(text=f"Invalid regex: {e}")
+    if _has_nested_repeat(parsed):
+        raise web.HTTPBadRequest(text="Nested unbounded repeats like (a+)* aren't allowed in "
+                                      "the regex")
+    return compiled
+
+
+class LogSearch:
+    """
+    Filters log lines by a regex and a minimum severity, and includes some context lines around
+    each match.
+
+    Lines without a recognizable level (like traceback lines) get the level of the previous line
+    in the same stream.
+    """
+
+    pattern: Optional[Pattern]
+    min_level: Optional[int]
+    context: int
+    deadline: float
+    matches: int
+    scanned_lines: int
+    scanned_bytes: int
+    last_time: Optional[str]
+    timed_out: bool
+    _levels: Dict[str, Optional[str]]
+    _before: Deque[Dict[str, Any]]
+    _after: int
+
+    def __init__(self, pattern: Optional[Pattern], min_level: Optional[int], context: int,
+                 deadline: float) -> None:
+        self.pattern = pattern
+        self.min_level = min_level
+        self.context = context
+        self.deadline = deadline
+        self.matches = 0
+        self.scanned_lines = 0
+        self.scanned_bytes = 0
+        self.last_time = None
+        self.timed_out = False
+        self._levels = {}
+        self._before = deque(maxlen=context)
+        self._after = 0
+
+    def _get_level(self, line: LogLine, text: str) -> Optional[str]:
+        match = LEVEL_REGEX.search(text, 0, LEVEL_SEARCH_LENGTH)
+        if match:
+            self._levels[line.stream] = _parse_level(match.group(1))
+        return self._levels.get(line.stream)
+
+    def _is_match(self, level: Optional[str], text: str) -> bool:
+        if self.min_level is not None and (level is None or LEVELS[level] < self.min_level):
+            return False
+        return not self.pattern or bool(self.pattern.search(text, 0, MAX_MATCH_LENGTH))
+
+    def feed(self, lines: List[LogLine]) -> List[Dict[str, Any]]:
+        """
+        Scan a batch of lines and return the matches and context lines in it. This is slow with
+        complicated patterns, so it's meant to be run in an executor. It stops early when the
+        deadline passes or the maximum number of matches is reached.
+        """
+        output = []
+        for line in lines:
+            if time.monotonic() >= self.deadline:
+                self.timed_out = True
+                break
+            self.scanned_lines += 1
+            self.scanned_bytes += len(line.line) + 1
+            self.last_time = line.time or self.last_time
+            text = ANSI_REGEX.sub("", line.line)
+            level = self._get_level(line, text)
+            matched = self._is_match(level, text)
+            entry = {**line._asdict(), "level": level, "match": matched}
+            if matched:
+                output += self._before
+                self._before.clear()
+                output.append(entry)
+                self._after = self.context
+                self.matches += 1
+                if self.matches >= max_matches:
+                    break
+            elif self._after > 0:
+                output.append(entry)
+                self._after -= 1
+            elif self.context > 0:
+                self._before.append(entry)
+        return output
+
+
+def _format_ndjson(entry: Dict[str, Any]) -> str:
+    return json_codec.dumps(entry) + "\n"
+
+
+def _format_sse(entry: Dict[str, Any]) -> str:
+    return f"event: {'done' if entry.get('done') else 'line'}\ndata: {json_codec.dumps(entry)}\n\n"
+
+
+@routes.get("/docker/logs/{id}/search")
+async def search_logs(request: web.Request) -> web.StreamResponse:
+    """
+    Search the logs of a container and stream back the matching lines with context, as
+    newline-delimited JSON objects or server-sent events. The last object is a summary with
+    ``done`` set to true.
+
+    Only the newest ``tail`` lines are searched (by default ``docker.log_search.default_tail``),
+    oldest first. If the scan is cut short by one of the limits, ``truncated`` in the summary
+    says which one, and the lines newer than ``until`` (the time of the last scanned line)
+    weren't searched.
+    """
+    docker.check_access(request)
+    query = request.query
+    sse = (query.get("format") == "sse"
+           or "text/event-stream" in request.headers.get(hdrs.ACCEPT, ""))
+    flags = re.IGNORECASE if query.get("ignore_case", "").lower() in ("1", "true") else 0
+    pattern = _compile_pattern(query["q"], flags) if query.get("q") else None
+    min_level = None
+    if query.get("level"):
+        try:
+            min_level = LEVELS[_parse_level(query["level"])]
+        except KeyError:
+            raise web.HTTPBadRequest(text=f"Unknown log level {query['level']!r}")
+    try:
+        context = min(int(query.get("context", "0")), max_context)
+    except ValueError:
+        raise web.HTTPBadRequest(text="context must be a number")
+    search = LogSearch(pattern, min_level, max(context, 0), time.monotonic() + max_time)
+
+    try:
+        resp, demuxer = await open_logs(request.match_info["id"],
+                                        tail=query.get("tail", str(default_tail)),
+                                        since=query.get("since"), until=query.get("until"))
+    except ClientError:
+        UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
+        raise web.HTTPBadGateway(text="Failed to contact Docker daemon")
+
+    formatter = _format_sse if sse else _format_ndjson
+    response = web.StreamResponse(headers={
+        hdrs.CONTENT_TYPE: "text/event-stream" if sse else "application/x-ndjson",
+        hdrs.CACHE_CONTROL: "no-cache",
+    })
+    truncated = None
+    loop = asyncio.get_event_loop()
+    try:
+        await response.prepare(request)
+        try:
+            async for lines in read_log_batches(resp, demuxer):
+                output = await loop.run_in_executor(None, search.feed, lines)
+                if output:
+                    await response.write("".join(formatter(entry) for entry in output)
+                                         .encode("utf-8"))
+                if search.matches >= max_matches:
+                    truncated = "matches"
+                elif search.scanned_bytes >= max_bytes:
+                    truncated = "bytes"
+                elif search.timed_out:
+                    truncated = "time"
+                if truncated:
+                    break
+        except ClientError:
+            UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
+            truncated = "error"
+        await response.write(formatter({
+            "done": True,
+            "matches": search.matches,
+            "scanned_lines": search.scanned_lines,
+            "scanned_bytes": search.scanned_bytes,
+            "until": search.last_time,
+            "truncated": truncated,
+        }).encode("utf-8"))
+        await response.write_eof()
+    finally:
+        resp.release()
+    return response
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global default_tail, max_bytes, max_time, max_matches, max_context
+    default_tail = cfg["docker.log_search.default_tail"]
+    max_bytes = cfg["docker.log_search.max_bytes"]
+    max_time = cfg["docker.log_search.max_time"]
+    max_matches = cfg["docker.log_search.max_matches"]
+    max_context = cfg["docker.log_search.max_context"]
@@ -0,0 +1,434 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import (Dict, List, Optional, Tuple, NamedTuple, AsyncIterator, Any, Deque, Set,
+                    Callable)
+from collections import deque
+import calendar
+import asyncio
+import logging
+import struct
+import time
+import re
+
+from aiohttp import web, hdrs, ClientResponse, ClientError
+
+from ..config import Config
+from ..metrics import ACTIVE_LOG_STREAMS, UPSTREAM_ERRORS, LOG_HUB_SUBSCRIBERS, LOG_HUB_DROPPED
+from ..util import json_codec
+from .initable import initializer
+from .docker_containers import find_host
+from . import docker_client as docker
+
+routes = web.RouteTableDef()
+
+LogLine = NamedTuple("LogLine", stream=str, time=Optional[str], line=str)
+
+# Each frame in a multiplexed log stream starts with the stream type (1 byte), three padding
+# bytes and the payload length (4 bytes, big endian).
+# https://docs.docker.com/engine/api/v1.35/#operation/ContainerAttach
+FRAME_HEADER = struct.Struct(">BxxxL")
+STREAM_TYPES = {0: "stdin", 1: "stdout", 2: "stderr"}
+
+RFC3339_REGEX = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,9}))?"
+                           r"(Z|[+-]\d\d:\d\d)$")
+UNIX_TIMESTAMP_REGEX = re.compile(r"^\d+(\.\d{1,9})?$")
+
+hub_buffer_size: int
+hub_queue_size: int
+
+log = logging.getLogger("mau.manager.docker_logs")
+
+
+class LogDemuxer:
+    """
+    Splits Docker log output into lines. Multiplexed frames and lines can be split arbitrarily
+    across chunks, so incomplete ones are buffered until the rest arrives.
+    """
+
+    tty: bool
+    timestamps: bool
+    _buffer: bytearray
+    _partial_lines: Dict[str, bytearray]
+
+    def __init__(self, tty: bool, timestamps: bool = True) -> None:
+        self.tty = tty
+        self.timestamps = timestamps
+        self._buffer = bytearray()
+        self._partial_lines = {}
+
+    def _make_line(self, stream: str, data: bytes) -> LogLine:
+        line = data.decode("utf-8", errors="replace").rstrip("\r")
+        timestamp = None
+        if self.timestamps:
+            timestamp, _, line = line.partition(" ")
+        return LogLine(stream=stream, time=timestamp, line=line)
+
+    def _split_lines(self, stream: str, data: bytes) -> List[LogLine]:
+        partial = self._partial_lines.setdefault(stream, bytearray())
+        partial += data
+        *lines, rest = partial.split(b"\n")
+        self._partial_lines[stream] = rest
+        return [self._make_line(stream, line) for line in lines]
+
+    def feed(self, data: bytes) -> List[LogLine]:
+        if self.tty:
+            # TTY containers have a single raw stream without frame headers
+            return self._split_lines("stdout", data)
+        self._buffer += data
+        lines = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            stream_type, length = FRAME_HEADER.unpack_from(self._buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[offset + FRAME_HEADER.size:end])
+            lines += self._split_lines(STREAM_TYPES.get(stream_type, "stdout"), payload)
+            offset = end
+        del self._buffer[:offset]
+        return lines
+
+    def flush(self) -> List[LogLine]:
+        """Get the last lines of each stream if they didn't end with a newline."""
+        lines = [self._make_line(stream, bytes(partial))
+                 for stream, partial in self._partial_lines.items() if partial]
+        self._partial_lines = {}
+        return lines
+
+
+def to_docker_timestamp(value: str) -> str:
+    """Convert a RFC 3339 or Unix timestamp into the Unix timestamp format Docker wants."""
+    if UNIX_TIMESTAMP_REGEX.match(value):
+        return value
+    match = RFC3339_REGEX.match(value)
+    if not match:
+        raise web.HTTPBadRequest(text=f"Invalid timestamp {value!r}")
+    base, fraction, offset = match.groups()
+    seconds = calendar.timegm(time.strptime(base, "%Y-%m-%dT%H:%M:%S"))
+    if offset != "Z":
+        sign = 1 if offset[0] == "+" else -1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    return f"{seconds}.{fraction}" if fraction else str(seconds)
+
+
+async def open_logs(container_id: str, follow: bool = False, tail: str = "all",
+                    since: Optional[str] = None, until: Optional[str] = None,
+                    stdout: bool = True, stderr: bool = True
+                    ) -> Tuple[ClientResponse, LogDemuxer]:
+    """
+    Request the logs of a container. The caller must close the returned response. Timestamps
+    are always requested, so that clients can use them for pagination.
+    """
+    host = await find_host(container_id)
+    info = await host.inspect_container(container_id)
+    params = {
+        "follow": str(follow).lower(),
+        "stdout": str(stdout).lower(),
+        "stderr": str(stderr).lower(),
+        "timestamps": "true",
+        "tail": tail,
+    }
+    if since:
+        params["since"] = to_docker_timestamp(since)
+    if until:
+        params["until"] = to_docker_timestamp(until)
+    resp = await host.http.get(host.api_url(f"containers/{container_id}/logs"),
+                               params=params, timeout=docker.STREAM_TIMEOUT)
+    if resp.status != 200:
+        try:
+            message = (await resp.json(loads=json_codec.loads))["message"]
+        except (ClientError, ValueError, KeyError, TypeError):
+            message = f"HTTP {resp.status}"
+        finally:
+            resp.release()
+        raise web.HTTPBadGateway(text=f"Failed to get container logs: {message}")
+    return resp, LogDemuxer(tty=info["Config"]["Tty"])
+
+
+async def read_log_batches(resp: ClientResponse, demuxer: LogDemuxer
+                           ) -> AsyncIterator[List[LogLine]]:
+    """Read a log response and yield the complete lines from each received chunk."""
+    async for chunk in resp.content.iter_any():
+        lines = demuxer.feed(chunk)
+        if lines:
+            yield lines
+    lines = demuxer.flush()
+    if lines:
+        yield lines
+
+
+def _timestamp_key(timestamp: str) -> Tuple[int, str]:
+    seconds, _, fraction = to_docker_timestamp(timestamp).partition(".")
+    return int(seconds), fraction.ljust(9, "0")
+
+
+class LogSubscriber:
+    """A client following the logs of a container through a :class:`LogHub`."""
+
+    initial: List[LogLine]
+    _queue: 'asyncio.Queue[Optional[List[LogLine]]]'
+
+    def __init__(self, initial: List[LogLine]) -> None:
+        self.initial = initial
+        self._queue = asyncio.Queue(maxsize=hub_queue_size)
+
+    def push(self, lines: Optional[List[LogLine]]) -> bool:
+        try:
+            self._queue.put_nowait(lines)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def end(self) -> None:
+        # Make room for the end marker if the queue is full
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                self._queue.get_nowait()
+
+    async def batches(self) -> AsyncIterator[List[LogLine]]:
+        if self.initial:
+            yield self.initial
+        while True:
+            lines = await self._queue.get()
+            if lines is None:
+                return
+            yield lines
+
+
+class LogHub:
+    """
+    Shares one Docker log follow stream of a container between all clients following it.
+
+    The last lines are kept in a ring buffer, so that new subscribers can get recent lines
+    without a new request to Docker. Subscribers that don't keep up are disconnected instead of
+    buffering lines for them indefinitely. The upstream stream is closed when the last subscriber
+    leaves.
+    """
+
+    container_id: str
+    buffer: Deque[LogLine]
+    subscribers: Set[LogSubscriber]
+    closed: bool
+    _lock: asyncio.Lock
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, container_id: str) -> None:
+        self.container_id = container_id
+        self.buffer = deque(maxlen=hub_buffer_size)
+        self.subscribers = set()
+        self.closed = False
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _publish(self, lines: List[LogLine]) -> None:
+        self.buffer.extend(lines)
+        for sub in list(self.subscribers):
+            if not sub.push(lines):
+                log.debug(f"Disconnecting slow subscriber from {self.container_id} logs")
+                LOG_HUB_DROPPED.inc()
+                self.unsubscribe(sub)
+
+    async def _load_backlog(self) -> None:
+        resp, demuxer = await open_logs(self.container_id, tail=str(hub_buffer_size))
+        try:
+            async for lines in read_log_batches(resp, demuxer):
+                self.buffer.extend(lines)
+        except BaseException:
+            # Don't return a half-read response to the connection pool
+            resp.close()
+            raise
+        resp.release()
+
+    async def _follow(self) -> None:
+        last_time = self.buffer[-1].time if self.buffer else None
+        try:
+            # Continue from the end of the backlog. Docker's since is inclusive, so lines that
+            # were already in the backlog need to be skipped.
+            resp, demuxer = await open_logs(self.container_id, follow=True, since=last_time,
+                                            tail="all" if last_time else "0")
+            try:
+                last_key = _timestamp_key(last_time) if last_time else None
+                async for lines in read_log_batches(resp, demuxer):
+                    if last_key:
+                        lines = [line for line in lines
+                                 if not line.time or _timestamp_key(line.time) > last_key]
+                        if not lines:
+                            continue
+                        last_key = None
+                    self._publish(lines)
+            finally:
+                # The follow stream never ends cleanly, so the connection can't be reused
+                resp.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning(f"Error following logs of {self.container_id}", exc_info=True)
+        self._close()
+
+    def _close(self) -> None:
+        self.closed = True
+        if hubs.get(self.container_id) is self:
+            del hubs[self.container_id]
+        for sub in self.subscribers:
+            sub.end()
+        self.subscribers.clear()
+        LOG_HUB_SUBSCRIBERS.set(sum(len(hub.subscribers) for hub in hubs.values()))
+
+    async def subscribe(self, tail: Optional[int]) -> Optional[LogSubscriber]:
+        """Subscribe to the hub. Returns None if the hub was closed while waiting for it."""
+        async with self._lock:
+            if self.closed:
+                return None
+            if not self._task:
+                # Load the backlog before starting to follow, so errors (like the container not
+                # existing) are raised to the first subscriber.
+                await self._load_backlog()
+                self._task = asyncio.ensure_future(self._follow())
+        if self.closed:
+            return None
+        initial = list(self.buffer)
+        if tail is not None:
+            initial = initial[-tail:] if tail > 0 else []
+        sub = LogSubscriber(initial)
+        self.subscribers.add(sub)
+        LOG_HUB_SUBSCRIBERS.inc()
+        return sub
+
+    def unsubscribe(self, sub: LogSubscriber) -> None:
+        if sub not in self.subscribers:
+            return
+        self.subscribers.remove(sub)
+        LOG_HUB_SUBSCRIBERS.dec()
+        sub.end()
+        if not self.subscribers and self._task:
+            self._task.cancel()
+            self._close()
+
+
+hubs: Dict[str, LogHub] = {}
+
+
+async def subscribe(container_id: str, tail: Optional[int]) -> Tuple[LogHub, LogSubscriber]:
+    while True:
+        try:
+            hub = hubs[container_id]
+        except KeyError:
+            hub = hubs[container_id] = LogHub(container_id)
+        try:
+            sub = await hub.subscribe(tail)
+        except Exception:
+            if not hub.subscribers and hubs.get(container_id) is hub:
+                del hubs[container_id]
+            raise
+        if sub:
+            return hub, sub
+        # The last subscriber left or the stream ended while we were waiting, so start over
+        # with a new hub.
+
+
+def _format_ndjson(line: LogLine) -> str:
+    return json_codec.dumps(line._asdict()) + "\n"
+
+
+def _format_sse(line: LogLine) -> str:
+    # The timestamp is used as the event ID, so a reconnecting EventSource will send it back in
+    # Last-Event-ID and continue from where it was.
+    return f"id: {line.time}\ndata: {json_codec.dumps(line._asdict())}\n\n"
+
+
+def _get_bool(query: Dict[str, Any], key: str, default: bool) -> bool:
+    value = query.get(key)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true")
+
+
+async def _follow_shared(request: web.Request, response: web.StreamResponse,
+                         formatter: Callable[[LogLine], str], tail: str) -> web.StreamResponse:
+    try:
+        hub, sub = await subscribe(request.match_info["id"],
+                                   tail=None if tail == "all" else int(tail))
+    except ValueError:
+        raise web.HTTPBadRequest(text="tail must be a number or 'all'")
+    except ClientError:
+        UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
+        raise web.HTTPBadGateway(text="Failed to contact Docker daemon")
+    try:
+        await response.prepare(request)
+        async for lines in sub.batches():
+            await response.write("".join(formatter(line) for line in lines).encode("utf-8"))
+        await response.write_eof()
+    finally:
+        hub.unsubscribe(sub)
+    return response
+
+
+@routes.get("/docker/logs/{id}")
+async def get_logs(request: web.Request) -> web.StreamResponse:
+    """
+    Stream the logs of a container as newline-delimited JSON objects or server-sent events,
+    with one line of output in each object/event.
+    """
+    docker.check_access(request)
+    query = request.query
+    sse = (query.get("format") == "sse"
+           or "text/event-stream" in request.headers.get(hdrs.ACCEPT, ""))
+    follow = _get_bool(query, "follow", False)
+    since = query.get("since") or request.headers.get("Last-Event-ID")
+    until = query.get("until")
+    stdout = _get_bool(query, "stdout", True)
+    stderr = _get_bool(query, "stderr", True)
+    tail = query.get("tail", "all")
+    response = web.StreamResponse(headers={
+        hdrs.CONTENT_TYPE: "text/event-stream" if sse else "application/x-ndjson",
+        hdrs.CACHE_CONTROL: "no-cache",
+    })
+    formatter = _format_sse if sse else _format_ndjson
+
+    if follow and hub_buffer_size > 0 and not since and not until and stdout and stderr:
+        return await _follow_shared(request, response, formatter, tail)
+
+    try:
+        resp, demuxer = await open_logs(request.match_info["id"], follow=follow, tail=tail,
+                                        since=since, until=until, stdout=stdout, stderr=stderr)
+    except ClientError:
+        UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
+        raise web.HTTPBadGateway(text="Failed to contact Docker daemon")
+
+    try:
+        with ACTIVE_LOG_STREAMS.track_inprogress():
+            await response.prepare(request)
+            try:
+                async for lines in read_log_batches(resp, demuxer):
+                    await response.write("".join(formatter(line) for line in lines)
+                                         .encode("utf-8"))
+            except ClientError:
+                # Headers were already sent, so just end the response
+                UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
+            await response.write_eof()
+    finally:
+        resp.release()
+    return response
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global hub_buffer_size, hub_queue_size
+    hub_buffer_size = cfg["docker.log_hub.buffer_size"]
+    hub_queue_size = cfg["docker.log_hub.queue_size"]
@@ -13,52 +13,78 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import asyncio
+from typing import Optional
+import re
 
+from multidict import MultiDict
 import aiohttp
 from aiohttp import web
-from yarl import URL
 
 from ..config import Config
+from ..metrics import ACTIVE_LOG_STREAMS, UPSTREAM_ERRORS
 from .initable import initializer
-from .errors import Error
+from .generic_proxy import stream_response, filter_headers, REQUEST_SKIP_HEADERS
+from .docker_logs import routes as log_routes
+from .docker_log_search import routes as log_search_routes
+from .docker_containers import routes as container_routes
+from .docker_jobs import routes as job_routes
+from .docker_stats import routes as stats_routes
+from .docker_containers import find_host
+from . import docker_client as docker
 
-PROXY_CHUNK_SIZE = 32 * 1024
 routes = web.RouteTableDef()
-config: Config
-host: URL
-http: aiohttp.ClientSession
+
+container_path_regex = re.compile(r"^v[0-9.]+/containers/(?!json$|create$|prune$)([^/]+)")
+
+
+async def _get_host(path: str, query: 'MultiDict[str]') -> docker.DockerHost:
+    """
+    Find the Docker host to send a request to. Requests about a specific container go to the
+    host that has it, other requests go to the host in the ``host`` query parameter or the
+    first configured host.
+    """
+    host_name: Optional[str] = query.pop("host", None)
+    if host_name:
+        return docker.get_host(host_name)
+    match = container_path_regex.match(path)
+    if match:
+        return await find_host(match.group(1))
+    return docker.default_host
 
 
 @routes.view("/docker/{path:.+}")
-async def proxy(request: web.Request) -> web.Response:
-    if not config.get_permissions(request["token"].user_id).admin:
-        raise Error.no_access_docker
+async def proxy(request: web.Request) -> web.StreamResponse:
+    docker.check_access(request)
     path = request.match_info["path"]
     query = request.query.copy()
-    headers = request.headers.copy()
-    del headers["Host"]
-    del headers["Authorization"]
+    headers = filter_headers(request.headers, REQUEST_SKIP_HEADERS)
+    headers.pop("Authorization", None)
+    is_log_stream = path.endswith("/logs") and query.get("follow", "") in ("1", "true")
 
+    data = request.content if request.body_exists else None
     try:
-        timeout = aiohttp.ClientTimeout(total=None, connect=5, sock_connect=5, sock_read=None)
-        resp = await http.request(request.method, host / path, headers=headers,
-                                  params=query, data=request.content, timeout=timeout)
+        host = await _get_host(path, query)
+        async with host.http.request(request.method, host.url / path, headers=headers,
+                                     params=query, data=data,
+                                     timeout=docker.STREAM_TIMEOUT) as resp:
+            if is_log_stream:
+                with ACTIVE_LOG_STREAMS.track_inprogress():
+                    return await stream_response(request, resp)
+            return await stream_response(request, resp)
     except aiohttp.ClientError:
+        UPSTREAM_ERRORS.labels(bridge="docker", type="error").inc()
         raise web.HTTPBadGateway(text="Failed to contact Docker daemon")
-    return web.Response(status=resp.status, headers=resp.headers, body=resp.content)
 
 
 @initializer
-def init(cfg: Config, app: web.Application) -> None:
-    global http, host, config
-    config = cfg
-    host = cfg["docker.host"]
-    if host.startswith("unix://"):
-        http = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=host[len("unix://"):]),
-                                     loop=asyncio.get_event_loop())
-        host = "unix://localhost"
-    else:
-        http = aiohttp.ClientSession(loop=asyncio.get_event_loop())
-    host = URL(host)
+def init(_: Config, app: web.Application) -> None:
+    # The specific endpoints must be registered before the catch-all proxy
+    app.add_routes(log_routes)
+    app.add_routes(log_search_routes)
+    app.add_routes(container_routes)
+    app.add_routes(job_routes)
+    app.add_routes(stats_routes)
     app.add_routes(routes)
+    # The other Docker modules stop using the sessions in their own cleanup hooks, which were
+    # registered before this one
+    app.on_cleanup.append(docker.close_hosts)
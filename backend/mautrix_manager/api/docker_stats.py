@@ -0,0 +1,267 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Optional, Set, List, Tuple
+import asyncio
+import logging
+
+from aiohttp import web, hdrs
+
+from ..config import Config
+from ..metrics import STATS_HUB_SUBSCRIBERS
+from ..util import json_codec
+from .initable import initializer
+from .bridge import bridges
+from .docker_containers import find_host
+from .docker_logs import to_docker_timestamp
+from . import docker_client as docker
+
+routes = web.RouteTableDef()
+
+RETRY_DELAY_MAX = 30
+
+# (container name, record)
+StatsEvent = Tuple[str, Dict[str, Any]]
+
+interval: float
+queue_size: int
+
+log = logging.getLogger("mau.manager.docker_stats")
+
+
+def _network_bytes(sample: Dict[str, Any]) -> Tuple[int, int]:
+    networks = (sample.get("networks") or {}).values()
+    return (sum(net.get("rx_bytes", 0) for net in networks),
+            sum(net.get("tx_bytes", 0) for net in networks))
+
+
+def make_record(prev: Dict[str, Any], cur: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compute a compact usage record from two raw Docker stats samples. CPU usage and network
+    rates are averaged over the time between the samples.
+    """
+    elapsed = float(to_docker_timestamp(cur["read"])) - float(to_docker_timestamp(prev["read"]))
+    cpu, prev_cpu = cur["cpu_stats"], prev["cpu_stats"]
+    cpu_delta = cpu["cpu_usage"]["total_usage"] - prev_cpu["cpu_usage"]["total_usage"]
+    system_delta = cpu.get("system_cpu_usage", 0) - prev_cpu.get("system_cpu_usage", 0)
+    online_cpus = cpu.get("online_cpus") or len(cpu["cpu_usage"].get("percpu_usage") or [1])
+    memory = cur.get("memory_stats") or {}
+    rx, tx = _network_bytes(cur)
+    prev_rx, prev_tx = _network_bytes(prev)
+    return {
+        "time": float(to_docker_timestamp(cur["read"])),
+        "cpu_percent": (round(cpu_delta / system_delta * online_cpus * 100, 2)
+                        if system_delta > 0 and cpu_delta >= 0 else 0.0),
+        # Page cache is counted in the usage, but it can be reclaimed, so leave it out like
+        # the docker CLI does.
+        "memory": memory.get("usage", 0) - (memory.get("stats") or {}).get("cache", 0),
+        "memory_limit": memory.get("limit", 0),
+        "net_rx": round(max(rx - prev_rx, 0) / elapsed) if elapsed > 0 else 0,
+        "net_tx": round(max(tx - prev_tx, 0) / elapsed) if elapsed > 0 else 0,
+    }
+
+
+class StatsSubscriber:
+    """A client receiving stats of one or more containers."""
+
+    _queue: 'asyncio.Queue[Optional[StatsEvent]]'
+
+    def __init__(self) -> None:
+        self._queue = asyncio.Queue(maxsize=queue_size)
+
+    def push(self, event: StatsEvent) -> bool:
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def end(self) -> None:
+        # Make room for the end marker if the queue is full
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                self._queue.get_nowait()
+
+    async def get(self) -> Optional[StatsEvent]:
+        return await self._queue.get()
+
+
+class StatsHub:
+    """
+    Shares one Docker stats stream of a container between all clients watching it.
+
+    Docker sends a full stats object every second. The hub turns them into compact records and
+    only publishes one every ``interval`` seconds. The upstream stream is closed when the last
+    subscriber leaves. Instead of usage records, subscribers can also get ``{"error": ...}`` if
+    the stream failed or ``{"state": "stopped"}`` if the container isn't running.
+    """
+
+    container: str
+    last: Optional[Dict[str, Any]]
+    subscribers: Set[StatsSubscriber]
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, container: str) -> None:
+        self.container = container
+        self.last = None
+        self.subscribers = set()
+        self._task = None
+
+    def _publish(self, record: Dict[str, Any]) -> None:
+        self.last = record
+        for sub in list(self.subscribers):
+            if not sub.push((self.container, record)):
+                log.debug(f"Disconnecting slow subscriber from {self.container} stats")
+                unsubscribe(sub)
+                sub.end()
+
+    async def _stream(self) -> None:
+        host = await find_host(self.container)
+        async with host.http.get(host.api_url(f"containers/{self.container}/stats"),
+                                 params={"stream": "true"},
+                                 timeout=docker.STREAM_TIMEOUT) as resp:
+            resp.raise_for_status()
+            prev: Optional[Dict[str, Any]] = None
+            while True:
+                line = await resp.content.readline()
+                if not line:
+                    return
+                if not line.strip():
+                    continue
+                sample = json_codec.loads(line)
+                # Docker keeps sending empty samples for stopped containers, so tell the
+                # subscribers and stop streaming. _run will try again later with a backoff.
+                if "system_cpu_usage" not in sample["cpu_stats"]:
+                    self._publish({"state": "stopped"})
+                    return
+                if prev is None:
+                    prev = sample
+                    continue
+                elapsed = (float(to_docker_timestamp(sample["read"]))
+                           - float(to_docker_timestamp(prev["read"])))
+                # Send the first record right away, then average over the interval
+                if self.last is None or elapsed >= interval:
+                    self._publish(make_record(prev, sample))
+                    prev = sample
+
+    async def _run(self) -> None:
+        delay = 1
+        while True:
+            try:
+                await self._stream()
+            except asyncio.CancelledError:
+                raise
+            except web.HTTPNotFound:
+                self._publish({"error": "Container not found"})
+            except Exception:
+                log.warning(f"Error streaming stats of {self.container}", exc_info=True)
+                self._publish({"error": "Failed to get stats from Docker"})
+            # Back off if the stream didn't work, e.g. because the container isn't running
+            if self.last and "cpu_percent" in self.last:
+                delay = 1
+            else:
+                delay = min(delay * 2, RETRY_DELAY_MAX)
+            self.last = None
+            await asyncio.sleep(delay)
+
+    def subscribe(self, sub: StatsSubscriber) -> None:
+        self.subscribers.add(sub)
+        if self.last:
+            sub.push((self.container, self.last))
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    def unsubscribe(self, sub: StatsSubscriber) -> None:
+        self.subscribers.discard(sub)
+        if not self.subscribers:
+            if self._task:
+                self._task.cancel()
+                self._task = None
+            if hubs.get(self.container) is self:
+                del hubs[self.container]
+
+
+hubs: Dict[str, StatsHub] = {}
+subscriptions: Dict[StatsSubscriber, List[StatsHub]] = {}
+
+
+def subscribe(containers: List[str]) -> StatsSubscriber:
+    sub = StatsSubscriber()
+    subscriptions[sub] = []
+    for container in containers:
+        try:
+            hub = hubs[container]
+        except KeyError:
+            hub = hubs[container] = StatsHub(container)
+        hub.subscribe(sub)
+        subscriptions[sub].append(hub)
+    STATS_HUB_SUBSCRIBERS.set(len(subscriptions))
+    return sub
+
+
+def unsubscribe(sub: StatsSubscriber) -> None:
+    for hub in subscriptions.pop(sub, []):
+        hub.unsubscribe(sub)
+    STATS_HUB_SUBSCRIBERS.set(len(subscriptions))
+
+
+@routes.get("/docker/stats")
+async def get_stats(request: web.Request) -> web.StreamResponse:
+    """
+    Stream resource usage of containers as server-sent events. The containers can be given as
+    a comma-separated list in the ``containers`` query parameter. By default, the containers
+    named after the enabled bridges are included.
+    """
+    docker.check_access(request)
+    containers = [container for container in request.query.get("containers", "").split(",")
+                  if container]
+    if not containers:
+        containers = [name for name, bridge in bridges.items() if bridge.enabled]
+    response = web.StreamResponse(headers={
+        hdrs.CONTENT_TYPE: "text/event-stream",
+        hdrs.CACHE_CONTROL: "no-cache",
+    })
+    await response.prepare(request)
+    sub = subscribe(containers)
+    try:
+        while True:
+            event = await sub.get()
+            if event is None:
+                break
+            container, record = event
+            await response.write(f"event: stats\ndata: "
+                                 f"{json_codec.dumps({'container': container, **record})}\n\n"
+                                 .encode("utf-8"))
+        await response.write_eof()
+    finally:
+        unsubscribe(sub)
+    return response
+
+
+async def _stop(_: web.Application) -> None:
+    for sub in list(subscriptions.keys()):
+        unsubscribe(sub)
+        sub.end()
+
+
+@initializer
+def init(cfg: Config, app: web.Application) -> None:
+    global interval, queue_size
+    interval = cfg["docker.stats.interval"]
+    queue_size = cfg["docker.stats.queue_size"]
+    app.on_cleanup.append(_stop)
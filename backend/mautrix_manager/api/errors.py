@@ -14,10 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Dict
-import json
 
 from aiohttp import web
 
+from ..util import json_codec
+
 
 class _ErrorMeta:
     def __init__(self, *args, **kwargs) -> None:
@@ -26,7 +27,7 @@ class _ErrorMeta:
     @staticmethod
     def _make_error(errcode: str, error: str) -> Dict[str, str]:
         return {
-            "body": json.dumps({
+            "body": json_codec.dumps({
                 "error": error,
                 "errcode": errcode,
             }),
@@ -78,6 +79,17 @@ class _ErrorMeta:
         return web.HTTPUnauthorized(**self._make_error(
             "M_UNAUTHORIZED", "You are not authorized to access the Docker API proxy"))
 
+    @property
+    def invalid_docker_job(self) -> web.HTTPException:
+        return web.HTTPBadRequest(**self._make_error(
+            "M_BAD_JSON", "The job must have an action (start, stop or restart) and a list of "
+                          "containers"))
+
+    @property
+    def invalid_revoke_payload(self) -> web.HTTPException:
+        return web.HTTPBadRequest(**self._make_error(
+            "M_BAD_JSON", "The request must have a list of session IDs or all set to true"))
+
     @property
     def no_impersonation(self) -> web.HTTPException:
         return web.HTTPUnauthorized(**self._make_error(
@@ -88,6 +100,17 @@ class _ErrorMeta:
         return web.HTTPNotImplemented(**self._make_error("NET.MAUNIUM.BRIDGE_DISABLED",
                                                          "This bridge is disabled in the manager"))
 
+    @property
+    def bridge_unavailable(self) -> web.HTTPException:
+        return web.HTTPServiceUnavailable(**self._make_error(
+            "NET.MAUNIUM.BRIDGE_UNAVAILABLE",
+            "The bridge is not responding, try again later"))
+
+    @property
+    def too_many_websockets(self) -> web.HTTPException:
+        return web.HTTPTooManyRequests(**self._make_error(
+            "M_LIMIT_EXCEEDED", "Too many open websockets, close some before opening more"))
+
     @property
     def homeserver_mismatch(self) -> web.HTTPException:
         return web.HTTPUnauthorized(**self._make_error(
@@ -13,19 +13,23 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
 import logging
 
+from mautrix.types import UserID
+
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
+from .bridge import Bridge, bridges
 
 routes = web.RouteTableDef()
 config: Config
-host: URL
-secret: str
+bridge: Bridge
 domain: str
 
 
@@ -33,26 +37,29 @@ log = logging.getLogger("mau.manager.proxy")
 
 
 @routes.view("/mautrix-facebook/{path:.+}")
-async def proxy_all(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_all(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "api")
+    return await proxy(bridge, request, "api")
 
 
 @routes.get("/mautrix-facebook")
-async def check_status(_: web.Request) -> web.Response:
-    if not secret:
+async def check_status(request: web.Request) -> web.Response:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return web.json_response({"domain": domain})
+    return json_response(get_info(request["token"].user_id))
+
+
+def get_info(_: UserID) -> Dict[str, Any]:
+    return {"domain": domain}
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, config, domain
+    global bridge, config, domain
     config = cfg
-    secret = cfg["bridges.mautrix-facebook.secret"]
-    if secret:
-        host = URL(cfg["bridges.mautrix-facebook.url"])
+    bridge = bridges["mautrix-facebook"]
+    if bridge.enabled:
         domain = cfg["bridges.mautrix-facebook.domain"]
         if domain not in ("messenger.com", "facebook.com"):
             log.warning("mautrix-facebook domain should be facebook.com or messenger.com")
@@ -13,28 +13,145 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import FrozenSet, Mapping, Tuple, Hashable
 import asyncio
 import aiohttp
 import logging.config
 
-from aiohttp import web
+from aiohttp import web, hdrs
+from multidict import CIMultiDict, MultiDict, istr
 from yarl import URL
 
+from ..metrics import UPSTREAM_ERRORS, BRIDGE_REJECTED, COALESCED_REQUESTS
+from ..util import SingleFlight
 from .errors import Error
-from .initable import initializer
+from .bridge import Bridge, UNAVAILABLE_STATUSES
+from .response_cache import BufferedResponse
+from . import response_cache
 
-http: aiohttp.ClientSession
+PROXY_CHUNK_SIZE = 32 * 1024
+
+# Headers that only apply to a single connection and must not be forwarded.
+# https://tools.ietf.org/html/rfc7230#section-6.1
+HOP_BY_HOP_HEADERS: FrozenSet[istr] = frozenset({
+    hdrs.CONNECTION, istr("Keep-Alive"), hdrs.PROXY_AUTHENTICATE, hdrs.PROXY_AUTHORIZATION,
+    hdrs.TE, hdrs.TRAILER, hdrs.TRANSFER_ENCODING, hdrs.UPGRADE,
+})
+# Headers that are hop-by-hop in practice: aiohttp recomputes the host for the upstream request.
+REQUEST_SKIP_HEADERS: FrozenSet[istr] = HOP_BY_HOP_HEADERS | {hdrs.HOST}
+
+# Only requests without side effects can be coalesced
+COALESCABLE_METHODS = frozenset({hdrs.METH_GET, hdrs.METH_HEAD})
+# Request headers that can change the response, in addition to the URL
+COALESCE_KEY_HEADERS = (hdrs.ACCEPT, hdrs.ACCEPT_ENCODING, hdrs.ACCEPT_LANGUAGE)
+
+inflight: SingleFlight[Hashable, BufferedResponse] = SingleFlight()
 
 log = logging.getLogger("mau.manager.proxy")
 
 
-async def proxy(url: URL, secret: str, request: web.Request, path_prefix: str) -> web.Response:
-    if not secret:
+def filter_headers(headers: Mapping[str, str], skip: FrozenSet[istr] = HOP_BY_HOP_HEADERS
+                   ) -> CIMultiDict:
+    # Headers listed in the Connection header are hop-by-hop too
+    connection = headers.get(hdrs.CONNECTION, "")
+    if connection:
+        skip = skip | {istr(name.strip()) for name in connection.split(",")}
+    return CIMultiDict((key, value) for key, value in headers.items() if key not in skip)
+
+
+async def stream_response(request: web.Request, resp: aiohttp.ClientResponse
+                          ) -> web.StreamResponse:
+    """
+    Stream an upstream response to the client chunk by chunk. The upstream response is closed
+    (rather than returned to the pool) if the transfer is interrupted in either direction.
+    """
+    response = web.StreamResponse(status=resp.status, reason=resp.reason,
+                                  headers=filter_headers(resp.headers))
+    try:
+        await response.prepare(request)
+        async for chunk in resp.content.iter_chunked(PROXY_CHUNK_SIZE):
+            # write() waits for the transport to drain, so a slow client slows down reading
+            # from upstream instead of making us buffer the whole body.
+            await response.write(chunk)
+        await response.write_eof()
+    except aiohttp.ClientError:
+        # The status line was already sent, so the only way to signal the error is to cut
+        # the client connection short.
+        log.debug(f"Upstream connection failed while streaming response to {request.path}",
+                  exc_info=True)
+        resp.close()
+        if request.transport is not None:
+            request.transport.close()
+    except (ConnectionResetError, asyncio.CancelledError):
+        resp.close()
+        raise
+    return response
+
+
+def check_available(bridge: Bridge) -> None:
+    """Fail fast if the circuit breaker of the bridge is open."""
+    if not bridge.breaker.allow_request():
+        BRIDGE_REJECTED.labels(bridge=bridge.name).inc()
+        err = Error.bridge_unavailable
+        err.headers[hdrs.RETRY_AFTER] = str(max(int(bridge.breaker.retry_after), 1))
+        raise err
+
+
+def _record_status(bridge: Bridge, status: int) -> None:
+    if status in UNAVAILABLE_STATUSES:
+        bridge.breaker.record_failure(f"HTTP {status}")
+    else:
+        bridge.breaker.record_success()
+
+
+async def _fetch_buffered(bridge: Bridge, method: str, url: URL, headers: CIMultiDict,
+                          query: MultiDict) -> BufferedResponse:
+    async with bridge.http.request(method, url, headers=headers, params=query) as resp:
+        body = await resp.read()
+        return BufferedResponse(status=resp.status, reason=resp.reason, body=body,
+                                headers=filter_headers(resp.headers))
+
+
+async def _proxy_buffered(bridge: Bridge, request: web.Request, url: URL, headers: CIMultiDict,
+                          query: MultiDict, cache: bool) -> web.Response:
+    """
+    Proxy a request without streaming, so that identical concurrent requests can share a single
+    upstream request and the response can be cached. The response is buffered in memory and sent
+    to each client separately.
+    """
+    key: Tuple[Hashable, ...] = (bridge.name, request.method, str(url.with_query(query)),
+                                 *(request.headers.get(header) for header in COALESCE_KEY_HEADERS))
+
+    async def fetch() -> BufferedResponse:
+        if bridge.coalesce_requests:
+            resp, shared = await inflight.do(key, lambda: _fetch_buffered(
+                bridge, request.method, url, headers, query))
+            if shared:
+                COALESCED_REQUESTS.labels(bridge=bridge.name).inc()
+        else:
+            resp = await _fetch_buffered(bridge, request.method, url, headers, query)
+        _record_status(bridge, resp.status)
+        return resp
+
+    if cache:
+        resp = await response_cache.get(bridge, request["token"].user_id, key, fetch)
+    else:
+        resp = await fetch()
+    return web.Response(status=resp.status, reason=resp.reason, headers=resp.headers.copy(),
+                        body=resp.body)
+
+
+async def proxy(bridge: Bridge, request: web.Request, path_prefix: str) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
+    check_available(bridge)
     query = request.query.copy()
     query["user_id"] = request["token"].user_id
-    headers = request.headers.copy()
-    headers["Authorization"] = f"Bearer {secret}"
+    headers = filter_headers(request.headers, REQUEST_SKIP_HEADERS)
+    headers[hdrs.AUTHORIZATION] = f"Bearer {bridge.secret}"
+    headers.update(bridge.deadline_header())
+
+    url = bridge.url
 
     if path_prefix:
         url /= path_prefix
@@ -44,22 +161,36 @@ async def proxy(url: URL, secret: str, request: web.Request, path_prefix: str) -
         url /= path
 
     try:
-        resp = await http.request(request.method, url, headers=headers,
-                                  params=query, data=request.content)
-    except aiohttp.ClientError:
+        if request.method in COALESCABLE_METHODS and not request.body_exists:
+            cache = (request.method == hdrs.METH_GET
+                     and response_cache.is_cacheable(bridge, url, query["user_id"]))
+            if cache or bridge.coalesce_requests:
+                return await _proxy_buffered(bridge, request, url, headers, query, cache)
+        else:
+            # Anything that might change the state in the bridge drops the user's cached responses
+            response_cache.invalidate(bridge, query["user_id"])
+        # Only pass the body stream when there is one, so bodyless requests don't get chunked
+        data = request.content if request.body_exists else None
+        async with bridge.http.request(request.method, url, headers=headers, params=query,
+                                       data=data) as resp:
+            _record_status(bridge, resp.status)
+            return await stream_response(request, resp)
+    except asyncio.TimeoutError:
+        log.debug(f"Proxying request to {url} timed out")
+        bridge.breaker.record_failure("timeout")
+        UPSTREAM_ERRORS.labels(bridge=bridge.name, type="timeout").inc()
+        raise web.HTTPGatewayTimeout(text="Bridge did not respond in time")
+    except aiohttp.ClientError as e:
         log.debug("Failed to proxy request", exc_info=True)
+        bridge.breaker.record_failure(type(e).__name__)
+        UPSTREAM_ERRORS.labels(bridge=bridge.name, type="error").inc()
         raise web.HTTPBadGateway(text="Failed to contact bridge")
-    except CancelledError:
+    except ConnectionResetError:
+        log.debug(f"Client disconnected while proxying request to {url}")
+        raise
+    except asyncio.CancelledError:
         log.debug(f"Proxying request to {url} was cancelled before it responded")
         raise
     except Exception:
         log.warning(f"Proxying request to {url} threw unhandled exception", exc_info=True)
         raise
-
-    return web.Response(status=resp.status, headers=resp.headers, body=resp.content)
-
-
-@initializer
-def init(*_) -> None:
-    global http
-    http = aiohttp.ClientSession(loop=asyncio.get_event_loop(), auto_decompress=False)
@@ -13,39 +13,45 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
+
+from mautrix.types import UserID
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
+from .bridge import Bridge, bridges
 
 routes = web.RouteTableDef()
 config: Config
-host: URL
-secret: str
+bridge: Bridge
 
 
 @routes.view("/mautrix-hangouts/{path:.+}")
-async def proxy_all(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_all(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "api")
+    return await proxy(bridge, request, "api")
 
 
 @routes.get("/mautrix-hangouts")
-async def check_status(_: web.Request) -> web.Response:
-    if not secret:
+async def check_status(request: web.Request) -> web.Response:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return web.json_response({})
+    return json_response(get_info(request["token"].user_id))
+
+
+def get_info(_: UserID) -> Dict[str, Any]:
+    return {}
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, config
+    global bridge, config
     config = cfg
-    secret = cfg["bridges.mautrix-hangouts.secret"]
-    if secret:
-        host = URL(cfg["bridges.mautrix-hangouts.url"])
+    bridge = bridges["mautrix-hangouts"]
     app.add_routes(routes)
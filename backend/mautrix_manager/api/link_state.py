@@ -0,0 +1,210 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Optional, Tuple, Dict
+from abc import ABC, abstractmethod
+import asyncio
+import logging
+
+from aiohttp import web
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..database import LinkState
+from ..util import TTLCache
+from .initable import initializer
+from .static_util import make_token
+from .. import workers
+
+
+class LinkStateStore(ABC):
+    """
+    Storage for the short-lived state of account linking flows, like which user a link token
+    belongs to. Every entry expires after ``ttl`` seconds unless it's refreshed.
+    """
+
+    ttl: float
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    async def set(self, namespace: str, key: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    async def get_or_set(self, namespace: str, key: str, value: Any) -> Any:
+        """Get the value of a key and refresh its expiry, or set it if it doesn't exist."""
+        pass
+
+    @abstractmethod
+    async def pop(self, namespace: str, key: str) -> Optional[Any]:
+        pass
+
+    def link(self, namespace: str, key: str, other_key: str) -> None:
+        """
+        Mark two keys as belonging together, so that if a size limit drops one of them, the
+        other one is dropped too. Only needed for stores that drop entries before they expire.
+        """
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class MemoryLinkStateStore(LinkStateStore):
+    """Stores link state in a size-bounded LRU cache. Only works with a single manager process."""
+
+    cache: TTLCache[Tuple[str, str], Any]
+    _links: Dict[Tuple[str, str], Tuple[str, str]]
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        super().__init__(ttl)
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, on_remove=self._removed)
+        self._links = {}
+
+    def _removed(self, key: Tuple[str, str]) -> None:
+        other_key = self._links.pop(key, None)
+        # The other key might have been linked to something else since
+        if other_key and self._links.get(other_key) == key:
+            del self._links[other_key]
+            self.cache.pop(other_key)
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return self.cache.get((namespace, key))
+
+    async def set(self, namespace: str, key: str, value: Any) -> None:
+        self.cache.set((namespace, key), value)
+
+    async def get_or_set(self, namespace: str, key: str, value: Any) -> Any:
+        existing = self.cache.get((namespace, key))
+        if existing is not None:
+            value = existing
+        self.cache.set((namespace, key), value)
+        return value
+
+    async def pop(self, namespace: str, key: str) -> Optional[Any]:
+        self._links.pop((namespace, key), None)
+        return self.cache.pop((namespace, key))
+
+    def link(self, namespace: str, key: str, other_key: str) -> None:
+        self._links[(namespace, key)] = (namespace, other_key)
+        self._links[(namespace, other_key)] = (namespace, key)
+
+
+class PostgresLinkStateStore(LinkStateStore):
+    """Stores link state in the database, so it can be shared between manager processes."""
+
+    sweep_interval: float
+    sweep_batch_size: int
+    _sweep_task: Optional[asyncio.Future]
+
+    def __init__(self, ttl: float, sweep_interval: float, sweep_batch_size: int) -> None:
+        super().__init__(ttl)
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        self._sweep_task = None
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return await LinkState.get(namespace, key)
+
+    async def set(self, namespace: str, key: str, value: Any) -> None:
+        await LinkState.set(namespace, key, value, ttl=self.ttl)
+
+    async def get_or_set(self, namespace: str, key: str, value: Any) -> Any:
+        return await LinkState.get_or_set(namespace, key, value, ttl=self.ttl)
+
+    async def pop(self, namespace: str, key: str) -> Optional[Any]:
+        return await LinkState.pop(namespace, key)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                deleted = await LinkState.delete_expired(self.sweep_batch_size)
+                if deleted:
+                    log.debug(f"Deleted {deleted} expired link state entries")
+            except Exception:
+                log.exception("Error deleting expired link state entries")
+
+    async def start(self) -> None:
+        if self.sweep_interval > 0:
+            self._sweep_task = asyncio.ensure_future(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+
+
+store: LinkStateStore
+
+log = logging.getLogger("mau.manager.link_state")
+
+
+async def get_user_token(namespace: str, user_id: UserID) -> str:
+    """Get the link token of a user, creating it if necessary. Also refreshes the expiry."""
+    user_key = f"user:{user_id}"
+    token = await store.get_or_set(namespace, user_key, make_token())
+    token_key = f"token:{token}"
+    await store.set(namespace, token_key, user_id)
+    # A user entry without the token entry would hand out tokens that don't work
+    store.link(namespace, user_key, token_key)
+    return token
+
+
+async def get_token_user(namespace: str, token: str) -> Optional[UserID]:
+    return await store.get(namespace, f"token:{token}")
+
+
+async def _start(_: web.Application) -> None:
+    await store.start()
+
+
+async def _stop(_: web.Application) -> None:
+    await store.stop()
+
+
+@initializer
+def init(cfg: Config, app: web.Application) -> None:
+    global store
+    backend = cfg["server.link_state.backend"]
+    if backend == "memory" and workers.is_worker():
+        log.warning("The memory link state backend doesn't work with multiple workers, "
+                    "using postgres instead")
+        backend = "postgres"
+    if backend == "postgres":
+        store = PostgresLinkStateStore(ttl=cfg["server.link_state.ttl"],
+                                       sweep_interval=cfg["server.link_state.sweep_interval"],
+                                       sweep_batch_size=cfg["server.link_state.sweep_batch_size"])
+    elif backend == "memory":
+        store = MemoryLinkStateStore(ttl=cfg["server.link_state.ttl"],
+                                     max_size=cfg["server.link_state.max_size"])
+    else:
+        raise ValueError(f"Unknown link state backend {backend!r}")
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
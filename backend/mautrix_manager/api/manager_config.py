@@ -18,7 +18,9 @@ from typing import Dict
 from aiohttp import web
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .initable import initializer
+from .bridge import bridges, get_health
 
 routes = web.RouteTableDef()
 features: Dict[str, bool]
@@ -26,7 +28,7 @@ features: Dict[str, bool]
 
 @routes.get("/manager/config")
 async def check_status(_: web.Request) -> web.Response:
-    return web.json_response(features)
+    return json_response({**features, "bridge_health": get_health()})
 
 
 @initializer
@@ -34,7 +36,6 @@ def init(cfg: Config, app: web.Application) -> None:
     global features
     features = {
         **cfg["features"],
-        "bridges": {bridge: bool(data["url"] and data["secret"])
-                    for bridge, data in cfg["bridges"].items()}
+        "bridges": {name: bridge.enabled for name, bridge in bridges.items()}
     }
     app.add_routes(routes)
@@ -13,44 +13,40 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, NamedTuple
-from collections import defaultdict
-import asyncio
-
-from aiohttp import web, ClientError, ClientSession
+from aiohttp import web, ClientError, ContentTypeError
 from yarl import URL
 
 from mautrix.client import ClientAPI
-from mautrix.types import UserID
 
 from ..config import Config
+from ..util import json_codec
+from ..util.json_codec import JSONDecodeError
 from .initable import initializer
+from .bridge import Bridge, bridges
 from .static_util import reply, make_token, handle_error_response
+from .link_state import get_token_user
+from . import link_state, response_cache
 
-host: URL
-secret: str
+bridge: Bridge
 custom_redirect_uri_format: str
-http: ClientSession
 routes = web.RouteTableDef()
 
-link_start_tokens: Dict[UserID, str] = defaultdict(make_token)
-reverse_link_start_tokens: Dict[str, UserID] = {}
-
-LinkTokenInfo = NamedTuple("LinkTokenInfo", oauth_secret=str, oauth_token=str, user_id=UserID)
-link_tokens: Dict[str, LinkTokenInfo] = {}
+# Namespaces in the link state store. Link start tokens identify the user when starting the
+# OAuth flow, and link tokens map the OAuth callback to the secrets from the start.
+LINK_START_TOKENS = "mx-puppet-twitter-start"
+LINK_TOKENS = "mx-puppet-twitter"
 
 page_title = "Twitter linking"
 
 
 @routes.get("/twitter-link/start")
 async def start_link_static(request: web.Request) -> web.Response:
-    if not secret:
+    if not bridge.enabled:
         return reply(501, page_title, "The Twitter bridge is disabled in the manager")
 
-    try:
-        token = request.query["manager_token"]
-        user_id = reverse_link_start_tokens[token]
-    except (KeyError, IndexError):
+    token = request.query.get("manager_token")
+    user_id = await get_token_user(LINK_START_TOKENS, token) if token else None
+    if not user_id:
         return reply(403, page_title, "Invalid manager token",
                      "Try restarting the linking process from the manager.")
 
@@ -61,63 +57,79 @@ async def start_link_static(request: web.Request) -> web.Response:
     redirect_uri = str(URL(redirect_uri).update_query({"link_token": link_token}))
 
     try:
-        resp = await http.post(host / "oauth" / "request",
-                               params={"user_id": user_id},
-                               headers={"Authorization": f"Bearer {secret}"},
-                               json={"oauth_callback": redirect_uri})
+        async with bridge.http.post(bridge.url / "oauth" / "request",
+                                    params={"user_id": user_id},
+                                    headers=bridge.request_headers(),
+                                    json={"oauth_callback": redirect_uri}) as resp:
+            if not 200 <= resp.status < 300:
+                return await handle_error_response(page_title, "Failed to link Twitter account",
+                                                   resp)
+            try:
+                resp_data = await resp.json(loads=json_codec.loads)
+                oauth_info = {
+                    "oauth_secret": resp_data["oauth_secret"],
+                    "oauth_token": resp_data["oauth_token"],
+                    "user_id": user_id,
+                }
+                url = resp_data["url"]
+            except (ContentTypeError, JSONDecodeError, KeyError, TypeError):
+                return reply(502, page_title, "Failed to link Twitter account",
+                             "The bridge returned an invalid response. Check the bridge logs.")
+            await link_state.store.set(LINK_TOKENS, link_token, oauth_info)
+            return web.Response(status=302, headers={"Location": url})
     except ClientError:
         return reply(502, page_title, "Failed to contact bridge",
                      "Make sure the bridge is running and reachable.")
-    resp_data = await resp.json()
-    link_tokens[link_token] = LinkTokenInfo(oauth_secret=resp_data["oauth_secret"],
-                                            oauth_token=resp_data["oauth_token"],
-                                            user_id=user_id)
-    if 200 <= resp.status < 300:
-        return web.Response(status=302, headers={"Location": resp_data["url"]})
-    else:
-        return await handle_error_response(page_title, "Failed to link Twitter account", resp)
 
 
 @routes.get("/twitter-link/callback")
 async def link_static(request: web.Request) -> web.Response:
-    if not secret:
+    if not bridge.enabled:
         return reply(501, page_title, "The Twitter bridge is disabled in the manager")
 
-    try:
-        token = request.query["link_token"]
-        link_info = link_tokens[token]
-    except (KeyError, IndexError):
+    oauth_token = request.query.get("oauth_token")
+    oauth_verifier = request.query.get("oauth_verifier")
+    if not oauth_token or not oauth_verifier:
+        # Check the request before using up the link token, so that it can still be retried
+        return reply(400, page_title, "Missing OAuth token or verifier",
+                     "Try restarting the linking process from the manager.")
+
+    token = request.query.get("link_token")
+    # Link tokens are single-use
+    link_info = await link_state.store.pop(LINK_TOKENS, token) if token else None
+    if not link_info:
         return reply(403, page_title, "Invalid link token",
                      "Try restarting the linking process from the manager.")
 
-    if link_info.oauth_token != request.query["oauth_token"]:
+    if link_info["oauth_token"] != oauth_token:
         return reply(400, page_title, "Mismatching OAuth token",
                      "Try restarting the linking process from the manager.")
 
     try:
-        resp = await http.post(host / "oauth" / "link",
-                               params={"user_id": link_info.user_id},
-                               headers={"Authorization": f"Bearer {secret}"},
-                               json={"oauth_token": request.query["oauth_token"],
-                                     "oauth_verifier": request.query["oauth_verifier"],
-                                     "oauth_secret": link_info.oauth_secret})
+        async with bridge.http.post(bridge.url / "oauth" / "link",
+                                    params={"user_id": link_info["user_id"]},
+                                    headers=bridge.request_headers(),
+                                    json={"oauth_token": oauth_token,
+                                          "oauth_verifier": oauth_verifier,
+                                          "oauth_secret": link_info["oauth_secret"]}) as resp:
+            # Linking changes the status that the bridge reports for the user
+            response_cache.invalidate(bridge, link_info["user_id"])
+            if 200 <= resp.status < 300:
+                return reply(resp.status, page_title, "Successfully linked Twitter account",
+                             "Your Twitter account is now bridged to Matrix. "
+                             "You can close this page and return to the app.")
+            else:
+                return await handle_error_response(page_title, "Failed to link Twitter account",
+                                                   resp)
     except ClientError:
         return reply(502, page_title, "Failed to contact bridge",
                      "Make sure the bridge is running and reachable.")
-    if 200 <= resp.status < 300:
-        return reply(resp.status, page_title, "Successfully linked Twitter account",
-                     "Your Twitter account is now bridged to Matrix. "
-                     "You can close this page and return to the app.")
-    else:
-        return await handle_error_response(page_title, "Failed to link Twitter account", resp)
 
 
 @initializer(ui=True)
 def init(cfg: Config, app: web.Application) -> None:
-    global http, host, secret, custom_redirect_uri_format
-    http = ClientSession(loop=asyncio.get_event_loop())
-    secret = cfg["bridges.mx-puppet-twitter.secret"]
-    if secret:
-        host = URL(cfg["bridges.mx-puppet-twitter.url"])
+    global bridge, custom_redirect_uri_format
+    bridge = bridges["mx-puppet-twitter"]
+    if bridge.enabled:
         custom_redirect_uri_format = cfg["bridges.mx-puppet-twitter.custom_oauth_redirect"]
     app.add_routes(routes)
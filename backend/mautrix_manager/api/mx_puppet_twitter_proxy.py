@@ -13,55 +13,60 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
 
 from mautrix.client import ClientAPI
+from mautrix.types import UserID
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
-from .mx_puppet_twitter_link import link_start_tokens, reverse_link_start_tokens
+from .bridge import Bridge, bridges
+from .mx_puppet_twitter_link import LINK_START_TOKENS
+from .link_state import get_user_token
 
 routes = web.RouteTableDef()
 config: Config
-host: URL
-secret: str
+bridge: Bridge
 custom_redirect_uri_format: str
 static_linking_page: bool
 
 
 @routes.view("/mx-puppet-twitter/{path:.+}")
-async def proxy_all(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_all(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "")
+    return await proxy(bridge, request, "")
 
 
 @routes.get("/mx-puppet-twitter")
 async def check_status(request: web.Request) -> web.Response:
-    if not secret:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    user_id = request["token"].user_id
+    return json_response(await get_info(request["token"].user_id))
+
+
+async def get_info(user_id: UserID) -> Dict[str, Any]:
     localpart, homeserver = ClientAPI.parse_user_id(user_id)
-    reverse_link_start_tokens[link_start_tokens[user_id]] = user_id
-    return web.json_response({
+    return {
         "custom_redirect_uri": (custom_redirect_uri_format.format(localpart=localpart,
                                                                   homeserver=homeserver)
                                 if custom_redirect_uri_format else None),
         "static_linking_page": static_linking_page,
-        "link_start_token": link_start_tokens[user_id],
-    })
+        "link_start_token": await get_user_token(LINK_START_TOKENS, user_id),
+    }
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, config, custom_redirect_uri_format, static_linking_page
+    global bridge, config, custom_redirect_uri_format, static_linking_page
     config = cfg
-    secret = cfg["bridges.mx-puppet-twitter.secret"]
-    if secret:
-        host = URL(cfg["bridges.mx-puppet-twitter.url"])
+    bridge = bridges["mx-puppet-twitter"]
+    if bridge.enabled:
         custom_redirect_uri_format = cfg["bridges.mx-puppet-twitter.custom_oauth_redirect"]
         static_linking_page = cfg["bridges.mx-puppet-twitter.static_linking_page"]
     app.add_routes(routes)
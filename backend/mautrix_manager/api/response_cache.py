@@ -0,0 +1,160 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Tuple, Hashable, NamedTuple, Callable, Awaitable, Optional
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..metrics import RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_HIT_RATIO
+from ..util import TTLCache
+from .. import workers
+from .initable import initializer
+from .bridge import Bridge
+
+BufferedResponse = NamedTuple("BufferedResponse", status=int, reason=str, headers=CIMultiDict,
+                              body=bytes)
+# fresh_until, response
+CacheEntry = Tuple[float, BufferedResponse]
+Fetcher = Callable[[], Awaitable[BufferedResponse]]
+
+# How long to remember invalidations. This should be longer than requests to bridges can take.
+INVALIDATION_TTL = 300
+
+# Cached responses by (bridge, user ID). Each value contains all the cached responses of that
+# user to that bridge, so that they can be dropped at once when the user changes something.
+cache: TTLCache[Tuple[str, UserID], Dict[Hashable, CacheEntry]] = TTLCache(max_size=0, ttl=0)
+# When each (bridge, user ID) pair was last invalidated, to avoid caching responses to
+# requests that were sent before the invalidation.
+invalidated: TTLCache[Tuple[str, UserID], float] = TTLCache(max_size=0, ttl=0)
+ttl: float
+stale_ttl: float
+paths: Dict[str, List[str]]
+hits: int = 0
+misses: int = 0
+# Background revalidations in progress, so that a burst of stale hits only makes one request
+_revalidating: Dict[Tuple[str, UserID, Hashable], asyncio.Future] = {}
+
+log = logging.getLogger("mau.manager.response_cache")
+
+
+def is_cacheable(bridge: Bridge, url: URL, user_id: UserID) -> bool:
+    """Check if the response to a GET request to the given bridge URL can be cached."""
+    if cache.max_size <= 0 or bridge.name not in paths:
+        return False
+    path = url.path[len(bridge.url.path):].strip("/")
+    return any(path == pattern.format(user_id=user_id) for pattern in paths[bridge.name])
+
+
+def invalidate(bridge: Bridge, user_id: UserID) -> None:
+    """Drop the cached responses of a user to a bridge after the user changed something."""
+    if cache.max_size <= 0:
+        return
+    cache.pop((bridge.name, user_id))
+    invalidated.set((bridge.name, user_id), time.monotonic())
+
+
+def _store(bridge: Bridge, user_id: UserID, key: Hashable, started: float,
+           resp: BufferedResponse) -> None:
+    if resp.status != 200:
+        return
+    last_invalidated = invalidated.get((bridge.name, user_id))
+    if last_invalidated is not None and last_invalidated >= started:
+        return
+    entries = cache.get((bridge.name, user_id))
+    if entries is None:
+        entries = {}
+    entries[key] = (time.monotonic() + ttl, resp)
+    # Re-set the whole group to extend its expiry and mark it as recently used
+    cache.set((bridge.name, user_id), entries)
+
+
+async def _fetch(bridge: Bridge, user_id: UserID, key: Hashable, fetch: Fetcher
+                 ) -> BufferedResponse:
+    started = time.monotonic()
+    resp = await fetch()
+    _store(bridge, user_id, key, started, resp)
+    return resp
+
+
+async def _revalidate(bridge: Bridge, user_id: UserID, key: Hashable, fetch: Fetcher) -> None:
+    try:
+        await _fetch(bridge, user_id, key, fetch)
+    except Exception:
+        log.debug(f"Failed to revalidate cached response from {bridge.name}", exc_info=True)
+
+
+def _lookup(bridge: Bridge, user_id: UserID, key: Hashable) -> Optional[CacheEntry]:
+    entries = cache.get((bridge.name, user_id))
+    if not entries:
+        return None
+    entry = entries.get(key)
+    if entry and entry[0] + stale_ttl < time.monotonic():
+        del entries[key]
+        return None
+    return entry
+
+
+async def get(bridge: Bridge, user_id: UserID, key: Hashable, fetch: Fetcher
+              ) -> BufferedResponse:
+    """
+    Get a response from the cache or fetch it. Stale responses are returned immediately and
+    refreshed in the background.
+    """
+    global hits, misses
+    entry = _lookup(bridge, user_id, key)
+    if entry is None:
+        misses += 1
+        RESPONSE_CACHE_LOOKUPS.labels(bridge=bridge.name, result="miss").inc()
+        return await _fetch(bridge, user_id, key, fetch)
+    hits += 1
+    fresh_until, resp = entry
+    if fresh_until >= time.monotonic():
+        RESPONSE_CACHE_LOOKUPS.labels(bridge=bridge.name, result="hit").inc()
+    else:
+        RESPONSE_CACHE_LOOKUPS.labels(bridge=bridge.name, result="stale").inc()
+        revalidate_key = (bridge.name, user_id, key)
+        if revalidate_key not in _revalidating:
+            task = asyncio.ensure_future(_revalidate(bridge, user_id, key, fetch))
+            _revalidating[revalidate_key] = task
+            task.add_done_callback(lambda _: _revalidating.pop(revalidate_key, None))
+    return resp
+
+
+def hit_ratio() -> float:
+    return hits / (hits + misses) if hits or misses else 0.0
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global cache, invalidated, ttl, stale_ttl, paths
+    ttl = cfg["server.response_cache.ttl"]
+    stale_ttl = cfg["server.response_cache.stale_ttl"]
+    paths = cfg["server.response_cache.paths"] or {}
+    max_size = cfg["server.response_cache.size"]
+    if max_size > 0 and workers.is_worker():
+        # Invalidations would only reach the worker that handled the request that caused them
+        log.warning("The response cache doesn't work with multiple workers, disabling it")
+        max_size = 0
+    cache = TTLCache(max_size=max_size, ttl=ttl + stale_ttl)
+    invalidated = TTLCache(max_size=max_size, ttl=INVALIDATION_TTL)
+    RESPONSE_CACHE_HIT_RATIO.set_function(hit_ratio)
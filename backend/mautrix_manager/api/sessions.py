@@ -0,0 +1,183 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any, Optional
+import asyncio
+import logging
+
+from aiohttp import web
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..database import Token
+from ..database.token import REVOCATION_CHANNEL
+from ..util.json_codec import json_response, read_json, JSONDecodeError
+from .. import workers
+from .initable import initializer
+from .errors import Error
+
+routes = web.RouteTableDef()
+
+config: Config
+flush_interval: float
+sweep_interval: float
+sweep_batch_size: int
+_task: Optional[asyncio.Future] = None
+_listen_task: Optional[asyncio.Future] = None
+
+LISTENER_CHECK_INTERVAL = 30
+
+log = logging.getLogger("mau.manager.sessions")
+
+
+def _get_user_id(request: web.Request, user_id: Optional[str]) -> UserID:
+    own_user_id = request["token"].user_id
+    if not user_id or user_id == own_user_id:
+        return own_user_id
+    elif not config.get_permissions(own_user_id).admin:
+        raise Error.no_impersonation
+    return UserID(user_id)
+
+
+def _serialize(token: Token, current: Token) -> Dict[str, Any]:
+    return {
+        "id": token.id,
+        "created_at": token.created_at,
+        "last_used_at": token.last_used_at,
+        "expires_at": token.expires_at,
+        "current": token.secret == current.secret,
+    }
+
+
+@routes.get("/sessions")
+async def list_sessions(request: web.Request) -> web.Response:
+    """List the sessions of the current user, or any user for admins."""
+    user_id = _get_user_id(request, request.query.get("user_id"))
+    tokens = await Token.get_all_by_user(user_id)
+    return json_response({
+        "user_id": user_id,
+        "sessions": [_serialize(token, request["token"]) for token in tokens],
+    })
+
+
+@routes.post("/sessions/revoke")
+async def revoke_sessions(request: web.Request) -> web.Response:
+    """
+    Revoke sessions by ID, or all sessions with ``"all": true``. The current session is only
+    revoked if ``include_current`` is also set.
+    """
+    try:
+        data = await read_json(request)
+    except JSONDecodeError:
+        raise Error.request_not_json
+    if not isinstance(data, dict):
+        raise Error.invalid_revoke_payload
+    ids = data.get("ids") or []
+    revoke_all = data.get("all") is True
+    if not isinstance(ids, list) or not (ids or revoke_all):
+        raise Error.invalid_revoke_payload
+    user_id = _get_user_id(request, data.get("user_id"))
+    current = request["token"]
+    secrets = [token.secret for token in await Token.get_all_by_user(user_id)
+               if (revoke_all or token.id in ids)
+               and (token.secret != current.secret or data.get("include_current") is True)]
+    revoked = await Token.delete_many(secrets) if secrets else 0
+    log.info(f"{current.user_id} revoked {revoked} sessions of {user_id}")
+    return json_response({"revoked": revoked})
+
+
+async def _maintenance_loop() -> None:
+    since_sweep = sweep_interval
+    while True:
+        await asyncio.sleep(flush_interval)
+        since_sweep += flush_interval
+        try:
+            await Token.flush_touches()
+            if sweep_interval > 0 and since_sweep >= sweep_interval:
+                since_sweep = 0
+                deleted = await Token.delete_expired(sweep_batch_size)
+                if deleted:
+                    log.info(f"Deleted {deleted} expired access tokens")
+        except Exception:
+            log.exception("Error in access token maintenance")
+
+
+def _on_revoked(_conn: Any, _pid: int, _channel: str, secret: str) -> None:
+    Token.forget(secret)
+
+
+async def _listen_revocations() -> None:
+    """Drop tokens revoked by other workers from the cache of this worker."""
+    while True:
+        try:
+            async with Token.db.acquire() as conn:
+                await conn.add_listener(REVOCATION_CHANNEL, _on_revoked)
+                # Notifications may have been missed while not listening
+                Token.cache.clear()
+                try:
+                    while True:
+                        await asyncio.sleep(LISTENER_CHECK_INTERVAL)
+                        # Make sure the connection is still alive
+                        await conn.execute("SELECT 1")
+                finally:
+                    await conn.remove_listener(REVOCATION_CHANNEL, _on_revoked)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning("Error listening for token revocations, reconnecting", exc_info=True)
+            await asyncio.sleep(LISTENER_CHECK_INTERVAL)
+
+
+async def _start(_: web.Application) -> None:
+    global _task, _listen_task
+    updated = await Token.apply_lifetime()
+    if updated:
+        log.info(f"Updated the expiry of {updated} access tokens to match the session lifetime")
+    _task = asyncio.ensure_future(_maintenance_loop())
+    if workers.is_worker():
+        _listen_task = asyncio.ensure_future(_listen_revocations())
+
+
+async def _stop(_: web.Application) -> None:
+    global _task, _listen_task
+    for task in (_task, _listen_task):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _task = _listen_task = None
+    # Save the last use times that haven't been written yet
+    try:
+        await Token.flush_touches()
+    except Exception:
+        log.exception("Failed to save access token use times")
+
+
+@initializer
+def init(cfg: Config, app: web.Application) -> None:
+    global config, flush_interval, sweep_interval, sweep_batch_size
+    config = cfg
+    flush_interval = cfg["server.sessions.flush_interval"]
+    sweep_interval = cfg["server.sessions.sweep_interval"]
+    sweep_batch_size = cfg["server.sessions.sweep_batch_size"]
+    Token.init_expiry(lifetime=cfg["server.sessions.lifetime"],
+                      touch_interval=cfg["server.sessions.touch_interval"])
+    Token.broadcast_revocations = workers.is_worker()
+    app.add_routes(routes)
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
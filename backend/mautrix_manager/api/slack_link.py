@@ -13,70 +13,68 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict
-from collections import defaultdict
-import asyncio
-
-from aiohttp import web, ClientError, ClientSession
-from yarl import URL
+from aiohttp import web, ClientError
 
 from mautrix.client import ClientAPI
-from mautrix.types import UserID
 
 from ..config import Config
 from .initable import initializer
-from .static_util import reply, make_token, handle_error_response
+from .bridge import Bridge, bridges
+from .static_util import reply, handle_error_response
+from .link_state import get_token_user
+from . import response_cache
 
-host: URL
-secret: str
+bridge: Bridge
 client_id: str
 custom_redirect_uri_format: str
-http: ClientSession
 routes = web.RouteTableDef()
-link_tokens: Dict[UserID, str] = defaultdict(make_token)
-reverse_link_tokens: Dict[str, UserID] = {}
+
+# Namespace of the user link tokens in the link state store
+LINK_TOKENS = "mx-puppet-slack"
 
 page_title = "Slack linking"
 
 
 @routes.get("/slack-link")
 async def link_static(request: web.Request) -> web.Response:
-    if not secret:
+    if not bridge.enabled:
         return reply(501, page_title, "The Slack bridge is disabled in the manager")
 
     try:
         token = request.query["state"][len("slack-link-"):]
-        user_id = reverse_link_tokens[token]
-    except (KeyError, IndexError):
+    except KeyError:
+        token = None
+    user_id = await get_token_user(LINK_TOKENS, token) if token else None
+    if not user_id:
         return reply(403, page_title, "Invalid manager token",
                      "Try restarting the linking process from the manager.")
 
     localpart, homeserver = ClientAPI.parse_user_id(user_id)
     redirect_uri = custom_redirect_uri_format.format(localpart=localpart, homeserver=homeserver)
     try:
-        resp = await http.post(host / "oauth" / "link",
-                               params={"user_id": user_id},
-                               headers={"Authorization": f"Bearer {secret}"},
-                               json={"code": request.query["code"],
-                                     "redirect_uri": redirect_uri})
+        async with bridge.http.post(bridge.url / "oauth" / "link", params={"user_id": user_id},
+                                    headers=bridge.request_headers(),
+                                    json={"code": request.query["code"],
+                                          "redirect_uri": redirect_uri}) as resp:
+            # Linking changes the status that the bridge reports for the user
+            response_cache.invalidate(bridge, user_id)
+            if 200 <= resp.status < 300:
+                return reply(resp.status, page_title, "Successfully linked Slack account",
+                             "Your Slack account is now bridged to Matrix. "
+                             "You can close this page and return to the app.")
+            else:
+                return await handle_error_response(page_title, "Failed to link Slack account",
+                                                   resp)
     except ClientError:
         return reply(502, page_title, "Failed to contact bridge",
                      "Make sure the bridge is running and reachable.")
-    if 200 <= resp.status < 300:
-        return reply(resp.status, page_title, "Successfully linked Slack account",
-                     "Your Slack account is now bridged to Matrix. "
-                     "You can close this page and return to the app.")
-    else:
-        return await handle_error_response(page_title, "Failed to link Slack account", resp)
 
 
 @initializer(ui=True)
 def init(cfg: Config, app: web.Application) -> None:
-    global http, host, secret, client_id, custom_redirect_uri_format
-    http = ClientSession(loop=asyncio.get_event_loop())
-    secret = cfg["bridges.mx-puppet-slack.secret"]
-    if secret:
-        host = URL(cfg["bridges.mx-puppet-slack.url"])
+    global bridge, client_id, custom_redirect_uri_format
+    bridge = bridges["mx-puppet-slack"]
+    if bridge.enabled:
         client_id = cfg["bridges.mx-puppet-slack.client_id"]
         custom_redirect_uri_format = cfg["bridges.mx-puppet-slack.custom_oauth_redirect"]
     app.add_routes(routes)
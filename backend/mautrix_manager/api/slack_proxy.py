@@ -13,53 +13,58 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
 
 from mautrix.client import ClientAPI
+from mautrix.types import UserID
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
-from .slack_link import link_tokens, reverse_link_tokens
+from .bridge import Bridge, bridges
+from .slack_link import LINK_TOKENS
+from .link_state import get_user_token
 
 routes = web.RouteTableDef()
-host: URL
-secret: str
+bridge: Bridge
 client_id: str
 custom_redirect_uri_format: str
 
 
 @routes.view("/mx-puppet-slack/{path:.+}")
-async def proxy_all(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_all(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "")
+    return await proxy(bridge, request, "")
 
 
 @routes.get("/mx-puppet-slack")
 async def check_status(request: web.Request) -> web.Response:
-    if not secret:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    user_id = request["token"].user_id
+    return json_response(await get_info(request["token"].user_id))
+
+
+async def get_info(user_id: UserID) -> Dict[str, Any]:
     localpart, homeserver = ClientAPI.parse_user_id(user_id)
-    reverse_link_tokens[link_tokens[user_id]] = user_id
-    return web.json_response({
+    return {
         "client_id": client_id,
         "custom_redirect_uri": (custom_redirect_uri_format.format(localpart=localpart,
                                                                   homeserver=homeserver)
                                 if custom_redirect_uri_format else None),
-        "link_token": link_tokens[user_id],
-    })
+        "link_token": await get_user_token(LINK_TOKENS, user_id),
+    }
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, client_id, custom_redirect_uri_format
-    secret = cfg["bridges.mx-puppet-slack.secret"]
-    if secret:
-        host = URL(cfg["bridges.mx-puppet-slack.url"])
+    global bridge, client_id, custom_redirect_uri_format
+    bridge = bridges["mx-puppet-slack"]
+    if bridge.enabled:
         client_id = cfg["bridges.mx-puppet-slack.client_id"]
         custom_redirect_uri_format = cfg["bridges.mx-puppet-slack.custom_oauth_redirect"]
     app.add_routes(routes)
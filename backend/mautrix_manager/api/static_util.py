@@ -13,11 +13,13 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from json import JSONDecodeError
 import random
 import string
 
-from aiohttp import web, ClientResponse
+from aiohttp import web, ClientResponse, ContentTypeError
+
+from ..util import json_codec
+from ..util.json_codec import JSONDecodeError
 
 simple_static_page = """<!DOCTYPE html>
 <html lang="en">
@@ -49,8 +51,8 @@ def reply(status: int, page: str, title: str, body: str = "") -> web.Response:
 async def handle_error_response(page_title: str, error_title: str, resp: ClientResponse
                                 ) -> web.Response:
     try:
-        data = await resp.json()
+        data = await resp.json(loads=json_codec.loads)
         error = data["error"]
-    except (JSONDecodeError, KeyError):
+    except (ContentTypeError, JSONDecodeError, KeyError, TypeError):
         error = "An unknown error occurred. Check the bridge logs."
     return reply(resp.status, page_title, error_title, error)
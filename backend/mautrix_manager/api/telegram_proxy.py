@@ -13,25 +13,29 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
+
+from mautrix.types import UserID
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
+from .bridge import Bridge, bridges
 
 routes = web.RouteTableDef()
 config: Config
-host: URL
-secret: str
+bridge: Bridge
 allow_bot_login: bool
 
 
 @routes.view("/mautrix-telegram/user/{user_id}")
 @routes.view("/mautrix-telegram/user/{user_id}/{path:.+}")
-async def proxy_user(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_user(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
     user_id = request.match_info.get("user_id", None)
     sender = request["token"].user_id
@@ -40,36 +44,39 @@ async def proxy_user(request: web.Request) -> web.Response:
     elif sender != user_id and not config.get_permissions(sender).admin:
         raise Error.no_impersonation
 
-    return await proxy(host, secret, request, f"user/{user_id}")
+    return await proxy(bridge, request, f"user/{user_id}")
 
 
 @routes.view("/mautrix-telegram/portal/{path:.+}")
-async def proxy_portal(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_portal(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "portal")
+    return await proxy(bridge, request, "portal")
 
 
 @routes.view("/mautrix-telegram/bridge")
-async def proxy_bridge(request: web.Request) -> web.Response:
-    if not secret:
+async def proxy_bridge(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "bridge")
+    return await proxy(bridge, request, "bridge")
 
 
 @routes.get("/mautrix-telegram")
-async def check_status(_: web.Request) -> web.Response:
-    if not secret:
+async def check_status(request: web.Request) -> web.Response:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return web.json_response({"allow_bot_login": allow_bot_login})
+    return json_response(get_info(request["token"].user_id))
+
+
+def get_info(_: UserID) -> Dict[str, Any]:
+    return {"allow_bot_login": allow_bot_login}
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, config, allow_bot_login
+    global bridge, config, allow_bot_login
     config = cfg
-    secret = cfg["bridges.mautrix-telegram.secret"]
-    if secret:
-        host = URL(cfg["bridges.mautrix-telegram.url"])
+    bridge = bridges["mautrix-telegram"]
+    if bridge.enabled:
         allow_bot_login = cfg["bridges.mautrix-telegram.allow_bot_login"]
     app.add_routes(routes)
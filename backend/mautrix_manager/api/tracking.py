@@ -20,6 +20,7 @@ from ipaddress import ip_address
 from ..config import Config
 from .initable import initializer
 from ..mixpanel import is_enabled, track, engage
+from ..util.json_codec import json_response, read_json
 
 routes = web.RouteTableDef()
 
@@ -53,14 +54,14 @@ async def cors_track(_: web.Request) -> web.Response:
 
 @routes.get("/track")
 async def check_track(_: web.Request) -> web.Response:
-    return web.json_response({
+    return json_response({
         "enabled": is_enabled(),
     }, headers=cors_headers)
 
 
 @routes.post("/track")
 async def do_track(request: web.Request) -> web.Response:
-    data = await request.json()
+    data = await read_json(request)
     try:
         event = data["event"]
         props = data["properties"]
@@ -71,20 +72,20 @@ async def do_track(request: web.Request) -> web.Response:
     ip = get_remote_ip(request)
     if ip:
         props["ip"] = ip
-    await track(event=event, user_id=request["token"].user_id,
-                user_agent=request.headers["User-Agent"], **props)
+    track(event=event, user_id=request["token"].user_id,
+          user_agent=request.headers["User-Agent"], **props)
     return web.Response(status=204, headers=cors_headers)
 
 @routes.post("/engage")
 async def do_engage(request: web.Request) -> web.Response:
-    props = await request.json()
+    props = await read_json(request)
     if not isinstance(props, dict):
         return web.Response(status=400, headers=cors_headers)
     ip = get_remote_ip(request)
     if ip:
         props["$ip"] = ip
-    await engage(user_id=request["token"].user_id,
-                user_agent=request.headers["User-Agent"], **props)
+    engage(user_id=request["token"].user_id,
+          user_agent=request.headers["User-Agent"], **props)
     return web.Response(status=204, headers=cors_headers)
 
 @initializer
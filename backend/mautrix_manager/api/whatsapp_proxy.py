@@ -13,63 +13,53 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Any
+
 from aiohttp import web
-from yarl import URL
+
+from mautrix.types import UserID
 
 from ..config import Config
+from ..util.json_codec import json_response
 from .errors import Error
 from .initable import initializer
 from .generic_proxy import proxy
-from . import generic_proxy
+from .ws_relay import relay
+from .bridge import Bridge, bridges
 
 routes = web.RouteTableDef()
 config: Config
-host: URL
-secret: str
+bridge: Bridge
 
 
 @routes.view("/mautrix-whatsapp/login")
 async def proxy_login(request: web.Request) -> web.WebSocketResponse:
-    print("Hello")
-    if not secret:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    query = request.query.copy()
-    query["user_id"] = request["token"].user_id
-    url = (host / "login").with_query(query)
-    headers = request.headers.copy()
-    headers["Authorization"] = f"Bearer {secret}"
-    resp = web.WebSocketResponse()
-    await resp.prepare(request)
-    async with generic_proxy.http.ws_connect(url, headers=headers) as websocket:
-        close = False
-        while not close:
-            data = await websocket.receive_json()
-            if "success" in data:
-                close = True
-            await resp.send_json(data)
-    return resp
+    return await relay(request, bridge, "login")
 
 
 @routes.view("/mautrix-whatsapp/{path:.+}")
-async def proxy_all(request: web.Request) -> web.Response:
-    print("Hello?")
-    if not secret:
+async def proxy_all(request: web.Request) -> web.StreamResponse:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return await proxy(host, secret, request, "")
+    return await proxy(bridge, request, "")
 
 
 @routes.get("/mautrix-whatsapp")
-async def check_status(_: web.Request) -> web.Response:
-    if not secret:
+async def check_status(request: web.Request) -> web.Response:
+    if not bridge.enabled:
         raise Error.bridge_disabled
-    return web.json_response({})
+    return json_response(get_info(request["token"].user_id))
+
+
+def get_info(_: UserID) -> Dict[str, Any]:
+    return {}
 
 
 @initializer
 def init(cfg: Config, app: web.Application) -> None:
-    global host, secret, config
+    global bridge, config
     config = cfg
-    secret = cfg["bridges.mautrix-whatsapp.secret"]
-    if secret:
-        host = URL(cfg["bridges.mautrix-whatsapp.url"])
+    bridge = bridges["mautrix-whatsapp"]
     app.add_routes(routes)
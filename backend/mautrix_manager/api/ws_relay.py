@@ -0,0 +1,179 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Union, Callable
+from collections import defaultdict
+import asyncio
+import logging
+import time
+
+from aiohttp import (web, hdrs, WSMsgType, WSCloseCode, ClientError, ClientWebSocketResponse,
+                     WSServerHandshakeError)
+from multidict import istr
+
+from mautrix.types import UserID
+
+from ..config import Config
+from ..metrics import ACTIVE_WEBSOCKETS, UPSTREAM_ERRORS
+from .errors import Error
+from .initable import initializer
+from .bridge import Bridge, DEADLINE_HEADER
+from .generic_proxy import filter_headers, check_available, REQUEST_SKIP_HEADERS
+from . import response_cache
+
+AnyWebSocket = Union[web.WebSocketResponse, ClientWebSocketResponse]
+# Close codes that are only used locally and can't be sent to the other side
+RESERVED_CLOSE_CODES = frozenset({1005, 1006, 1015})
+
+# The websocket handshake headers are generated separately for the upstream connection
+WS_SKIP_HEADERS = REQUEST_SKIP_HEADERS | {
+    hdrs.SEC_WEBSOCKET_KEY, hdrs.SEC_WEBSOCKET_VERSION, hdrs.SEC_WEBSOCKET_EXTENSIONS,
+    hdrs.SEC_WEBSOCKET_PROTOCOL, hdrs.ORIGIN, istr("Sec-WebSocket-Accept"),
+}
+
+heartbeat: Optional[float]
+idle_timeout: Optional[float]
+max_per_user: int
+open_sockets: Dict[UserID, int] = defaultdict(int)
+
+log = logging.getLogger("mau.manager.ws_relay")
+
+
+class _Activity:
+    last: float
+
+    def __init__(self) -> None:
+        self.last = time.monotonic()
+
+    def touch(self) -> None:
+        self.last = time.monotonic()
+
+    @property
+    def idle(self) -> float:
+        return time.monotonic() - self.last
+
+
+async def _pump(src: AnyWebSocket, dst: AnyWebSocket, activity: _Activity,
+                on_message: Optional[Callable[[], None]] = None) -> None:
+    while True:
+        try:
+            msg = await src.receive(timeout=idle_timeout)
+        except asyncio.TimeoutError:
+            # The other direction may still be active
+            if activity.idle >= idle_timeout:
+                return
+            continue
+        if msg.type == WSMsgType.TEXT:
+            await dst.send_str(msg.data)
+        elif msg.type == WSMsgType.BINARY:
+            await dst.send_bytes(msg.data)
+        else:
+            # CLOSE, CLOSING, CLOSED or ERROR
+            return
+        activity.touch()
+        if on_message:
+            on_message()
+
+
+def _close_code(code: Optional[int]) -> int:
+    if not code or code in RESERVED_CLOSE_CODES:
+        return WSCloseCode.GOING_AWAY
+    return code
+
+
+async def relay(request: web.Request, bridge: Bridge, path: str) -> web.WebSocketResponse:
+    """
+    Relay a websocket between the client and a bridge. Messages are passed through as-is in both
+    directions until either side closes the connection or it's idle for too long.
+    """
+    user_id = request["token"].user_id
+    if open_sockets[user_id] >= max_per_user:
+        raise Error.too_many_websockets
+    check_available(bridge)
+    query = request.query.copy()
+    # Don't leak the manager access token to the bridge
+    query.pop("access_token", None)
+    query["user_id"] = user_id
+    headers = filter_headers(request.headers, WS_SKIP_HEADERS)
+    headers.update(bridge.request_headers())
+    # The deadline only makes sense for normal requests
+    headers.pop(DEADLINE_HEADER, None)
+    protocols = [proto.strip() for proto
+                 in request.headers.get(hdrs.SEC_WEBSOCKET_PROTOCOL, "").split(",")
+                 if proto.strip()]
+
+    def invalidate_cache() -> None:
+        # The bridge state of the user changes during a login, so cached responses like the
+        # ping that the client makes after the login would be outdated.
+        response_cache.invalidate(bridge, user_id)
+
+    open_sockets[user_id] += 1
+    try:
+        try:
+            upstream = await bridge.http.ws_connect((bridge.url / path).with_query(query),
+                                                    headers=headers, protocols=protocols,
+                                                    heartbeat=heartbeat, autoping=True)
+        except WSServerHandshakeError as e:
+            bridge.breaker.record_success()
+            raise web.HTTPBadGateway(text=f"Bridge rejected websocket with HTTP {e.status}")
+        except (ClientError, asyncio.TimeoutError) as e:
+            bridge.breaker.record_failure(type(e).__name__)
+            UPSTREAM_ERRORS.labels(bridge=bridge.name, type="error").inc()
+            raise web.HTTPBadGateway(text="Failed to contact bridge")
+        bridge.breaker.record_success()
+        try:
+            resp = web.WebSocketResponse(heartbeat=heartbeat, autoping=True,
+                                         protocols=[upstream.protocol] if upstream.protocol
+                                         else ())
+            await resp.prepare(request)
+            activity = _Activity()
+            with ACTIVE_WEBSOCKETS.labels(bridge=bridge.name).track_inprogress():
+                pumps = [asyncio.ensure_future(_pump(resp, upstream, activity)),
+                         asyncio.ensure_future(_pump(upstream, resp, activity,
+                                                     on_message=invalidate_cache))]
+                try:
+                    done, pending = await asyncio.wait(pumps,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for pump in pumps:
+                        pump.cancel()
+                # Pass through errors from the pumps
+                for pump in done:
+                    exc = pump.exception()
+                    if exc and not isinstance(exc, (ConnectionResetError, ClientError)):
+                        log.warning(f"Error relaying websocket to {bridge.name}", exc_info=exc)
+            # Forward the close code of whichever side closed first
+            if upstream.closed and not resp.closed:
+                await resp.close(code=_close_code(upstream.close_code))
+            elif resp.closed and not upstream.closed:
+                await upstream.close(code=_close_code(resp.close_code))
+            elif not resp.closed:
+                await resp.close(code=WSCloseCode.GOING_AWAY, message=b"Idle timeout")
+        finally:
+            await upstream.close()
+    finally:
+        invalidate_cache()
+        open_sockets[user_id] -= 1
+        if open_sockets[user_id] <= 0:
+            del open_sockets[user_id]
+    return resp
+
+
+@initializer
+def init(cfg: Config, _: web.Application) -> None:
+    global heartbeat, idle_timeout, max_per_user
+    heartbeat = cfg["server.websocket.heartbeat"] or None
+    idle_timeout = cfg["server.websocket.idle_timeout"] or None
+    max_per_user = cfg["server.websocket.max_per_user"]
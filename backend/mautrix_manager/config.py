@@ -37,25 +37,90 @@ class Config(BaseFileConfig):
         copy("homeserver.federation_url")
 
         copy("docker.host")
+        copy("docker.hosts")
+        copy("docker.host_timeout")
+        copy("docker.log_hub.buffer_size")
+        copy("docker.log_hub.queue_size")
+        copy("docker.log_search.default_tail")
+        copy("docker.log_search.max_bytes")
+        copy("docker.log_search.max_time")
+        copy("docker.log_search.max_matches")
+        copy("docker.log_search.max_context")
+        copy("docker.jobs.parallelism")
+        copy("docker.jobs.retention")
+        copy("docker.jobs.max_jobs")
+        copy("docker.stats.interval")
+        copy("docker.stats.queue_size")
 
         copy("features.docker_controls")
         copy("features.internal_bridge_info")
 
         copy("mixpanel.token")
+        copy("mixpanel.queue_size")
+        copy("mixpanel.batch_size")
+        copy("mixpanel.flush_interval")
 
         copy("metrics.enabled")
         copy("metrics.listen_port")
 
         copy("server.host")
         copy("server.port")
+        copy("server.unix_socket")
+        copy("server.workers")
+        copy("server.speedups.uvloop")
+        copy("server.speedups.orjson")
         copy("server.database")
         copy("server.override_resource_path")
+        copy("server.static_cache.enabled")
+        copy("server.static_cache.max_file_size")
+        copy("server.precompress_static")
+        copy("server.bridge_status_timeout")
+        copy("server.bridge_health.failure_threshold")
+        copy("server.bridge_health.reset_timeout")
+        copy("server.bridge_health.probe_interval")
+        copy("server.bridge_health.probe_timeout")
+        copy("server.bridge_http.limit")
+        copy("server.bridge_http.limit_per_host")
+        copy("server.bridge_http.keepalive_timeout")
+        copy("server.bridge_http.dns_cache_ttl")
+        copy("server.bridge_http.timeout.connect")
+        copy("server.bridge_http.timeout.sock_read")
+        copy("server.bridge_http.timeout.total")
+        copy("server.bridge_http.coalesce_requests")
+        copy("server.websocket.heartbeat")
+        copy("server.websocket.idle_timeout")
+        copy("server.websocket.max_per_user")
+        copy("server.response_cache.size")
+        copy("server.response_cache.ttl")
+        copy("server.response_cache.stale_ttl")
+        copy("server.response_cache.paths")
+        copy("server.token_cache.size")
+        copy("server.token_cache.ttl")
+        copy("server.token_cache.negative_ttl")
+        copy("server.openid.timeout")
+        copy("server.openid.server_cache_size")
+        copy("server.openid.server_cache_ttl")
+        copy("server.openid.server_negative_ttl")
+        copy("server.openid.token_cache_size")
+        copy("server.openid.token_cache_ttl")
+        copy("server.link_state.backend")
+        copy("server.link_state.ttl")
+        copy("server.link_state.max_size")
+        copy("server.link_state.sweep_interval")
+        copy("server.link_state.sweep_batch_size")
+        copy("server.sessions.lifetime")
+        copy("server.sessions.touch_interval")
+        copy("server.sessions.flush_interval")
+        copy("server.sessions.sweep_interval")
+        copy("server.sessions.sweep_batch_size")
+        copy("server.sessions.max_per_user")
 
         for bridge in ("mautrix-telegram", "mautrix-whatsapp", "mautrix-facebook",
                        "mautrix-hangouts", "mautrix-twitter", "mx-puppet-slack",
                        "mx-puppet-twitter", "mx-puppet-instagram"):
             copy(f"bridges.{bridge}.url")
             copy(f"bridges.{bridge}.secret")
+            copy(f"bridges.{bridge}.http")
 
         copy("bridges.mautrix-telegram.allow_bot_login")
         copy("bridges.mautrix-facebook.domain")
@@ -74,6 +139,14 @@ class Config(BaseFileConfig):
         user = admin or level == "user"
         return Permissions(user=user, admin=admin, level=level)
 
+    def is_server_allowed(self, server_name: str) -> bool:
+        """Check if any user on the given server could have access."""
+        for key in self["permissions"].keys():
+            if ((key == "*" or key == server_name or key.endswith(f":{server_name}"))
+                    and self._get_permissions(key).user):
+                return True
+        return False
+
     def get_permissions(self, mxid: UserID) -> Permissions:
         permissions = self["permissions"]
         if mxid in permissions:
@@ -1,3 +1,4 @@
 from .base import Base
 from .token import Token
+from .link_state import LinkState
 from .upgrade import upgrade_table
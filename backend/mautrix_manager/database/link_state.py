@@ -0,0 +1,84 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional, Any
+import time
+
+from ..metrics import DB_QUERY_TIME
+from ..util import json_codec
+from .base import Base
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+class LinkState(Base):
+    """Short-lived key-value data for account linking flows, stored as JSON with an expiry."""
+
+    @classmethod
+    async def get(cls, namespace: str, key: str) -> Optional[Any]:
+        with DB_QUERY_TIME.labels(query="link_state_get").time():
+            value = await cls.db.fetchval("SELECT value FROM link_state WHERE namespace=$1 "
+                                          "AND key=$2 AND expires_at>$3", namespace, key, _now())
+        return json_codec.loads(value) if value is not None else None
+
+    @classmethod
+    async def set(cls, namespace: str, key: str, value: Any, ttl: float) -> None:
+        with DB_QUERY_TIME.labels(query="link_state_set").time():
+            await cls.db.execute("INSERT INTO link_state (namespace, key, value, expires_at) "
+                                 "VALUES ($1, $2, $3, $4) ON CONFLICT (namespace, key) "
+                                 "DO UPDATE SET value=excluded.value, "
+                                 "expires_at=excluded.expires_at",
+                                 namespace, key, json_codec.dumps(value), _now() + int(ttl * 1000))
+
+    @classmethod
+    async def get_or_set(cls, namespace: str, key: str, value: Any, ttl: float) -> Any:
+        """
+        Get the value of a key and extend its expiry, or set it to the given value if it
+        doesn't exist or has expired. This is atomic, so concurrent callers get the same value.
+        """
+        now = _now()
+        with DB_QUERY_TIME.labels(query="link_state_get_or_set").time():
+            stored = await cls.db.fetchval("INSERT INTO link_state (namespace, key, value, "
+                                           "expires_at) VALUES ($1, $2, $3, $4) "
+                                           "ON CONFLICT (namespace, key) DO UPDATE SET "
+                                           "value=CASE WHEN link_state.expires_at>$5 "
+                                           "THEN link_state.value ELSE excluded.value END, "
+                                           "expires_at=excluded.expires_at RETURNING value",
+                                           namespace, key, json_codec.dumps(value),
+                                           now + int(ttl * 1000), now)
+        return json_codec.loads(stored)
+
+    @classmethod
+    async def pop(cls, namespace: str, key: str) -> Optional[Any]:
+        with DB_QUERY_TIME.labels(query="link_state_pop").time():
+            value = await cls.db.fetchval("DELETE FROM link_state WHERE namespace=$1 AND key=$2 "
+                                          "AND expires_at>$3 RETURNING value",
+                                          namespace, key, _now())
+        return json_codec.loads(value) if value is not None else None
+
+    @classmethod
+    async def delete_expired(cls, batch_size: int) -> int:
+        deleted = 0
+        while True:
+            with DB_QUERY_TIME.labels(query="link_state_delete_expired").time():
+                rows = await cls.db.fetch("DELETE FROM link_state WHERE (namespace, key) IN ("
+                                          "  SELECT namespace, key FROM link_state"
+                                          "  WHERE expires_at<$1 LIMIT $2"
+                                          ") RETURNING key", _now(), batch_size)
+            deleted += len(rows)
+            if len(rows) < batch_size:
+                return deleted
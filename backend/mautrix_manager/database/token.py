@@ -13,39 +13,226 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional
+from typing import Optional, ClassVar, Dict, Tuple, List
+import hashlib
 import random
 import string
+import time
 
 from attr import dataclass
 import asyncpg
 
 from mautrix.types import UserID
 
+from ..util import TTLCache
+from ..metrics import TOKEN_CACHE_LOOKUPS, DB_QUERY_TIME
 from .base import Base
 
+_not_cached = object()
+
+# Postgres notification channel for telling other manager processes to drop revoked tokens from
+# their caches.
+REVOCATION_CHANNEL = "mautrix_manager_token_revoked"
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
 
 @dataclass
 class Token(Base):
+    # Cached lookups by secret. Unknown secrets are cached as None for a shorter time,
+    # so that clients spamming invalid tokens don't cause a query for every request.
+    cache: ClassVar[TTLCache[str, Optional['Token']]] = TTLCache(max_size=0, ttl=0)
+    negative_cache_ttl: ClassVar[float] = 0
+    # Tokens expire after this many milliseconds without being used. 0 means never.
+    lifetime: ClassVar[int] = 0
+    # last_used_at is only updated if it's older than this (in milliseconds), and the updates
+    # are written to the database in batches by flush_touches.
+    touch_interval: ClassVar[int] = 0
+    _pending_touches: ClassVar[Dict[str, Tuple[int, Optional[int]]]] = {}
+    # Whether revocations should be sent to other processes sharing the database
+    broadcast_revocations: ClassVar[bool] = False
+
     user_id: UserID
     secret: str
+    created_at: int
+    last_used_at: int
+    expires_at: Optional[int] = None
 
     @staticmethod
     def random(user_id: UserID) -> 'Token':
+        now = _now()
         return Token(secret="".join(random.choices(string.ascii_lowercase + string.digits, k=64)),
-                     user_id=user_id)
+                     user_id=user_id, created_at=now, last_used_at=now,
+                     expires_at=now + Token.lifetime if Token.lifetime else None)
+
+    @classmethod
+    def init_cache(cls, max_size: int, ttl: float, negative_ttl: float) -> None:
+        cls.cache = TTLCache(max_size=max_size, ttl=ttl)
+        cls.negative_cache_ttl = negative_ttl
+
+    @classmethod
+    def init_expiry(cls, lifetime: float, touch_interval: float) -> None:
+        cls.lifetime = int(lifetime * 1000)
+        cls.touch_interval = int(touch_interval * 1000)
+
+    @property
+    def id(self) -> str:
+        """A public identifier for the session, so clients can refer to it without the secret."""
+        return hashlib.sha256(self.secret.encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at < _now()
 
     @classmethod
     async def get(cls, secret: str) -> Optional['Token']:
-        row: asyncpg.Record = await cls.db.fetchrow("SELECT user_id, secret "
-                                                    "FROM access_token WHERE secret=$1", secret)
+        token = cls.cache.get(secret, _not_cached)
+        if token is not _not_cached:
+            TOKEN_CACHE_LOOKUPS.labels(result="hit" if token else "negative_hit").inc()
+            return token if token and not token.expired else None
+        TOKEN_CACHE_LOOKUPS.labels(result="miss").inc()
+        with DB_QUERY_TIME.labels(query="token_get").time():
+            row: asyncpg.Record = await cls.db.fetchrow("SELECT user_id, secret, created_at, "
+                                                        "last_used_at, expires_at "
+                                                        "FROM access_token WHERE secret=$1",
+                                                        secret)
         if row is None:
+            if cls.negative_cache_ttl > 0:
+                cls.cache.set(secret, None, ttl=cls.negative_cache_ttl)
             return None
-        return Token(**row)
+        token = Token(**row)
+        cls.cache.set(secret, token)
+        return token if not token.expired else None
+
+    @classmethod
+    async def get_all_by_user(cls, user_id: UserID) -> List['Token']:
+        with DB_QUERY_TIME.labels(query="token_get_all_by_user").time():
+            rows = await cls.db.fetch("SELECT user_id, secret, created_at, last_used_at, "
+                                      "expires_at FROM access_token WHERE user_id=$1 "
+                                      "ORDER BY last_used_at DESC", user_id)
+        tokens = [Token(**row) for row in rows]
+        for token in tokens:
+            # The database might not have the latest use time yet
+            pending = cls._pending_touches.get(token.secret)
+            if pending:
+                token.last_used_at, token.expires_at = pending
+        return [token for token in tokens if not token.expired]
+
+    def touch(self) -> None:
+        """Mark the token as used now and extend its expiry. The change is saved later."""
+        now = _now()
+        if now - self.last_used_at < self.touch_interval:
+            return
+        self.last_used_at = now
+        if self.lifetime:
+            self.expires_at = now + self.lifetime
+        self._pending_touches[self.secret] = (self.last_used_at, self.expires_at)
+
+    @classmethod
+    async def flush_touches(cls) -> int:
+        if not cls._pending_touches:
+            return 0
+        pending = cls._pending_touches
+        cls._pending_touches = {}
+        secrets = list(pending.keys())
+        try:
+            with DB_QUERY_TIME.labels(query="token_touch").time():
+                await cls.db.execute("UPDATE access_token SET last_used_at=data.last_used_at, "
+                                     "expires_at=data.expires_at "
+                                     "FROM (SELECT unnest($1::text[]) AS secret, "
+                                     "unnest($2::bigint[]) AS last_used_at, "
+                                     "unnest($3::bigint[]) AS expires_at) AS data "
+                                     "WHERE access_token.secret=data.secret", secrets,
+                                     [pending[secret][0] for secret in secrets],
+                                     [pending[secret][1] for secret in secrets])
+        except BaseException:
+            # Retry on the next flush, unless the token was touched again in the meantime
+            for secret, touch in pending.items():
+                cls._pending_touches.setdefault(secret, touch)
+            raise
+        return len(secrets)
+
+    @classmethod
+    async def apply_lifetime(cls) -> int:
+        """
+        Make the stored expiry times match the configured lifetime: tokens without an expiry get
+        one if there's a lifetime, and all expiries are removed if tokens never expire.
+        """
+        with DB_QUERY_TIME.labels(query="token_apply_lifetime").time():
+            if cls.lifetime:
+                status = await cls.db.execute("UPDATE access_token "
+                                              "SET expires_at=last_used_at+$1 "
+                                              "WHERE expires_at IS NULL", cls.lifetime)
+            else:
+                status = await cls.db.execute("UPDATE access_token SET expires_at=NULL "
+                                              "WHERE expires_at IS NOT NULL")
+        cls.cache.clear()
+        return int(status.split(" ")[-1])
+
+    @classmethod
+    async def delete_expired(cls, batch_size: int) -> int:
+        """Delete expired tokens in batches, so a big backlog doesn't lock the table for long."""
+        deleted = 0
+        while True:
+            with DB_QUERY_TIME.labels(query="token_delete_expired").time():
+                rows = await cls.db.fetch("DELETE FROM access_token WHERE secret IN ("
+                                          "  SELECT secret FROM access_token"
+                                          "  WHERE expires_at<$1 LIMIT $2"
+                                          ") RETURNING secret", _now(), batch_size)
+            # Other processes check the expiry of cached tokens themselves, so there's no need
+            # to notify them.
+            for row in rows:
+                cls.forget(row["secret"])
+            deleted += len(rows)
+            if len(rows) < batch_size:
+                return deleted
+
+    @classmethod
+    def forget(cls, secret: str) -> None:
+        """Drop a revoked token from the local caches."""
+        cls.cache.pop(secret)
+        cls._pending_touches.pop(secret, None)
+
+    @classmethod
+    async def _revoked(cls, secrets: List[str]) -> None:
+        for secret in secrets:
+            cls.forget(secret)
+        if cls.broadcast_revocations and secrets:
+            with DB_QUERY_TIME.labels(query="token_notify_revoked").time():
+                await cls.db.execute("SELECT pg_notify($1, secret) "
+                                     "FROM unnest($2::text[]) AS secret",
+                                     REVOCATION_CHANNEL, secrets)
+
+    @classmethod
+    async def delete_many(cls, secrets: List[str]) -> int:
+        with DB_QUERY_TIME.labels(query="token_delete_many").time():
+            rows = await cls.db.fetch("DELETE FROM access_token WHERE secret=ANY($1::text[]) "
+                                      "RETURNING secret", secrets)
+        await cls._revoked(secrets)
+        return len(rows)
+
+    @classmethod
+    async def delete_old_sessions(cls, user_id: UserID, keep: int) -> int:
+        """Delete the least recently used tokens of a user, except for the newest ``keep``."""
+        with DB_QUERY_TIME.labels(query="token_delete_old_sessions").time():
+            rows = await cls.db.fetch("DELETE FROM access_token WHERE secret IN ("
+                                      "  SELECT secret FROM access_token WHERE user_id=$1"
+                                      "  ORDER BY last_used_at DESC OFFSET $2"
+                                      ") RETURNING secret", user_id, keep)
+        await cls._revoked([row["secret"] for row in rows])
+        return len(rows)
 
     async def delete(self) -> None:
-        await self.db.execute("DELETE FROM access_token WHERE secret=$1", self.secret)
+        with DB_QUERY_TIME.labels(query="token_delete").time():
+            await self.db.execute("DELETE FROM access_token WHERE secret=$1", self.secret)
+        await self._revoked([self.secret])
 
     async def insert(self) -> None:
-        await self.db.execute("INSERT INTO access_token (user_id, secret) VALUES ($1, $2)",
-                              self.user_id, self.secret)
+        with DB_QUERY_TIME.labels(query="token_insert").time():
+            await self.db.execute("INSERT INTO access_token (user_id, secret, created_at, "
+                                  "last_used_at, expires_at) VALUES ($1, $2, $3, $4, $5)",
+                                  self.user_id, self.secret, self.created_at, self.last_used_at,
+                                  self.expires_at)
+        self.cache.set(self.secret, self)
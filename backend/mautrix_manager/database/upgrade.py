@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+
 from asyncpg import Connection
 
 from mautrix.util.async_db.upgrade import UpgradeTable
@@ -26,3 +28,29 @@ async def upgrade_v1(conn: Connection) -> None:
         user_id VARCHAR(255),
         secret  VARCHAR(255) PRIMARY KEY
     )""")
+
+
+@upgrade_table.register(description="Add token timestamps and user ID index")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE access_token ADD COLUMN created_at BIGINT, "
+                       "ADD COLUMN last_used_at BIGINT, ADD COLUMN expires_at BIGINT")
+    # Timestamps are in milliseconds. The expiry of existing tokens is left empty here and set
+    # at startup based on the configured lifetime.
+    now = int(time.time() * 1000)
+    await conn.execute("UPDATE access_token SET created_at=$1, last_used_at=$1", now)
+    await conn.execute("ALTER TABLE access_token ALTER COLUMN created_at SET NOT NULL, "
+                       "ALTER COLUMN last_used_at SET NOT NULL")
+    await conn.execute("CREATE INDEX access_token_user_id_idx ON access_token (user_id)")
+    await conn.execute("CREATE INDEX access_token_expires_at_idx ON access_token (expires_at)")
+
+
+@upgrade_table.register(description="Add link state table")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute("""CREATE TABLE link_state (
+        namespace  VARCHAR(255),
+        key        VARCHAR(255),
+        value      TEXT NOT NULL,
+        expires_at BIGINT NOT NULL,
+        PRIMARY KEY (namespace, key)
+    )""")
+    await conn.execute("CREATE INDEX link_state_expires_at_idx ON link_state (expires_at)")
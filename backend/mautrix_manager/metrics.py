@@ -0,0 +1,97 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, Awaitable, Tuple
+import time
+
+from aiohttp import web
+
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+# The metrics HTTP server itself is started by mautrix.util.program.Program based on the
+# metrics.enabled and metrics.listen_port config options.
+REQUEST_COUNT = Counter("mautrix_manager_requests_total", "Number of handled API requests",
+                        ["route", "bridge", "method", "status"])
+REQUEST_TIME = Histogram("mautrix_manager_request_duration_seconds",
+                         "Time spent handling API requests, including streaming the response",
+                         ["route", "bridge"])
+UPSTREAM_ERRORS = Counter("mautrix_manager_upstream_errors_total",
+                          "Number of failed requests to bridges or the Docker daemon",
+                          ["bridge", "type"])
+TOKEN_CACHE_LOOKUPS = Counter("mautrix_manager_token_cache_lookups_total",
+                              "Number of access token cache lookups", ["result"])
+DB_QUERY_TIME = Histogram("mautrix_manager_db_query_duration_seconds",
+                          "Time spent on database queries", ["query"])
+ACTIVE_WEBSOCKETS = Gauge("mautrix_manager_active_websockets",
+                          "Number of open proxied websockets", ["bridge"])
+ACTIVE_LOG_STREAMS = Gauge("mautrix_manager_active_docker_log_streams",
+                           "Number of open Docker log streams")
+BRIDGE_BREAKER_STATE = Gauge("mautrix_manager_bridge_breaker_state",
+                             "State of the circuit breaker of each bridge "
+                             "(0 = closed, 1 = half-open, 2 = open)", ["bridge"])
+BRIDGE_REJECTED = Counter("mautrix_manager_bridge_rejected_requests_total",
+                          "Number of requests rejected because the bridge circuit was open",
+                          ["bridge"])
+COALESCED_REQUESTS = Counter("mautrix_manager_coalesced_requests_total",
+                             "Number of requests that were answered with the response to an "
+                             "identical concurrent request", ["bridge"])
+RESPONSE_CACHE_LOOKUPS = Counter("mautrix_manager_response_cache_lookups_total",
+                                 "Number of bridge response cache lookups", ["bridge", "result"])
+RESPONSE_CACHE_HIT_RATIO = Gauge("mautrix_manager_response_cache_hit_ratio",
+                                 "Fraction of bridge response cache lookups that were served "
+                                 "from the cache (including stale responses)")
+LOG_HUB_SUBSCRIBERS = Gauge("mautrix_manager_docker_log_hub_subscribers",
+                            "Number of clients following Docker logs through a shared stream")
+LOG_HUB_DROPPED = Counter("mautrix_manager_docker_log_hub_dropped_subscribers_total",
+                          "Number of clients disconnected from shared Docker log streams for "
+                          "not reading fast enough")
+STATS_HUB_SUBSCRIBERS = Gauge("mautrix_manager_docker_stats_subscribers",
+                              "Number of clients receiving Docker container stats")
+MIXPANEL_QUEUE_DEPTH = Gauge("mautrix_manager_mixpanel_queue_depth",
+                             "Number of Mixpanel events waiting to be sent")
+MIXPANEL_DROPPED = Counter("mautrix_manager_mixpanel_dropped_events_total",
+                           "Number of Mixpanel events dropped because the queue was full")
+
+
+def get_route_labels(request: web.Request) -> Tuple[str, str]:
+    """Get the route template and the top-level API section (bridge name) of a request."""
+    try:
+        route = request.match_info.route.resource.canonical
+    except AttributeError:
+        return "unknown", "unknown"
+    parts = route.split("/", 3)
+    # The first part is empty and the second is the subapp prefix
+    bridge = parts[2] if len(parts) > 2 else ""
+    return route, bridge
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    route, bridge = get_route_labels(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_TIME.labels(route=route, bridge=bridge).observe(time.perf_counter() - start)
+        REQUEST_COUNT.labels(route=route, bridge=bridge, method=request.method,
+                             status=str(status)).inc()
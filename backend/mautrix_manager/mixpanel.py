@@ -13,67 +13,148 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Deque, Dict, List, Tuple, Any, Optional
+from collections import deque, defaultdict
 import logging
 import asyncio
 import base64
-import json
+import time
 
 import aiohttp
 from yarl import URL
 
 from .config import Config
+from .metrics import MIXPANEL_QUEUE_DEPTH, MIXPANEL_DROPPED
+from .util import json_codec
+
+# Mixpanel accepts at most 50 events per batch request.
+MAX_BATCH_SIZE = 50
+api_url = URL("https://api.mixpanel.com")
+
+# (endpoint, user agent, payload)
+QueuedEvent = Tuple[str, str, Dict[str, Any]]
 
 log = logging.getLogger("mau.mixpanel")
 token: str
 http: aiohttp.ClientSession
+queue: Deque[QueuedEvent]
+batch_size: int
+flush_interval: float
+dropped: int = 0
+_pending: asyncio.Event
+_batch_full: asyncio.Event
+_flush_task: Optional[asyncio.Future] = None
 
 
 def is_enabled() -> bool:
     return bool(token)
 
 
-async def track(event: str, user_id: str, user_agent: str = "", **properties: str) -> None:
+def _enqueue(endpoint: str, user_agent: str, data: Dict[str, Any]) -> None:
+    global dropped
+    if len(queue) == queue.maxlen:
+        # The deque discards the oldest event when appending to a full queue
+        dropped += 1
+        MIXPANEL_DROPPED.inc()
+        if dropped % 100 == 1:
+            log.warning(f"Mixpanel event queue is full, dropped {dropped} events so far")
+    queue.append((endpoint, user_agent, data))
+    _pending.set()
+    if len(queue) >= batch_size:
+        _batch_full.set()
+
+
+def track(event: str, user_id: str, user_agent: str = "", **properties: Any) -> None:
     if not token:
         return
-    try:
-        await http.post(URL("https://api.mixpanel.com/track/").with_query({
-            "data": base64.b64encode(json.dumps({
-                "event": event,
-                "properties": {
-                    **properties,
-                    "token": token,
-                    "distinct_id": user_id,
-                }
-            }).encode("utf-8")).decode("utf-8"),
-        }), headers={
-            "User-Agent": user_agent
-        } if user_agent else {})
-        log.debug(f"Tracked {event} from {user_id}")
-    except Exception:
-        log.exception(f"Failed to track {event} from {user_id}")
+    _enqueue("track", user_agent, {
+        "event": event,
+        "properties": {
+            # Events are sent later in batches, so record when it actually happened
+            "time": int(time.time()),
+            **properties,
+            "token": token,
+            "distinct_id": user_id,
+        }
+    })
+    log.debug(f"Queued {event} from {user_id}")
 
 
-async def engage(user_id: str, user_agent: str = "", **properties: str) -> None:
+def engage(user_id: str, user_agent: str = "", **properties: Any) -> None:
     if not token:
         return
+    _enqueue("engage", user_agent, {
+        "$time": int(time.time() * 1000),
+        **properties,
+        "$token": token,
+        "$distinct_id": user_id,
+    })
+    log.debug(f"Queued profile update for {user_id}")
+
+
+async def _send(endpoint: str, user_agent: str, items: List[Dict[str, Any]]) -> None:
     try:
-        await http.post(URL("https://api.mixpanel.com/engage/").with_query({
-            "data": base64.b64encode(json.dumps({
-                **properties,
-                "$token": token,
-                "$distinct_id": user_id,
-            }).encode("utf-8")).decode("utf-8"),
-        }), headers={
+        data = base64.b64encode(json_codec.dumps_bytes(items)).decode("utf-8")
+        async with http.post(api_url / endpoint / "", data={"data": data}, headers={
             "User-Agent": user_agent
-        } if user_agent else {})
-        log.debug(f"Update user's profile for {user_id}")
+        } if user_agent else {}) as resp:
+            if resp.status != 200:
+                log.warning(f"Unexpected status {resp.status} sending {len(items)} "
+                            f"{endpoint} events to Mixpanel: {await resp.text()}")
+                return
+        log.debug(f"Sent {len(items)} {endpoint} events to Mixpanel")
     except Exception:
-        log.exception(f"Failed to update user's profile for {user_id}")
+        log.exception(f"Failed to send {len(items)} {endpoint} events to Mixpanel")
+
+
+async def flush() -> None:
+    while queue:
+        groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        for _ in range(min(batch_size, len(queue))):
+            endpoint, user_agent, data = queue.popleft()
+            groups[(endpoint, user_agent)].append(data)
+        await asyncio.gather(*(_send(endpoint, user_agent, items)
+                               for (endpoint, user_agent), items in groups.items()))
+
+
+async def _flush_loop() -> None:
+    while True:
+        await _pending.wait()
+        try:
+            # Send right away if a full batch is queued, otherwise wait for more events
+            await asyncio.wait_for(_batch_full.wait(), timeout=flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        _pending.clear()
+        _batch_full.clear()
+        await flush()
+
+
+async def stop() -> None:
+    global _flush_task
+    if _flush_task:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    if token and queue:
+        log.debug(f"Flushing {len(queue)} queued events before stopping")
+        await flush()
+    await http.close()
 
 
 def init(config: Config) -> None:
-    global token, http
+    global token, http, queue, batch_size, flush_interval, _pending, _batch_full, _flush_task
     token = config["mixpanel.token"]
     http = aiohttp.ClientSession(loop=asyncio.get_event_loop())
+    queue = deque(maxlen=config["mixpanel.queue_size"])
+    batch_size = min(config["mixpanel.batch_size"], MAX_BATCH_SIZE)
+    flush_interval = config["mixpanel.flush_interval"]
+    _pending = asyncio.Event()
+    _batch_full = asyncio.Event()
+    MIXPANEL_QUEUE_DEPTH.set_function(lambda: len(queue))
     if token:
+        _flush_task = asyncio.ensure_future(_flush_loop())
         log.info("Mixpanel tracking is enabled")
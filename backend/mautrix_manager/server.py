@@ -13,19 +13,41 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List
+
 from pkg_resources import resource_filename
 from aiohttp import web
+import logging
 
 from .api import api_app, ui_app, integrations_app, init as init_api
-from .static import StaticResource
+from .static import StaticResource, precompress
 from .config import Config
+from . import workers
+
+log = logging.getLogger("mau.server")
+
+
+def get_resource_path(config: Config) -> str:
+    return (config["server.override_resource_path"]
+            or resource_filename("mautrix_manager", "frontend"))
+
+
+def precompress_resources(config: Config) -> None:
+    if not config["server.precompress_static"]:
+        return
+    try:
+        written = precompress(get_resource_path(config))
+        if written:
+            log.info(f"Wrote {written} precompressed UI resources")
+    except OSError:
+        log.warning("Failed to precompress UI resources", exc_info=True)
 
 
 class Server:
     config: Config
     runner: web.AppRunner
     app: web.Application
-    site: web.TCPSite
+    sites: List[web.BaseSite]
 
     def __init__(self, config: Config) -> None:
         init_api(config)
@@ -35,17 +57,29 @@ class Server:
         self.app.add_subapp("/api", api_app)
         self.app.add_subapp("/ui", ui_app)
 
-        resource_path = (config["server.override_resource_path"]
-                         or resource_filename("mautrix_manager", "frontend"))
-        self.app.router.register_resource(StaticResource("/", resource_path, name="frontend"))
+        resource_path = get_resource_path(config)
+        self.app.router.register_resource(StaticResource(
+            "/", resource_path, name="frontend", cache=config["server.static_cache.enabled"],
+            max_cached_file_size=config["server.static_cache.max_file_size"]))
 
         self.runner = web.AppRunner(self.app)
 
     async def start(self) -> None:
         await self.runner.setup()
-        self.site = web.TCPSite(self.runner, self.config["server.host"],
-                                self.config["server.port"])
-        await self.site.start()
+        self.sites = []
+        if self.config["server.port"]:
+            # With multiple workers, each worker has its own listening socket and the kernel
+            # distributes connections between them.
+            self.sites.append(web.TCPSite(self.runner, self.config["server.host"],
+                                          self.config["server.port"],
+                                          reuse_port=workers.is_worker()))
+        if workers.unix_socket:
+            self.sites.append(web.SockSite(self.runner, workers.unix_socket))
+        elif self.config["server.unix_socket"]:
+            self.sites.append(web.UnixSite(self.runner, self.config["server.unix_socket"]))
+        for site in self.sites:
+            await site.start()
+            log.info(f"Listening on {site.name}")
 
     async def stop(self) -> None:
         await self.runner.cleanup()
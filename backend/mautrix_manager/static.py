@@ -1,20 +1,140 @@
 # Simplified version of aiohttp's StaticResource that supports a custom 404 page.
 # https://github.com/aio-libs/aiohttp/blob/v3.6.2/aiohttp/web_urldispatcher.py#L496-L678
 # Licensed under Apache 2.0
-from typing import Callable, Awaitable, Tuple, Optional, Union, Dict, Set, Iterator, Any
+from typing import (Callable, Awaitable, Tuple, Optional, Union, Dict, Set, Iterator, Any,
+                    NamedTuple)
+from email.utils import formatdate
 from pathlib import Path, PurePath
+import mimetypes
+import logging
+import hashlib
+import gzip
+import os
+import re
 
-from aiohttp.web import (Request, StreamResponse, FileResponse, ResourceRoute, AbstractResource,
-                         AbstractRoute, UrlMappingMatchInfo)
-from aiohttp.abc import AbstractMatchInfo
+from aiohttp.web import (Request, StreamResponse, FileResponse, Response, ResourceRoute,
+                         AbstractResource, AbstractRoute, UrlMappingMatchInfo, HTTPNotFound)
+from aiohttp.abc import AbstractMatchInfo, AbstractStreamWriter
+from aiohttp import hdrs
 from yarl import URL
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 Handler = Callable[[Request], Awaitable[StreamResponse]]
 
+CachedFile = NamedTuple("CachedFile", path=Path, body=Optional[bytes], etag=str,
+                        last_modified=str, mtime=int, content_type=str,
+                        compressed=Dict[str, 'CachedFile'])
+
+# Content-Encoding -> file suffix, in order of preference
+COMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+COMPRESSIBLE_TYPES = re.compile(r"^(text/.+|application/(javascript|json|manifest\+json|xml)|"
+                                r"image/svg\+xml)$")
+# Snowpack only puts content hashes in the names of shared chunks, so only those are safe to
+# cache forever. The entrypoint modules (e.g. web_modules/preact.js) have to be revalidated.
+IMMUTABLE_PATH = re.compile(r"^web_modules/.+[.-][0-9a-f]{8,}\.m?js$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+log = logging.getLogger("mau.static")
+
+
+def _load_file(path: Path, max_size: int) -> CachedFile:
+    stat = path.stat()
+    content_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+    body = path.read_bytes() if stat.st_size <= max_size else None
+    etag = f'"{hashlib.sha1(body).hexdigest()}"' if body is not None else ""
+    return CachedFile(path=path, body=body, etag=etag,
+                      last_modified=formatdate(stat.st_mtime, usegmt=True),
+                      mtime=int(stat.st_mtime), content_type=content_type, compressed={})
+
+
+class _FileResponse(FileResponse):
+    """
+    A FileResponse that doesn't look for precompressed versions of the file by itself. aiohttp
+    would serve them without checking whether they're up to date, so the negotiation is done
+    before creating the response instead.
+    """
+
+    async def prepare(self, request: Request) -> Optional[AbstractStreamWriter]:
+        headers = request.headers.copy()
+        headers.popall(hdrs.ACCEPT_ENCODING, None)
+        return await super().prepare(request.clone(headers=headers))
+
+
+def _is_fresh(compressed_path: Path, path: Path) -> bool:
+    try:
+        return compressed_path.stat().st_mtime_ns >= path.stat().st_mtime_ns
+    except OSError:
+        return False
+
+
+def _accepted_encodings(request: Request) -> Set[str]:
+    accepted = set()
+    for item in request.headers.get(hdrs.ACCEPT_ENCODING, "").split(","):
+        encoding, *params = item.strip().split(";")
+        if any(param.strip() in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def _cache_control(relative_path: str) -> str:
+    return (IMMUTABLE_CACHE_CONTROL if IMMUTABLE_PATH.match(relative_path)
+            else DEFAULT_CACHE_CONTROL)
+
+
+def precompress(directory: Union[str, PurePath], min_size: int = 1024) -> int:
+    """
+    Write .gz (and .br, if the brotli module is installed) versions of all compressible files
+    in the given directory. Files whose compressed versions are already up to date are skipped.
+
+    Returns:
+        The number of compressed files written.
+    """
+    compressors = {".gz": lambda data: gzip.compress(data, compresslevel=9)}
+    if brotli is not None:
+        compressors[".br"] = lambda data: brotli.compress(data, quality=11)
+    written = 0
+    for dirpath, _, filenames in os.walk(directory, followlinks=True):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            content_type, encoding = mimetypes.guess_type(filename)
+            if (encoding or not COMPRESSIBLE_TYPES.match(content_type or "")
+                    or path.stat().st_size < min_size):
+                continue
+            data = None
+            for suffix, compress in compressors.items():
+                target = path.with_name(filename + suffix)
+                if _is_fresh(target, path):
+                    continue
+                if data is None:
+                    data = path.read_bytes()
+                target.write_bytes(compress(data))
+                written += 1
+    return written
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # If-None-Match uses weak comparison, so W/ prefixes are ignored
+        if tag.startswith("W/"):
+            tag = tag[len("W/"):]
+        if tag == etag:
+            return True
+    return False
+
 
 class StaticResource(AbstractResource):
     def __init__(self, prefix: str, directory: Union[str, PurePath], *, name: Optional[str] = None,
-                 error_path: Optional[str] = "index.html", chunk_size: int = 256 * 1024) -> None:
+                 error_path: Optional[str] = "index.html", chunk_size: int = 256 * 1024,
+                 cache: bool = False, max_cached_file_size: int = 1024 * 1024) -> None:
         super().__init__(name=name)
         try:
             directory = Path(directory).resolve()
@@ -26,6 +146,9 @@ class StaticResource(AbstractResource):
         self._chunk_size = chunk_size
         self._prefix = prefix
         self._error_file = (directory / error_path) if error_path else None
+        self._cache: Optional[Dict[str, CachedFile]] = None
+        if cache:
+            self._cache = self._index_directory(max_cached_file_size)
 
         self._routes = {
             "GET": ResourceRoute("GET", self._handle, self),
@@ -83,19 +206,104 @@ class StaticResource(AbstractResource):
     def __iter__(self) -> Iterator[AbstractRoute]:
         return iter(self._routes.values())
 
+    def _index_directory(self, max_size: int) -> Dict[str, CachedFile]:
+        index = {}
+        for dirpath, _, filenames in os.walk(self._directory, followlinks=True):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                index[path.relative_to(self._directory).as_posix()] = _load_file(path, max_size)
+        for key, file in index.items():
+            for encoding, suffix in COMPRESSED_SUFFIXES.items():
+                compressed = index.get(key + suffix)
+                if (compressed and compressed.body is not None
+                        and _is_fresh(compressed.path, file.path)):
+                    file.compressed[encoding] = compressed
+        return index
+
+    def _respond_cached(self, request: Request, file: CachedFile, relative_path: str
+                        ) -> StreamResponse:
+        headers = {hdrs.CACHE_CONTROL: _cache_control(relative_path)}
+        if file.body is None:
+            # Large files are streamed from disk and FileResponse handles validators for them
+            return _FileResponse(file.path, chunk_size=self._chunk_size, headers=headers)
+        if file.compressed:
+            headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+            accepted = _accepted_encodings(request)
+            for encoding, compressed in file.compressed.items():
+                if encoding in accepted:
+                    headers[hdrs.CONTENT_ENCODING] = encoding
+                    file = compressed._replace(content_type=file.content_type)
+                    break
+        headers[hdrs.ETAG] = file.etag
+        headers[hdrs.LAST_MODIFIED] = file.last_modified
+        if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, file.etag)
+        else:
+            if_modified_since = request.if_modified_since
+            not_modified = (if_modified_since is not None
+                            and if_modified_since.timestamp() >= file.mtime)
+        if not_modified:
+            return Response(status=304, headers=headers)
+        return Response(body=file.body, content_type=file.content_type, headers=headers)
+
+    def _handle_cached(self, request: Request) -> StreamResponse:
+        relative_path = request.match_info["filename"].lstrip("/")
+        try:
+            file = self._cache[relative_path]
+        except KeyError:
+            try:
+                relative_path = self._error_file.relative_to(self._directory).as_posix()
+                file = self._cache[relative_path]
+            except (AttributeError, KeyError):
+                raise HTTPNotFound()
+        return self._respond_cached(request, file, relative_path)
+
+    def _file_response(self, request: Request, filepath: Path) -> FileResponse:
+        relative_path = filepath.relative_to(self._directory).as_posix()
+        headers = {hdrs.CACHE_CONTROL: _cache_control(relative_path)}
+        accepted = _accepted_encodings(request)
+        for encoding, suffix in COMPRESSED_SUFFIXES.items():
+            if encoding not in accepted:
+                continue
+            compressed_path = filepath.with_name(filepath.name + suffix)
+            if compressed_path.is_file() and _is_fresh(compressed_path, filepath):
+                headers[hdrs.CONTENT_ENCODING] = encoding
+                headers[hdrs.CONTENT_TYPE] = (mimetypes.guess_type(str(filepath))[0]
+                                              or "application/octet-stream")
+                headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+                return FileResponse(compressed_path, chunk_size=self._chunk_size,
+                                    headers=headers)
+        return _FileResponse(filepath, chunk_size=self._chunk_size, headers=headers)
+
     async def _handle(self, request: Request) -> StreamResponse:
+        if self._cache is not None:
+            return self._handle_cached(request)
         try:
             filename = Path(request.match_info["filename"])
             if not filename.anchor:
                 filepath = (self._directory / filename).resolve()
+                # relative_to raises a ValueError if the path escapes the directory
+                filepath.relative_to(self._directory)
                 if filepath.is_file():
-                    return FileResponse(filepath, chunk_size=self._chunk_size)
+                    return self._file_response(request, filepath)
         except (ValueError, FileNotFoundError):
             pass
         except Exception:
             request.app.logger.exception("Error while trying to serve static file")
-        return FileResponse(self._error_file, chunk_size=self._chunk_size)
+        return self._file_response(request, self._error_file)
 
     def __repr__(self) -> str:
         name = f"'{self.name}'" if self.name is not None else ""
         return f"<StaticResource {name} {self._prefix} -> {self._directory!r}>"
+
+
+if __name__ == "__main__":
+    import sys
+
+    from pkg_resources import resource_filename
+
+    logging.basicConfig(level=logging.INFO)
+    resource_dir = (sys.argv[1] if len(sys.argv) > 1
+                    else resource_filename("mautrix_manager", "frontend"))
+    log.info(f"Wrote {precompress(resource_dir)} precompressed files in {resource_dir}")
@@ -0,0 +1,3 @@
+from .ttl_cache import TTLCache
+from .circuit_breaker import CircuitBreaker, BreakerState
+from .singleflight import SingleFlight
@@ -0,0 +1,104 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional, Callable, Dict, Any
+from enum import Enum
+import time
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker that stops requests to a backend after repeated failures.
+
+    The breaker opens after ``failure_threshold`` consecutive failures. While open, requests are
+    rejected until ``reset_timeout`` has passed, after which it's half-open and lets a single
+    trial request through. A successful trial closes the breaker and a failed one reopens it.
+    """
+
+    failure_threshold: int
+    reset_timeout: float
+    state: BreakerState
+    failures: int
+    opened_at: float
+    last_failure: Optional[str]
+    on_state_change: Optional[Callable[[BreakerState], None]]
+    _trial_started: float
+
+    def __init__(self, failure_threshold: int, reset_timeout: float,
+                 on_state_change: Optional[Callable[[BreakerState], None]] = None) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.last_failure = None
+        self._trial_started = 0
+
+    def _set_state(self, state: BreakerState) -> None:
+        if state != self.state:
+            self.state = state
+            if self.on_state_change:
+                self.on_state_change(state)
+
+    def allow_request(self) -> bool:
+        if self.state == BreakerState.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == BreakerState.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(BreakerState.HALF_OPEN)
+        # Only one trial request at a time. If the trial never reports back (e.g. because the
+        # client disconnected), another one is allowed after the reset timeout.
+        if self._trial_started and now - self._trial_started < self.reset_timeout:
+            return False
+        self._trial_started = now
+        return True
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until the next request will be allowed through."""
+        if self.state == BreakerState.CLOSED:
+            return 0
+        start = self._trial_started if self.state == BreakerState.HALF_OPEN else self.opened_at
+        return max(start + self.reset_timeout - time.monotonic(), 0)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._trial_started = 0
+        self._set_state(BreakerState.CLOSED)
+
+    def record_failure(self, reason: Optional[str] = None) -> None:
+        self.failures += 1
+        self.last_failure = reason
+        if self.state == BreakerState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._trial_started = 0
+            self._set_state(BreakerState.OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state.value,
+            "failures": self.failures,
+            "last_failure": self.last_failure,
+            "retry_after": round(self.retry_after, 1),
+        }
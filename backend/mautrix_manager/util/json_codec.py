@@ -0,0 +1,72 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Optional, Mapping, Union
+import json
+
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass of this, so it works with both decoders.
+JSONDecodeError = json.JSONDecodeError
+
+_use_orjson = False
+
+
+def use_orjson(enabled: bool) -> bool:
+    """Enable or disable orjson. Returns whether it's actually in use."""
+    global _use_orjson
+    _use_orjson = enabled and orjson is not None
+    return _use_orjson
+
+
+def dumps_bytes(data: Any) -> bytes:
+    if _use_orjson:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # Things orjson refuses to encode, like integers over 64 bits or non-string keys
+            pass
+    return json.dumps(data).encode("utf-8")
+
+
+def dumps(data: Any) -> str:
+    if _use_orjson:
+        try:
+            return orjson.dumps(data).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(data)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if _use_orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def read_json(request: web.Request) -> Any:
+    """Read the body of an incoming request as JSON."""
+    return loads(await request.read())
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Mapping[str, str]] = None
+                  ) -> web.Response:
+    return web.Response(body=dumps_bytes(data), status=status, headers=headers,
+                        content_type="application/json")
@@ -0,0 +1,62 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Generic, TypeVar, Dict, Callable, Awaitable, Tuple
+import asyncio
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Deduplicates concurrent calls: while a call for a key is in progress, other calls with the
+    same key wait for its result instead of starting a new call.
+
+    The call runs in a separate task, so cancelling any of the callers (including the one that
+    started it) doesn't cancel the call for the others.
+    """
+
+    _calls: Dict[K, asyncio.Future]
+
+    def __init__(self) -> None:
+        self._calls = {}
+
+    def _done(self, key: K, fut: asyncio.Future) -> None:
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            # Mark the exception as retrieved in case all callers were cancelled
+            fut.exception()
+
+    async def do(self, key: K, fn: Callable[[], Awaitable[V]]) -> Tuple[V, bool]:
+        """
+        Call ``fn`` or wait for an in-progress call with the same key.
+
+        Returns:
+            The result and whether it was shared with another caller.
+        """
+        try:
+            fut = self._calls[key]
+            shared = True
+        except KeyError:
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda _: self._done(key, fut))
+            shared = False
+        return await asyncio.shield(fut), shared
+
+    def __len__(self) -> int:
+        return len(self._calls)
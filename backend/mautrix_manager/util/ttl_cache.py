@@ -0,0 +1,107 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Generic, TypeVar, Tuple, Optional, Dict, Any, Callable
+from collections import OrderedDict
+import time
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    A size-bounded LRU cache where every entry also expires after a fixed time.
+
+    Expired entries are dropped lazily when they're looked up or when they reach the LRU end of
+    the cache, so there's no need for a background cleanup task. ``on_remove`` is called with
+    the key of every entry that is dropped because it expired or was evicted.
+    """
+
+    max_size: int
+    ttl: float
+    on_remove: Optional[Callable[[K], None]]
+    hits: int
+    misses: int
+    _data: 'OrderedDict[K, Tuple[float, V]]'
+
+    def __init__(self, max_size: int, ttl: float,
+                 on_remove: Optional[Callable[[K], None]] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: K, default: Any = None) -> Optional[V]:
+        try:
+            expiry, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expiry < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            if self.on_remove:
+                self.on_remove(key)
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        if self.max_size <= 0:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            evicted, _ = self._data.popitem(last=False)
+            if self.on_remove:
+                self.on_remove(evicted)
+
+    def pop(self, key: K, default: Any = None) -> Optional[V]:
+        try:
+            expiry, value = self._data.pop(key)
+        except KeyError:
+            return default
+        return value if expiry >= time.monotonic() else default
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        try:
+            expiry, _ = self._data[key]
+        except KeyError:
+            return False
+        return expiry >= time.monotonic()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+        }
@@ -0,0 +1,164 @@
+# mautrix-manager - A web interface for managing bridges
+# Copyright (C) 2020 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Deque, Optional
+from collections import deque, defaultdict
+import logging.config
+import logging
+import copy
+import signal
+import socket
+import time
+import sys
+import os
+
+from .config import Config
+
+# Workers that crash this many times within CRASH_WINDOW seconds aren't restarted anymore
+MAX_CRASHES = 5
+CRASH_WINDOW = 60
+RESTART_DELAY = 1
+
+# 0 in the supervisor process and when running without workers, otherwise 1 to N
+worker_id: int = 0
+# When listening on a unix socket, the supervisor creates it and the workers inherit it, as
+# unix sockets can't be shared with SO_REUSEPORT.
+unix_socket: Optional[socket.socket] = None
+
+log = logging.getLogger("mau.workers")
+
+
+def is_worker() -> bool:
+    return worker_id > 0
+
+
+def _tag_log_records(wid: int) -> None:
+    """Add the worker ID to the logger name of every log record."""
+    make_record = logging.getLogRecordFactory()
+
+    def make_tagged_record(*args, **kwargs) -> logging.LogRecord:
+        record = make_record(*args, **kwargs)
+        record.name = f"{record.name}[{wid}]"
+        record.worker_id = wid
+        return record
+
+    logging.setLogRecordFactory(make_tagged_record)
+
+
+def _split_log_files(config: Config, wid: int) -> None:
+    """Reconfigure logging so that each worker writes to its own log files."""
+    log_config = copy.deepcopy(config["logging"])
+    changed = False
+    for handler in log_config.get("handlers", {}).values():
+        if handler.get("filename"):
+            base, ext = os.path.splitext(handler["filename"])
+            handler["filename"] = f"{base}-{wid}{ext}"
+            changed = True
+    if changed:
+        # File handlers can't be shared, as each process would rotate the files separately
+        logging.config.dictConfig(log_config)
+
+
+def _describe_exit(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return f"signal {os.WTERMSIG(status)}"
+    return f"exit code {os.WEXITSTATUS(status)}"
+
+
+def _create_unix_socket(path: str) -> socket.socket:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
+
+
+def start(config: Config, count: int) -> None:
+    """
+    Fork ``count`` worker processes and supervise them, restarting crashed ones. This only
+    returns in the worker processes. The supervisor exits when all workers have stopped.
+
+    This must be called before the asyncio event loop is created.
+    """
+    global unix_socket
+    if config["server.unix_socket"]:
+        unix_socket = _create_unix_socket(config["server.unix_socket"])
+
+    children: Dict[int, int] = {}
+    crashes: Dict[int, Deque[float]] = defaultdict(lambda: deque(maxlen=MAX_CRASHES))
+    stopping = False
+    failed = False
+
+    def fork(wid: int) -> bool:
+        global worker_id
+        pid = os.fork()
+        if pid == 0:
+            worker_id = wid
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _split_log_files(config, wid)
+            _tag_log_records(wid)
+            return True
+        children[pid] = wid
+        log.info(f"Started worker {wid} with PID {pid}")
+        return False
+
+    def stop(signum: int, _: object) -> None:
+        nonlocal stopping
+        if not stopping:
+            log.info("Stopping workers")
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for wid in range(1, count + 1):
+        if fork(wid):
+            return
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        wid = children.pop(pid, None)
+        if wid is None:
+            continue
+        elif stopping:
+            log.debug(f"Worker {wid} stopped with {_describe_exit(status)}")
+            continue
+        now = time.monotonic()
+        crashes[wid].append(now)
+        if len(crashes[wid]) == MAX_CRASHES and now - crashes[wid][0] < CRASH_WINDOW:
+            log.critical(f"Worker {wid} crashed {MAX_CRASHES} times in {CRASH_WINDOW} seconds, "
+                         "stopping")
+            failed = True
+            stop(signal.SIGTERM, None)
+            continue
+        log.warning(f"Worker {wid} exited with {_describe_exit(status)}, restarting")
+        time.sleep(RESTART_DELAY)
+        if stopping:
+            continue
+        if fork(wid):
+            return
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+import struct
+
+from aiohttp import web
+import pytest
+
+from mautrix_manager.api.docker_logs import (LogDemuxer, LogLine, to_docker_timestamp,
+                                             _timestamp_key)
+
+
+def frame(stream: int, payload: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream, len(payload)) + payload
+
+
+def feed_chunks(demuxer: LogDemuxer, data: bytes, size: int) -> list:
+    lines = []
+    for i in range(0, len(data), size):
+        lines += demuxer.feed(data[i:i + size])
+    return lines + demuxer.flush()
+
+
+def test_frames_split_across_chunks():
+    data = (frame(1, b"2020-01-01T00:00:00Z first line\n")
+            + frame(1, b"2020-01-01T00:00:01Z second ")
+            + frame(1, b"line\n2020-01-01T00:00:02Z third line\n"))
+    expected = [
+        LogLine("stdout", "2020-01-01T00:00:00Z", "first line"),
+        LogLine("stdout", "2020-01-01T00:00:01Z", "second line"),
+        LogLine("stdout", "2020-01-01T00:00:02Z", "third line"),
+    ]
+    # Every chunk size splits the headers and payloads at different points
+    for size in range(1, len(data) + 1):
+        assert feed_chunks(LogDemuxer(tty=False), data, size) == expected
+
+
+def test_interleaved_streams():
+    data = (frame(1, b"2020-01-01T00:00:00Z out ")
+            + frame(2, b"2020-01-01T00:00:01Z err line\n")
+            + frame(1, b"line\n"))
+    lines = feed_chunks(LogDemuxer(tty=False), data, 3)
+    assert lines == [
+        LogLine("stderr", "2020-01-01T00:00:01Z", "err line"),
+        LogLine("stdout", "2020-01-01T00:00:00Z", "out line"),
+    ]
+
+
+def test_tty_stream():
+    data = b"2020-01-01T00:00:00Z \x1b[32mcolored\x1b[0m\r\n2020-01-01T00:00:01Z unterminated"
+    lines = feed_chunks(LogDemuxer(tty=True), data, 5)
+    assert lines == [
+        LogLine("stdout", "2020-01-01T00:00:00Z", "\x1b[32mcolored\x1b[0m"),
+        LogLine("stdout", "2020-01-01T00:00:01Z", "unterminated"),
+    ]
+
+
+def test_split_multibyte_character():
+    data = frame(1, "2020-01-01T00:00:00Z ä\n".encode("utf-8"))
+    lines = feed_chunks(LogDemuxer(tty=False), data, len(data) - 2)
+    assert lines == [LogLine("stdout", "2020-01-01T00:00:00Z", "ä")]
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("1577836800", "1577836800"),
+    ("1577836800.5", "1577836800.5"),
+    ("2020-01-01T00:00:00Z", "1577836800"),
+    ("2020-01-01T00:00:00.123456789Z", "1577836800.123456789"),
+    ("2020-01-01T02:30:00+02:30", "1577836800"),
+    ("2019-12-31T23:00:00.5-01:00", "1577836800.5"),
+])
+def test_to_docker_timestamp(value: str, expected: str):
+    assert to_docker_timestamp(value) == expected
+
+
+@pytest.mark.parametrize("value", ["yesterday", "2020-01-01", "2020-01-01T00:00:00",
+                                   "2020-01-01T00:00:00.1234567891Z"])
+def test_to_docker_timestamp_invalid(value: str):
+    with pytest.raises(web.HTTPBadRequest):
+        to_docker_timestamp(value)
+
+
+def test_timestamp_key_order():
+    timestamps = ["2020-01-01T00:00:00.9Z", "2020-01-01T00:00:00.10Z",
+                  "2020-01-01T01:00:00+01:00", "2020-01-01T00:00:01Z"]
+    assert sorted(timestamps, key=_timestamp_key) == [
+        "2020-01-01T01:00:00+01:00",
+        "2020-01-01T00:00:00.10Z",
+        "2020-01-01T00:00:00.9Z",
+        "2020-01-01T00:00:01Z",
+    ]
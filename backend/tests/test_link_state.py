@@ -0,0 +1,67 @@
+from typing import Awaitable, TypeVar
+import asyncio
+
+import pytest
+
+from mautrix_manager.api import link_state
+from mautrix_manager.api.link_state import MemoryLinkStateStore, get_user_token, get_token_user
+
+T = TypeVar("T")
+
+
+def run(coro: Awaitable[T]) -> T:
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def store(monkeypatch) -> MemoryLinkStateStore:
+    store = MemoryLinkStateStore(ttl=60, max_size=4)
+    monkeypatch.setattr(link_state, "store", store, raising=False)
+    return store
+
+
+def test_user_token_round_trip(store):
+    token = run(get_user_token("test", "@a:example.com"))
+    assert run(get_user_token("test", "@a:example.com")) == token
+    assert run(get_token_user("test", token)) == "@a:example.com"
+
+
+def test_evicted_token_takes_user_entry_with_it(store):
+    token_a = run(get_user_token("test", "@a:example.com"))
+    # Refresh only the user entry of @a, so that its token entry is the least recently used
+    assert run(store.get("test", "user:@a:example.com")) == token_a
+    run(get_user_token("test", "@b:example.com"))
+    # The cache is full, so this evicts the token entry of @a
+    run(store.set("other", "key", "value"))
+
+    assert run(get_token_user("test", token_a)) is None
+    assert run(store.get("test", "user:@a:example.com")) is None
+    # @a gets a new token that works, instead of the one that can't be resolved anymore
+    new_token_a = run(get_user_token("test", "@a:example.com"))
+    assert new_token_a != token_a
+    assert run(get_token_user("test", new_token_a)) == "@a:example.com"
+
+
+def test_evicted_user_takes_token_entry_with_it(store):
+    token_a = run(get_user_token("test", "@a:example.com"))
+    # Refresh only the token entry of @a, so that its user entry is the least recently used
+    assert run(get_token_user("test", token_a)) == "@a:example.com"
+    run(get_user_token("test", "@b:example.com"))
+    run(store.set("other", "key", "value"))
+
+    assert run(store.get("test", "user:@a:example.com")) is None
+    assert run(get_token_user("test", token_a)) is None
+
+
+def test_old_link_doesnt_drop_new_entries(store):
+    store.link("test", "user:@a:example.com", "token:old")
+    store.link("test", "user:@a:example.com", "token:new")
+    run(store.set("test", "user:@a:example.com", "new"))
+    run(store.set("test", "token:new", "@a:example.com"))
+    store._removed(("test", "token:old"))
+    assert run(store.get("test", "user:@a:example.com")) == "new"
+    assert run(store.get("test", "token:new")) == "@a:example.com"
@@ -0,0 +1,140 @@
+from typing import Any, Awaitable, List, Tuple, TypeVar
+import asyncio
+
+import pytest
+
+from mautrix_manager.database import token as token_module
+from mautrix_manager.database.token import Token
+from mautrix_manager.util import TTLCache
+
+T = TypeVar("T")
+
+
+def run(coro: Awaitable[T]) -> T:
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class FakeDatabase:
+    calls: List[Tuple[str, Tuple[Any, ...]]]
+    fail: bool
+    fetch_results: List[List[dict]]
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.fail = False
+        self.fetch_results = []
+
+    async def execute(self, query: str, *args: Any) -> str:
+        self.calls.append((query, args))
+        if self.fail:
+            raise ConnectionError("database is down")
+        return "UPDATE 3"
+
+    async def fetch(self, query: str, *args: Any) -> List[dict]:
+        self.calls.append((query, args))
+        return self.fetch_results.pop(0)
+
+
+@pytest.fixture
+def db(monkeypatch) -> FakeDatabase:
+    db = FakeDatabase()
+    monkeypatch.setattr(Token, "db", db, raising=False)
+    monkeypatch.setattr(Token, "cache", TTLCache(max_size=100, ttl=60))
+    monkeypatch.setattr(Token, "_pending_touches", {})
+    Token.init_expiry(lifetime=3600, touch_interval=60)
+    yield db
+    Token.init_expiry(lifetime=0, touch_interval=0)
+
+
+@pytest.fixture
+def now(monkeypatch) -> List[int]:
+    current = [1_000_000_000]
+    monkeypatch.setattr(token_module, "_now", lambda: current[0])
+    return current
+
+
+def make_token(secret: str, last_used_at: int) -> Token:
+    return Token(user_id="@user:example.com", secret=secret, created_at=0,
+                 last_used_at=last_used_at, expires_at=last_used_at + Token.lifetime)
+
+
+def test_touch_coalesces(db, now):
+    token = make_token("a", now[0])
+    now[0] += 30_000
+    token.touch()
+    # Used again within the touch interval, nothing to save
+    assert Token._pending_touches == {}
+
+    now[0] += 60_000
+    token.touch()
+    first = now[0]
+    assert Token._pending_touches == {"a": (first, first + 3_600_000)}
+
+    now[0] += 10_000
+    token.touch()
+    assert Token._pending_touches == {"a": (first, first + 3_600_000)}
+
+    now[0] += 60_000
+    token.touch()
+    assert Token._pending_touches == {"a": (now[0], now[0] + 3_600_000)}
+
+
+def test_flush_touches(db, now):
+    Token._pending_touches = {"a": (1, 2), "b": (3, 4)}
+    assert run(Token.flush_touches()) == 2
+    assert Token._pending_touches == {}
+    (_, args), = db.calls
+    assert args == (["a", "b"], [1, 3], [2, 4])
+    # Nothing pending, no query
+    assert run(Token.flush_touches()) == 0
+    assert len(db.calls) == 1
+
+
+def test_failed_flush_keeps_touches(db, now):
+    Token._pending_touches = {"a": (1, 2), "b": (3, 4)}
+    db.fail = True
+    original_execute = db.execute
+
+    async def execute_and_touch(query: str, *args: Any) -> str:
+        # A newer touch that happens while the flush is running must not be overwritten
+        Token._pending_touches["b"] = (5, 6)
+        return await original_execute(query, *args)
+
+    db.execute = execute_and_touch
+    with pytest.raises(ConnectionError):
+        run(Token.flush_touches())
+    assert Token._pending_touches == {"a": (1, 2), "b": (5, 6)}
+
+    db.execute = original_execute
+    db.fail = False
+    assert run(Token.flush_touches()) == 2
+    secrets, last_used, expires = db.calls[-1][1]
+    assert dict(zip(secrets, zip(last_used, expires))) == {"a": (1, 2), "b": (5, 6)}
+    assert Token._pending_touches == {}
+
+
+def test_apply_lifetime(db):
+    Token.cache.set("a", make_token("a", 0))
+    assert run(Token.apply_lifetime()) == 3
+    query, args = db.calls[-1]
+    assert "expires_at=last_used_at+$1" in query and args == (3_600_000,)
+    assert Token.cache.get("a") is None
+
+    Token.init_expiry(lifetime=0, touch_interval=0)
+    assert run(Token.apply_lifetime()) == 3
+    query, args = db.calls[-1]
+    assert "expires_at=NULL" in query and args == ()
+
+
+def test_delete_expired_in_batches(db, now):
+    Token.cache.set("a", make_token("a", 0))
+    Token._pending_touches = {"c": (1, 2)}
+    db.fetch_results = [[{"secret": "a"}, {"secret": "b"}], [{"secret": "c"}]]
+    assert run(Token.delete_expired(batch_size=2)) == 3
+    assert [args for _, args in db.calls] == [(now[0], 2), (now[0], 2)]
+    assert Token.cache.get("a") is None
+    assert Token._pending_touches == {}
@@ -0,0 +1,63 @@
+// mautrix-manager - A web interface for managing bridges
+// Copyright (C) 2020 Tulir Asokan
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU Affero General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU Affero General Public License for more details.
+//
+// You should have received a copy of the GNU Affero General Public License
+// along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import { tryFetch, apiPrefix } from "./tryGet.js"
+
+let statusPromise = null
+const usedInitialStatus = new Set()
+
+// Fetches the info and user status of all enabled bridges in one request.
+export const fetchStatus = () => {
+    if (!statusPromise) {
+        statusPromise = tryFetch(`${apiPrefix}/bridges/status`, {}, {
+            service: "mautrix-manager",
+            requestType: "bridge status",
+        }).catch(err => {
+            statusPromise = null
+            throw err
+        })
+    }
+    return statusPromise
+}
+
+const getBridgeStatus = async bridge => {
+    try {
+        return (await fetchStatus())[bridge] || null
+    } catch (err) {
+        return null
+    }
+}
+
+// Returns the info that would be returned by the /api/<bridge> endpoint,
+// or calls the fallback if the aggregated status isn't available.
+export const getBridgeInfo = async (bridge, fallback) => {
+    const bridgeStatus = await getBridgeStatus(bridge)
+    return bridgeStatus ? bridgeStatus.info : fallback()
+}
+
+// Returns the prefetched user status the first time it's called for each bridge.
+// Later calls and failed prefetches use the fallback to get fresh data with proper errors.
+export const takeInitialStatus = async (bridge, fallback) => {
+    if (usedInitialStatus.has(bridge)) {
+        return fallback()
+    }
+    usedInitialStatus.add(bridge)
+    const bridgeStatus = await getBridgeStatus(bridge)
+    if (!bridgeStatus || bridgeStatus.error || bridgeStatus.status_code >= 400) {
+        return fallback()
+    }
+    return bridgeStatus.status
+}
@@ -15,18 +15,14 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import { apiPrefix, tryFetch } from "./tryGet.js"
 
-const baseURL = `${apiPrefix}/docker/v1.35`
 const service = "Docker"
 
 export const findContainerByName = async (container) => {
-    const data = await tryFetch(`${baseURL}/containers/json`, {
+    // The manager keeps an index of containers, so this doesn't hit the Docker daemon
+    const data = await tryFetch(`${apiPrefix}/docker/containers`, {
         query: {
-            all: true,
-            filters: {
-                name: [`/${container}`],
-            },
+            name: container,
         },
-        contentType: "application/json",
     }, {
         service,
         requestType: "container find",
@@ -41,29 +37,97 @@ export const findContainerByName = async (container) => {
     return data[0]
 }
 
-export const startContainer = async id => await tryFetch(`${baseURL}/containers/${id}/start`, {
-    method: "POST",
-}, {
-    service,
-    requestType: "container start",
-})
+export const watchContainers = (onUpdate, onRemove, onReset) => {
+    const source = new EventSource(`${apiPrefix}/docker/containers/events?access_token=${
+        localStorage.accessToken}`)
+    // Sent with the full container list whenever the stream is (re)connected
+    source.addEventListener("reset", evt => onReset(JSON.parse(evt.data)))
+    source.addEventListener("update", evt => onUpdate(JSON.parse(evt.data)))
+    source.addEventListener("remove", evt => onRemove(JSON.parse(evt.data)))
+    return () => source.close()
+}
+
+export const watchStats = (containers, onStats) => {
+    const source = new EventSource(`${apiPrefix}/docker/stats?containers=${
+        containers.join(",")}&access_token=${localStorage.accessToken}`)
+    source.addEventListener("stats", evt => onStats(JSON.parse(evt.data)))
+    return () => source.close()
+}
+
+export const createJob = async (action, containers, { timeout, wait = false } = {}) =>
+    await tryFetch(`${apiPrefix}/docker/jobs`, {
+        method: "POST",
+        body: JSON.stringify({ action, containers, timeout, wait }),
+        headers: {
+            "Content-Type": "application/json",
+        },
+    }, {
+        service,
+        requestType: `container ${action}`,
+    })
 
-export const stopContainer = async id => await tryFetch(`${baseURL}/containers/${id}/stop`, {
-    method: "POST",
-}, {
-    service,
-    requestType: "container stop",
-    raw: true,
+export const watchJob = (id, onProgress) => new Promise((resolve, reject) => {
+    const source = new EventSource(`${apiPrefix}/docker/jobs/${id}/events?access_token=${
+        localStorage.accessToken}`)
+    source.addEventListener("progress", evt => onProgress && onProgress(JSON.parse(evt.data)))
+    source.addEventListener("done", evt => {
+        source.close()
+        resolve(JSON.parse(evt.data))
+    })
+    source.onerror = () => {
+        source.close()
+        reject(new Error("Lost connection while waiting for container action to finish"))
+    }
 })
 
-const bytesToUInt32 = bytes => (bytes[0] << 24) + (bytes[1] << 16) + (bytes[2] << 8) + bytes[3]
+const runAction = async (action, id) => {
+    let result = await createJob(action, [id])
+    // With multiple manager workers, the job is already finished when it's returned
+    if (result.finished_at === null) {
+        result = await watchJob(result.id)
+    }
+    const { error } = result.containers[id]
+    if (error) {
+        throw new Error(`Failed to ${action} container: ${error}`)
+    }
+}
+
+export const startContainer = id => runAction("start", id)
+
+export const stopContainer = id => runAction("stop", id)
+
+export const restartContainer = id => runAction("restart", id)
+
+export const searchLogs = async (id, { query, level, context = 2 }) => {
+    const resp = await tryFetch(`${apiPrefix}/docker/logs/${id}/search`, {
+        query: {
+            q: query,
+            level,
+            context,
+            ignore_case: true,
+        },
+    }, {
+        service,
+        requestType: "log search",
+        raw: true,
+    })
+    if (resp.status !== 200) {
+        throw new Error(`Log search failed: ${await resp.text()}`)
+    }
+    const entries = (await resp.text()).split("\n")
+        .filter(entry => entry)
+        .map(entry => JSON.parse(entry))
+    return {
+        lines: entries.filter(entry => !entry.done),
+        summary: entries.find(entry => entry.done),
+    }
+}
 
 export const streamLogs = async (id, tail = 100) => {
-    const resp = await tryFetch(`${baseURL}/containers/${id}/logs`, {
+    // The manager demultiplexes the Docker log stream and sends one JSON object per line
+    const resp = await tryFetch(`${apiPrefix}/docker/logs/${id}`, {
         query: {
             follow: true,
-            stdout: true,
-            stderr: true,
             tail,
         },
     }, {
@@ -79,25 +143,19 @@ export const streamLogs = async (id, tail = 100) => {
             await reader.cancel()
         },
         async * read() {
+            let buffer = ""
             let done = false
             while (!done) {
                 const chunk = await reader.read()
                 if (chunk.value) {
-                    let offset = 0
-                    while (offset < chunk.value.length) {
-                        //const type = chunk.value[offset]
-                        if (chunk.value[offset + 1] !== 0 ||
-                            chunk.value[offset + 2] !== 0 ||
-                            chunk.value[offset + 3] !== 0) {
-                            console.error("Invalid docker log header in", chunk)
-                            break
-                        }
-                        const length = bytesToUInt32(chunk.value.slice(offset + 4, offset + 8))
-                        if (chunk.value.length < offset + 8 + length) {
-                            console.error("Unexpectedly small chunk:", offset, length, chunk.value.length)
-                        }
-                        yield decoder.decode(chunk.value.slice(offset + 8, offset + 8 + length))
-                        offset += 8 + length
+                    buffer += decoder.decode(chunk.value, { stream: true })
+                    const entries = buffer.split("\n")
+                    buffer = entries.pop()
+                    const lines = entries
+                        .filter(entry => entry)
+                        .map(entry => JSON.parse(entry).line)
+                    if (lines.length > 0) {
+                        yield lines.join("\n")
                     }
                 }
                 done = chunk.done
@@ -15,6 +15,7 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { getBridgeInfo, takeInitialStatus } from "./bridges.js"
 
 const service = "Facebook bridge"
 const prefix = `${apiPrefix}/mautrix-facebook`
@@ -22,18 +23,19 @@ export let domain = null
 
 export const initClientInfo = async () => {
     if (!domain) {
-        const resp = await tryFetch(prefix, {}, {
+        const resp = await getBridgeInfo("mautrix-facebook", () => tryFetch(prefix, {}, {
             service,
             requestType: "bridge status",
-        })
+        }))
         domain = resp.domain
     }
 }
 
-export const whoami = () => tryFetch(`${prefix}/whoami`, {}, {
-    service,
-    requestType: "user info",
-})
+export const whoami = () => takeInitialStatus("mautrix-facebook", () => tryFetch(
+    `${prefix}/whoami`, {}, {
+        service,
+        requestType: "user info",
+    }))
 
 export const logout = () => tryFetch(`${prefix}/logout`, { method: "POST" }, {
     service,
@@ -15,14 +15,16 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { takeInitialStatus } from "./bridges.js"
 
 const service = "Hangouts bridge"
 const prefix = `${apiPrefix}/mautrix-hangouts`
 
-export const whoami = () => tryFetch(`${prefix}/whoami`, {}, {
-    service,
-    requestType: "user info",
-})
+export const whoami = () => takeInitialStatus("mautrix-hangouts", () => tryFetch(
+    `${prefix}/whoami`, {}, {
+        service,
+        requestType: "user info",
+    }))
 
 export const logout = () => tryFetch(`${prefix}/logout`, { method: "POST" }, {
     service,
@@ -15,14 +15,16 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { takeInitialStatus } from "./bridges.js"
 
 const service = "Instagram bridge"
 const prefix = `${apiPrefix}/mx-puppet-instagram`
 
-export const status = () => tryFetch(`${prefix}/status`, {}, {
-    service,
-    requestType: "status",
-})
+export const status = () => takeInitialStatus("mx-puppet-instagram", () => tryFetch(
+    `${prefix}/status`, {}, {
+        service,
+        requestType: "status",
+    }))
 
 export const login = (endpoint, payload) => tryFetch(`${prefix}${endpoint}`, {
     method: "POST",
@@ -15,6 +15,7 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { getBridgeInfo, takeInitialStatus } from "./bridges.js"
 
 const service = "Twitter bridge"
 const prefix = `${apiPrefix}/mx-puppet-twitter`
@@ -22,17 +23,18 @@ let customRedirectURI = null
 export let useStaticLinking = false
 export let staticLinkStartToken = null
 
-export const status = () => tryFetch(`${prefix}/status`, {}, {
-    service,
-    requestType: "status",
-})
+export const status = () => takeInitialStatus("mx-puppet-twitter", () => tryFetch(
+    `${prefix}/status`, {}, {
+        service,
+        requestType: "status",
+    }))
 
 export const initClientInfo = async () => {
     if (!customRedirectURI) {
-        const resp = await tryFetch(prefix, {}, {
+        const resp = await getBridgeInfo("mx-puppet-twitter", () => tryFetch(prefix, {}, {
             service,
             requestType: "bridge status",
-        })
+        }))
         customRedirectURI = resp.custom_redirect_uri
         useStaticLinking = resp.static_linking_page
         staticLinkStartToken = resp.link_start_token
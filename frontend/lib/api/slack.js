@@ -15,6 +15,7 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix, queryToURL } from "./tryGet.js"
+import { getBridgeInfo, takeInitialStatus } from "./bridges.js"
 
 const service = "Slack bridge"
 const prefix = `${apiPrefix}/mx-puppet-slack`
@@ -22,17 +23,18 @@ let clientID = null
 let linkToken = null
 let customRedirectURI = null
 
-export const status = () => tryFetch(`${prefix}/status`, {}, {
-    service,
-    requestType: "status",
-})
+export const status = () => takeInitialStatus("mx-puppet-slack", () => tryFetch(
+    `${prefix}/status`, {}, {
+        service,
+        requestType: "status",
+    }))
 
 export const initClientInfo = async () => {
     if (!clientID) {
-        const resp = await tryFetch(prefix, {}, {
+        const resp = await getBridgeInfo("mx-puppet-slack", () => tryFetch(prefix, {}, {
             service,
             requestType: "bridge status",
-        })
+        }))
         clientID = resp.client_id
         linkToken = resp.link_token
         customRedirectURI = resp.custom_redirect_uri
@@ -15,6 +15,7 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { getBridgeInfo, takeInitialStatus } from "./bridges.js"
 
 const service = "Telegram bridge"
 const prefix = `${apiPrefix}/mautrix-telegram`
@@ -22,18 +23,19 @@ export let allowBotLogin = null
 
 export const initClientInfo = async () => {
     if (allowBotLogin === null) {
-        const resp = await tryFetch(prefix, {}, {
+        const resp = await getBridgeInfo("mautrix-telegram", () => tryFetch(prefix, {}, {
             service,
             requestType: "bridge status",
-        })
+        }))
         allowBotLogin = resp.allow_bot_login
     }
 }
 
-export const getMe = () => tryFetch(`${prefix}/user/me`, {}, {
-    service,
-    requestType: "user info",
-})
+export const getMe = () => takeInitialStatus("mautrix-telegram", () => tryFetch(
+    `${prefix}/user/me`, {}, {
+        service,
+        requestType: "user info",
+    }))
 
 export const logout = () => tryFetch(`${prefix}/user/me/logout`, { method: "POST" }, {
     service,
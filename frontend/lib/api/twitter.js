@@ -15,14 +15,16 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { takeInitialStatus } from "./bridges.js"
 
 const service = "Twitter bridge"
 const prefix = `${apiPrefix}/mautrix-twitter`
 
-export const whoami = () => tryFetch(`${prefix}/whoami`, {}, {
-    service,
-    requestType: "user info",
-})
+export const whoami = () => takeInitialStatus("mautrix-twitter", () => tryFetch(
+    `${prefix}/whoami`, {}, {
+        service,
+        requestType: "user info",
+    }))
 
 export const logout = () => tryFetch(`${prefix}/logout`, { method: "POST" }, {
     service,
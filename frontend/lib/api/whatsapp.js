@@ -15,14 +15,16 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { tryFetch, apiPrefix } from "./tryGet.js"
+import { takeInitialStatus } from "./bridges.js"
 
 const service = "WhatsApp bridge"
 const prefix = `${apiPrefix}/mautrix-whatsapp`
 
-export const ping = () => tryFetch(`${prefix}/ping`, {}, {
-    service,
-    requestType: "ping",
-})
+export const ping = () => takeInitialStatus("mautrix-whatsapp", () => tryFetch(
+    `${prefix}/ping`, {}, {
+        service,
+        requestType: "ping",
+    }))
 
 const makeSimplePost = endpoint => () => tryFetch(`${prefix}/${endpoint}`, {
     method: "POST",
@@ -21,6 +21,7 @@ import { checkTrackingEnabled } from "../lib/api/tracking.js"
 import { makeStyles } from "../lib/theme.js"
 import { logout } from "../lib/api/login.js"
 import * as config from "../lib/api/config.js"
+import { fetchStatus } from "../lib/api/bridges.js"
 import InstagramBridge from "./bridges/Instagram.js"
 import SlackBridge from "./bridges/Slack.js"
 import TelegramBridge from "./bridges/Telegram.js"
@@ -129,6 +130,7 @@ const Main = () => {
     useEffect(() => {
         if (loggedIn) {
             checkTrackingEnabled()
+            fetchStatus().catch(err => console.error("Error fetching bridge status:", err))
             config.update().then(res => setDockerControls(res.docker_controls))
         }
         window.addEventListener("mautrix-cookie-monster-appeared", handleExtension)
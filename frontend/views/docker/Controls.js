@@ -61,11 +61,22 @@ const nameMap = {
     "/instagram": "mx-puppet-instagram",
 }
 
+const formatBytes = bytes => {
+    const units = ["B", "KiB", "MiB", "GiB"]
+    let unit = 0
+    while (bytes >= 1024 && unit < units.length - 1) {
+        bytes /= 1024
+        unit++
+    }
+    return `${bytes.toFixed(unit === 0 ? 0 : 1)} ${units[unit]}`
+}
+
 const DockerControls = () => {
     const classes = useStyles()
     const [container, setContainer] = useState(null)
     const [error, setError] = useState("")
     const [loading, setLoading] = useState(null)
+    const [stats, setStats] = useState(null)
     const [path] = useLocation()
     const { openModal } = useModal()
 
@@ -87,6 +98,42 @@ const DockerControls = () => {
         await updateContainerInfo()
     }, [containerName])
 
+    const containerID = container && container.Id
+    useEffect(() => {
+        if (!containerID) {
+            return undefined
+        }
+        const onUpdate = updated => {
+            if (updated.Id === containerID) {
+                setContainer(updated)
+            }
+        }
+        const onRemove = removed => {
+            if (removed.Id === containerID) {
+                setError(`Container ${containerName} removed`)
+                setContainer(null)
+            }
+        }
+        const onReset = containers => {
+            const current = containers.find(item => item.Id === containerID)
+            if (current) {
+                setContainer(current)
+            } else {
+                onRemove({ Id: containerID })
+            }
+        }
+        return api.watchContainers(onUpdate, onRemove, onReset)
+    }, [containerID])
+
+    const isRunning = Boolean(container && container.State === "running")
+    useEffect(() => {
+        setStats(null)
+        if (!containerID || !isRunning) {
+            return undefined
+        }
+        return api.watchStats([containerID], setStats)
+    }, [containerID, isRunning])
+
     if (!containerName) {
         return null
     } else if (!container) {
@@ -131,6 +178,11 @@ const DockerControls = () => {
     return html`
         <section class=${classes.root}>
             Docker status for ${container.Names[0].substr(1)}: ${container.Status}
+            ${stats && stats.cpu_percent !== undefined && html`<div>
+                CPU: ${stats.cpu_percent.toFixed(1)}%,
+                memory: ${formatBytes(stats.memory)} / ${formatBytes(stats.memory_limit)},
+                network: ${formatBytes(stats.net_rx)}/s in, ${formatBytes(stats.net_tx)}/s out
+            </div>`}
             <div>
                 <${Button} disabled=${isNotLoading("start") || container.State === "running"}
                            class=${classes.button} onClick=${start}>
@@ -30,11 +30,50 @@ const useStyles = makeStyles({
     loading: {
         padding: "1rem",
     },
+    wrapper: {
+        display: "flex",
+        flexDirection: "column",
+        height: "100%",
+    },
+    search: {
+        display: "flex",
+        padding: ".5rem",
+        "& > input": {
+            flex: 1,
+        },
+    },
+    hidden: {
+        display: "none",
+    },
+    match: {
+        fontWeight: "bold",
+    },
 }, { name: "docker-logs" })
 
+const SearchResults = ({ results, classes }) => {
+    if (results.error) {
+        return html`<pre class=${classes.root}>${results.error}</pre>`
+    }
+    const converter = new ANSIToHTML({ escapeHTML: true })
+    const { summary } = results
+    return html`<pre class=${classes.root}>
+        ${results.lines.map(entry => html`<div class=${entry.match ? classes.match : ""}
+            dangerouslySetInnerHTML=${{ __html: converter.toHtml(entry.line) }} />`)}
+        <div>
+            ${summary.matches} matches in ${summary.scanned_lines} lines
+            ${summary.truncated && ` (search stopped early: ${summary.truncated} limit reached${
+                summary.until ? `, lines after ${summary.until} weren't searched` : ""})`}
+        </div>
+    </pre>`
+}
+
 const Logs = ({ container }) => {
     const classes = useStyles()
     const [loading, setLoading] = useState(false)
+    const [searchQuery, setSearchQuery] = useState("")
+    const [searchLevel, setSearchLevel] = useState("")
+    const [results, setResults] = useState(null)
+    const [searching, setSearching] = useState(false)
     const stream = useRef(null)
     const logRef = useRef()
 
@@ -75,7 +114,42 @@ const Logs = ({ container }) => {
         </div>`
     }
 
-    return html`<pre class=${classes.root} ref=${logRef}></pre>`
+    const search = async evt => {
+        evt.preventDefault()
+        if (!searchQuery && !searchLevel) {
+            setResults(null)
+            return
+        }
+        setSearching(true)
+        try {
+            setResults(await api.searchLogs(container.Id, {
+                query: searchQuery,
+                level: searchLevel,
+            }))
+        } catch (err) {
+            setResults({ error: err.message })
+        }
+        setSearching(false)
+    }
+
+    return html`<div class=${classes.wrapper}>
+        <form class=${classes.search} onSubmit=${search}>
+            <input placeholder="Search regex" value=${searchQuery}
+                   onInput=${evt => setSearchQuery(evt.target.value)} />
+            <select value=${searchLevel} onChange=${evt => setSearchLevel(evt.target.value)}>
+                <option value="">Any level</option>
+                <option value="info">Info+</option>
+                <option value="warning">Warning+</option>
+                <option value="error">Error+</option>
+            </select>
+            <button type="submit" disabled=${searching}>Search</button>
+            ${results && html`<button type="button" onClick=${() => setResults(null)}>
+                Live logs
+            </button>`}
+        </form>
+        ${results && html`<${SearchResults} results=${results} classes=${classes} />`}
+        <pre class="${classes.root} ${results ? classes.hidden : ""}" ref=${logRef}></pre>
+    </div>`
 }
 
 export default Logs